@@ -0,0 +1,148 @@
+"""Local, versioned copies of the OpenDota constants tables.
+
+Each table lives in CONSTANTS_DIR/<table>.json along with a version number,
+the time it was fetched and the ETag/Last-Modified the API sent with it, so
+refreshing is a conditional GET that usually comes back 304. Tables are read
+from disk the first time they're used and memoized for the process.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import tempfile
+import threading
+import time
+
+import requests
+
+import opendota
+import retry_policy
+
+CONSTANTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "constants")
+TABLES = ("items", "heroes", "abilities", "ability_ids")
+ONE_DAY = 24 * 60 * 60
+
+# Tables we can build without the network, eg. for offline runs and tests
+SEED_FILES = {
+    "heroes": os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "hero_dict.json"
+    ),
+}
+
+_memo = {}
+_lock = threading.Lock()
+
+
+def _table_path(table):
+    return os.path.join(CONSTANTS_DIR, f"{table}.json")
+
+
+def read_entry(table):
+    """The stored {version, fetched_at, etag, last_modified, data} for table, or None"""
+    try:
+        with open(_table_path(table)) as f:
+            return json.loads(f.read())
+    except FileNotFoundError:
+        pass
+
+    seed_file = SEED_FILES.get(table)
+    if seed_file is None:
+        return None
+    with open(seed_file) as f:
+        return dict(
+            version=0,
+            fetched_at=0,
+            etag=None,
+            last_modified=None,
+            data=json.loads(f.read()),
+        )
+
+
+def _write_entry(table, entry):
+    os.makedirs(CONSTANTS_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=CONSTANTS_DIR, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(json.dumps(entry))
+        os.replace(tmp_path, _table_path(table))
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def refresh(table):
+    """Fetch table if it changed upstream. Returns the stored entry."""
+    entry = read_entry(table) or dict(version=0, etag=None, last_modified=None)
+    response = opendota.get_constants(
+        table,
+        etag=entry.get("etag"),
+        last_modified=entry.get("last_modified"),
+    )
+    if response.status_code == 304:
+        entry["fetched_at"] = time.time()
+    else:
+        response.raise_for_status()
+        entry = dict(
+            version=entry["version"] + 1,
+            fetched_at=time.time(),
+            etag=response.headers.get("ETag"),
+            last_modified=response.headers.get("Last-Modified"),
+            data=response.json(),
+        )
+    _write_entry(table, entry)
+    with _lock:
+        _memo[table] = entry["data"]
+    return entry
+
+
+def get_table(table, max_age=None):
+    """Constants table as a dict, fetching it only if we have no local copy
+    or, when max_age is given, the local copy is older than max_age seconds.
+
+    A failed refresh of a stale table falls back to the local copy so
+    reports still run offline.
+    """
+    with _lock:
+        data = _memo.get(table)
+    if data is not None and max_age is None:
+        return data
+
+    entry = read_entry(table)
+    if entry is None:
+        return refresh(table)["data"]
+
+    if max_age is not None and time.time() - entry["fetched_at"] > max_age:
+        try:
+            entry = refresh(table)
+        except (
+            requests.exceptions.RequestException,
+            retry_policy.RetriesExhausted,
+        ) as e:
+            print(f"Couldn't refresh {table} constants, using local copy: {e}")
+
+    with _lock:
+        _memo[table] = entry["data"]
+    return entry["data"]
+
+
+def clear_memo():
+    with _lock:
+        _memo.clear()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--refresh", action="store_true")
+    parser.add_argument("tables", nargs="*", default=list(TABLES))
+    args = parser.parse_args()
+
+    for table in args.tables:
+        entry = refresh(table) if args.refresh else read_entry(table)
+        if entry is None:
+            print(f"{table}: not stored")
+            continue
+        fetched_at = datetime.datetime.fromtimestamp(entry["fetched_at"])
+        print(
+            f"{table}: version {entry['version']}, fetched {fetched_at}, {len(entry['data'])} entries"
+        )
@@ -0,0 +1,106 @@
+"""Applies the numbered files in migrations/ to the matches database.
+
+Each file is either a Mango index definition, POSTed to _index as is, or
+{"design_doc": "<id>"} naming a couch_views design doc to install. Both are
+idempotent, so re-running a migration is harmless. Applied migrations are
+recorded in a _local metadata document so each runs once per database.
+"""
+
+import argparse
+import datetime
+import json
+import os
+
+import couch_views
+import couchdb
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+METADATA_DOC_ID = "_local/zeus_migrations"
+
+# Built when applied, since the items views embed the current items table
+DESIGN_DOCS = {
+    couch_views.DESIGN_DOC_ID: lambda: couch_views.STATS_DESIGN_DOC,
+    couch_views.ITEMS_DESIGN_DOC_ID: couch_views.items_design_doc,
+    couch_views.COUNTS_DESIGN_DOC_ID: lambda: couch_views.COUNTS_DESIGN_DOC,
+}
+
+
+def load_migrations(migrations_dir=MIGRATIONS_DIR):
+    """[(name, body)] in the order they apply"""
+    migrations = []
+    for filename in sorted(os.listdir(migrations_dir)):
+        if not filename.endswith(".json"):
+            continue
+        with open(os.path.join(migrations_dir, filename)) as f:
+            migrations.append((filename[: -len(".json")], json.loads(f.read())))
+    return migrations
+
+
+def _metadata_url(db):
+    return f"{db.database_url}/{METADATA_DOC_ID}"
+
+
+def read_metadata(db):
+    resp = db.r_session.get(_metadata_url(db))
+    if resp.status_code == 404:
+        return {"_id": METADATA_DOC_ID, "applied": {}}
+    resp.raise_for_status()
+    return resp.json()
+
+
+def _write_metadata(db, metadata):
+    resp = db.r_session.put(
+        _metadata_url(db),
+        data=json.dumps(metadata),
+        headers={"Content-Type": "application/json"},
+    )
+    resp.raise_for_status()
+    metadata["_rev"] = resp.json()["rev"]
+
+
+def apply_migration(db, body):
+    if "design_doc" in body:
+        couch_views.ensure_design_doc(db, DESIGN_DOCS[body["design_doc"]]())
+        return "installed"
+    resp = db.r_session.post(
+        f"{db.database_url}/_index",
+        data=json.dumps(body),
+        headers={"Content-Type": "application/json"},
+    )
+    resp.raise_for_status()
+    # "created", or "exists" if an identical index was already there
+    return resp.json()["result"]
+
+
+def migrate(db, migrations=None):
+    """Apply every migration not yet recorded for db. Returns the names applied."""
+    if migrations is None:
+        migrations = load_migrations()
+    metadata = read_metadata(db)
+    applied = []
+    for name, body in migrations:
+        if name in metadata["applied"]:
+            continue
+        result = apply_migration(db, body)
+        print(f"Applied migration {name}: {result}")
+        metadata["applied"][name] = datetime.datetime.now().isoformat()
+        # Recorded one at a time so a failure part way through resumes there
+        _write_metadata(db, metadata)
+        applied.append(name)
+    return applied
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--status", action="store_true", help="List migrations without applying"
+    )
+    args = parser.parse_args()
+
+    db = couchdb.get_matches_db()
+    if args.status:
+        applied = read_metadata(db)["applied"]
+        for name, _ in load_migrations():
+            print(f"{name}: {applied.get(name, 'pending')}")
+    else:
+        print(f"Applied {len(migrate(db))} migrations")
@@ -0,0 +1,253 @@
+"""Map/reduce views that count wins and games inside CouchDB.
+
+The raters can read these grouped counts instead of streaming every match
+document into Python. Every view emits [wins, games] and reduces with
+_sum, which sums arrays element-wise:
+
+    hero_weeks    [hero_id, start_week]                 all matches
+    hero_items    [hero_id, item_key]                   after winmore pruning,
+                                                        less built components
+    hero_talents  [hero_id, ability_id, level_taken]    every ability upgrade
+
+The winmore pruning in hero_items mirrors matchlib.prune_winmore_purchases
+with its default MAX_GPM_ADV; change both together.
+
+hero_items embeds the item components from the items constants table, so
+it lives in its own design doc, zeus_items: CouchDB rebuilds every view in
+a design doc when any of them changes, and a new items table shouldn't
+rebuild hero_weeks and hero_talents.
+
+Match counting lives in another design doc, zeus_counts, so its views can
+change without rebuilding the stats views. Both views reduce with _count
+and order by start day then start_time, so one range covers "since t":
+
+    matches_by_time       [start_day, start_time]
+    hero_matches_by_time  [hero_id, start_day, start_time]
+"""
+
+import json
+
+import constants_store
+import matchlib
+
+DESIGN_DOC_ID = "_design/zeus_stats"
+ITEMS_DESIGN_DOC_ID = "_design/zeus_items"
+COUNTS_DESIGN_DOC_ID = "_design/zeus_counts"
+SECONDS_PER_DAY = 24 * 60 * 60
+SECONDS_PER_WEEK = 7 * SECONDS_PER_DAY
+
+_PLAYER_RESULT_JS = """
+    var isRadiant = player.player_slot < 127;
+    var won = isRadiant === Boolean(doc.radiant_win);
+"""
+
+HERO_WEEKS_MAP = """function (doc) {
+  if (!doc.players || doc.start_time === undefined) return;
+  var week = Math.floor(doc.start_time / %(seconds_per_week)d);
+  for (var p = 0; p < doc.players.length; p++) {
+    var player = doc.players[p];%(player_result)s
+    emit([player.hero_id, week], [won ? 1 : 0, 1]);
+  }
+}""" % dict(seconds_per_week=SECONDS_PER_WEEK, player_result=_PLAYER_RESULT_JS)
+
+HERO_ITEMS_MAP_TEMPLATE = """function (doc) {
+  if (!doc.players || !doc.players.length || !doc.players[0].purchase_log) return;
+  if (!doc.radiant_gold_adv || !doc.players[0].times) return;
+  var threshold = %(max_gpm_adv)d;
+  var components = %%(components)s;
+  var times = doc.players[0].times;
+  var goldAdvPerMin = [];
+  for (var i = 0; i < doc.radiant_gold_adv.length; i++) {
+    goldAdvPerMin.push(doc.radiant_gold_adv[i] / (i || 1));
+  }
+  for (var p = 0; p < doc.players.length; p++) {
+    var player = doc.players[p];%(player_result)s
+    var sign = isRadiant ? 1 : -1;
+    var purchases = player.purchase_log || [];
+    var timeIdx = 0;
+    var counted = {};
+    for (var j = 0; j < purchases.length; j++) {
+      var purchase = purchases[j];
+      while (timeIdx + 1 < times.length && purchase.time > times[timeIdx + 1]) timeIdx++;
+      var advantage = sign * goldAdvPerMin[timeIdx];
+      if (times[timeIdx] > 600) {
+        if (won && advantage >= threshold) continue;
+        if (!won && advantage < -threshold) continue;
+      }
+      counted[purchase.key] = true;
+    }
+    var built = {};
+    for (var key in counted) {
+      var parts = components[key] || [];
+      for (var c = 0; c < parts.length; c++) built[parts[c]] = true;
+    }
+    for (var itemKey in counted) {
+      if (!built[itemKey]) emit([player.hero_id, itemKey], [won ? 1 : 0, 1]);
+    }
+  }
+}""" % dict(max_gpm_adv=matchlib.MAX_GPM_ADV, player_result=_PLAYER_RESULT_JS)
+
+HERO_TALENTS_MAP = """function (doc) {
+  if (!doc.players) return;
+  for (var p = 0; p < doc.players.length; p++) {
+    var player = doc.players[p];
+    if (!player.ability_upgrades_arr) continue;%(player_result)s
+    for (var i = 0; i < player.ability_upgrades_arr.length; i++) {
+      emit([player.hero_id, player.ability_upgrades_arr[i], i + 1], [won ? 1 : 0, 1]);
+    }
+  }
+}""" % dict(player_result=_PLAYER_RESULT_JS)
+
+
+def hero_items_map(components):
+    """The hero_items map, leaving out components (see
+    matchlib.counted_item_keys) per the {item_key: component keys} given"""
+    return HERO_ITEMS_MAP_TEMPLATE % dict(
+        components=json.dumps(components, sort_keys=True)
+    )
+
+
+STATS_DESIGN_DOC = {
+    "_id": DESIGN_DOC_ID,
+    "language": "javascript",
+    "views": {
+        "hero_weeks": {"map": HERO_WEEKS_MAP, "reduce": "_sum"},
+        "hero_talents": {"map": HERO_TALENTS_MAP, "reduce": "_sum"},
+    },
+}
+
+
+def items_design_doc(components=None):
+    """The zeus_items design doc, by default with the components from the
+    constants_store items table. A changed table changes the hero_items map,
+    so ensure_design_doc() rebuilds the view."""
+    if components is None:
+        components = matchlib.item_components(constants_store.get_table("items"))
+    return {
+        "_id": ITEMS_DESIGN_DOC_ID,
+        "language": "javascript",
+        "views": {
+            "hero_items": {"map": hero_items_map(components), "reduce": "_sum"},
+        },
+    }
+
+
+MATCHES_BY_TIME_MAP = """function (doc) {
+  if (doc.start_time === undefined) return;
+  emit([Math.floor(doc.start_time / %(seconds_per_day)d), doc.start_time], null);
+}""" % dict(seconds_per_day=SECONDS_PER_DAY)
+
+HERO_MATCHES_BY_TIME_MAP = """function (doc) {
+  if (!doc.players || doc.start_time === undefined) return;
+  var day = Math.floor(doc.start_time / %(seconds_per_day)d);
+  for (var p = 0; p < doc.players.length; p++) {
+    emit([doc.players[p].hero_id, day, doc.start_time], null);
+  }
+}""" % dict(seconds_per_day=SECONDS_PER_DAY)
+
+COUNTS_DESIGN_DOC = {
+    "_id": COUNTS_DESIGN_DOC_ID,
+    "language": "javascript",
+    "views": {
+        "matches_by_time": {"map": MATCHES_BY_TIME_MAP, "reduce": "_count"},
+        "hero_matches_by_time": {"map": HERO_MATCHES_BY_TIME_MAP, "reduce": "_count"},
+    },
+}
+
+
+def _design_doc_url(db, design_doc_id=DESIGN_DOC_ID):
+    return f"{db.database_url}/{design_doc_id}"
+
+
+def ensure_design_doc(db, design_doc=None):
+    """Install or update design_doc, by default STATS_DESIGN_DOC, if its
+    views changed. Returns True if it wrote, which makes CouchDB rebuild the
+    views on next read."""
+    if design_doc is None:
+        design_doc = STATS_DESIGN_DOC
+    url = _design_doc_url(db, design_doc["_id"])
+    resp = db.r_session.get(url)
+    desired = dict(design_doc)
+    if resp.status_code == 200:
+        existing = resp.json()
+        if existing.get("views") == desired["views"]:
+            return False
+        desired["_rev"] = existing["_rev"]
+    elif resp.status_code != 404:
+        resp.raise_for_status()
+
+    resp = db.r_session.put(
+        url,
+        data=json.dumps(desired),
+        headers={"Content-Type": "application/json"},
+    )
+    resp.raise_for_status()
+    print(f"Installed design doc {design_doc['_id']}")
+    return True
+
+
+def _encode_view_param(name, value):
+    if name in ("key", "startkey", "endkey", "keys") or isinstance(value, bool):
+        return json.dumps(value)
+    return value
+
+
+def query_view(db, view_name, design_doc_id=DESIGN_DOC_ID, **params):
+    """Rows of a view; keys like startkey/endkey are JSON encoded for you"""
+    resp = db.r_session.get(
+        f"{_design_doc_url(db, design_doc_id)}/_view/{view_name}",
+        params={
+            name: _encode_view_param(name, value) for name, value in params.items()
+        },
+    )
+    resp.raise_for_status()
+    return resp.json()["rows"]
+
+
+def _hero_range(hero_id):
+    if hero_id is None:
+        return {}
+    return dict(startkey=[hero_id], endkey=[hero_id, {}])
+
+
+def hero_counts(db, hero_id=None, since_week=None):
+    """{hero_id: (wins, games)}, optionally only for weeks >= since_week"""
+    if since_week is None:
+        rows = query_view(db, "hero_weeks", group_level=1, **_hero_range(hero_id))
+        return {row["key"][0]: tuple(row["value"]) for row in rows}
+
+    # A range can't skip weeks for every hero at once, so group by week and
+    # leave out the early ones here; that's a few thousand rows at most
+    counts = {}
+    for row in query_view(db, "hero_weeks", group_level=2, **_hero_range(hero_id)):
+        row_hero_id, week = row["key"]
+        if week < since_week:
+            continue
+        wins, games = counts.get(row_hero_id, (0, 0))
+        counts[row_hero_id] = (wins + row["value"][0], games + row["value"][1])
+    return counts
+
+
+def hero_item_counts(db, hero_id=None):
+    """{hero_id: {item_key: (wins, games)}} from the pruned purchase logs"""
+    counts = {}
+    rows = query_view(
+        db,
+        "hero_items",
+        design_doc_id=ITEMS_DESIGN_DOC_ID,
+        group_level=2,
+        **_hero_range(hero_id),
+    )
+    for row in rows:
+        row_hero_id, item_key = row["key"]
+        counts.setdefault(row_hero_id, {})[item_key] = tuple(row["value"])
+    return counts
+
+
+def hero_talent_counts(db, hero_id):
+    """{ability_id: {level_taken: (wins, games)}} for one hero"""
+    counts = {}
+    for row in query_view(db, "hero_talents", group_level=3, **_hero_range(hero_id)):
+        _, ability_id, level = row["key"]
+        counts.setdefault(ability_id, {})[level] = tuple(row["value"])
+    return counts
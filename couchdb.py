@@ -1,15 +1,39 @@
 import contextlib
 import cloudant
 import cloudant.database
-from cloudant import couchdb as couch
 from cloudant.query import Query
 import argparse
 import datetime
+import json
+import math
+import queue
+import threading
+import time
 import dateparser
+import requests.adapters
 
+import couch_views
 import opendota
 
 MATCHES_DBNAME = "zeus_matches"
+EPOCH_DATE = datetime.date(1970, 1, 1)
+COUCH_URL = "http://127.0.0.1:5984"
+# Connections kept open to CouchDB, shared by every handle in the process
+POOL_SIZE = 10
+
+# Matches whose purchase logs are in, the partial filter of the index
+# created by migrations/0003_create_parsed_start_time_index.json
+PARSED_MATCHES_SELECTOR = {"players": {"$elemMatch": {"purchase_log": {"$exists": True}}}}
+PARSED_START_TIME_INDEX = "parsed_start_time_idx"
+# Mango page size and how many pages PrefetchingQuery buffers ahead
+QUERY_PAGE_SIZE = 500
+QUERY_PREFETCH_PAGES = 2
+
+# One logged-in client and one handle per database, per process
+_client = None
+_databases = {}
+_context_depth = 0
+_lock = threading.Lock()
 
 
 def _ensure_db(client, dbname):
@@ -22,39 +46,267 @@ def _ensure_db(client, dbname):
     return client[dbname]
 
 
-def get_client() -> cloudant.Cloudant:
+def make_client() -> cloudant.Cloudant:
+    """A new logged-in client. Most callers want the shared get_client()."""
     return cloudant.Cloudant(
         "admin",
         "password",
-        url="http://127.0.0.1:5984",
+        url=COUCH_URL,
         connect=True,
+        # Long-lived workers outlast the session cookie
+        auto_renew=True,
+        adapter=requests.adapters.HTTPAdapter(
+            pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE
+        ),
     )
 
 
+def get_client() -> cloudant.Cloudant:
+    global _client
+    with _lock:
+        if _client is None:
+            _client = make_client()
+        return _client
+
+
 def get_matches_db(dbname=MATCHES_DBNAME) -> cloudant.database.CouchDatabase:
+    """Shared handle on dbname, created if missing the first time it's asked for"""
     client = get_client()
-    return _ensure_db(client, dbname)
+    with _lock:
+        if dbname not in _databases:
+            _databases[dbname] = _ensure_db(client, dbname)
+        return _databases[dbname]
+
+
+def close_client():
+    """Log out the shared client; the next get_* call reconnects"""
+    global _client
+    with _lock:
+        client, _client = _client, None
+        _databases.clear()
+    if client is not None:
+        client.disconnect()
 
 
 def match_exists_in_db(db, match_id):
     return str(match_id) in db
 
 
+def _all_docs(db, keys, include_docs=False):
+    """_all_docs rows for keys, in one request"""
+    resp = db.r_session.post(
+        f"{db.database_url}/_all_docs",
+        params={"include_docs": "true"} if include_docs else None,
+        data=json.dumps({"keys": keys}),
+        headers={"Content-Type": "application/json"},
+    )
+    resp.raise_for_status()
+    return resp.json()["rows"]
+
+
+def existing_match_ids(db, match_ids):
+    """The str ids among match_ids that are stored, in one _all_docs request"""
+    if not match_ids:
+        return set()
+    return {
+        row["id"]
+        for row in _all_docs(db, [str(match_id) for match_id in match_ids])
+        if "error" not in row and not row["value"].get("deleted")
+    }
+
+
+def explain(db, query_dict):
+    """CouchDB's plan for a Mango query, including the index it would use"""
+    resp = db.r_session.post(
+        f"{db.database_url}/_explain",
+        data=json.dumps(query_dict),
+        headers={"Content-Type": "application/json"},
+    )
+    resp.raise_for_status()
+    return resp.json()
+
+
+def warn_if_full_scan(db, query_dict):
+    """Print a warning if query_dict would be answered by scanning every
+    document, which usually means the migrations haven't been applied"""
+    index = explain(db, query_dict)["index"]
+    if index["type"] != "special":
+        return False
+    print(
+        f"WARNING: no index serves {json.dumps(query_dict['selector'])}, "
+        f"scanning all of {db.database_name}. Run couch_migrations.py"
+    )
+    return True
+
+
+class PrefetchingQuery:
+    """Iterable over the documents a Mango query matches.
+
+    Pages are fetched by following bookmarks on a background thread that
+    stays up to prefetch pages ahead of the consumer, so the next pages are
+    on their way while the current one is being processed. Each iteration
+    runs the query afresh; errors fetching a page are raised from the loop.
+    """
+
+    _DONE = object()
+
+    def __init__(self, db, query_dict, page_size=None, prefetch=None):
+        self.db = db
+        self.query_dict = dict(query_dict)
+        self.page_size = page_size or QUERY_PAGE_SIZE
+        self.prefetch = prefetch or QUERY_PREFETCH_PAGES
+
+    def fetch_page(self, bookmark=None):
+        """(docs, bookmark) for the page after bookmark"""
+        body = dict(self.query_dict, limit=self.page_size)
+        if bookmark is not None:
+            body["bookmark"] = bookmark
+        resp = self.db.r_session.post(
+            f"{self.db.database_url}/_find",
+            data=json.dumps(body),
+            headers={"Content-Type": "application/json"},
+        )
+        resp.raise_for_status()
+        result = resp.json()
+        if len(result["docs"]) < self.page_size:
+            return result["docs"], None
+        return result["docs"], result.get("bookmark")
+
+    def _put(self, pages, stop, item):
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _fetch_pages(self, pages, stop):
+        bookmark = None
+        try:
+            while not stop.is_set():
+                docs, bookmark = self.fetch_page(bookmark)
+                if docs and not self._put(pages, stop, docs):
+                    return
+                if not bookmark:
+                    break
+        except Exception as e:
+            self._put(pages, stop, e)
+            return
+        self._put(pages, stop, self._DONE)
+
+    def __iter__(self):
+        pages = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        fetcher = threading.Thread(target=self._fetch_pages, args=(pages, stop), daemon=True)
+        fetcher.start()
+        try:
+            while True:
+                page = pages.get()
+                if page is self._DONE:
+                    return
+                if isinstance(page, Exception):
+                    raise page
+                yield from page
+        finally:
+            # Also reached if the consumer stops early; the fetcher notices
+            # within one put timeout
+            stop.set()
+
+
+def _parsed_only(query_dict):
+    query_dict["selector"] = {"$and": [query_dict["selector"], PARSED_MATCHES_SELECTOR]}
+    query_dict["use_index"] = [PARSED_START_TIME_INDEX, PARSED_START_TIME_INDEX]
+
+
 def get_all_parsed_matches_more_recent_than(
-    db: cloudant.database.CouchDatabase, start_time
+    db: cloudant.database.CouchDatabase, start_time, fields=None, page_size=None
 ):
-    query = db.get_query_result(
-        selector={"start_time": {"$gt": start_time}},
-        sort=["start_time"],
-    )
+    query_dict = {
+        "selector": {"start_time": {"$gt": start_time}},
+        "sort": ["start_time"],
+    }
+    _parsed_only(query_dict)
+    if fields is not None:
+        query_dict["fields"] = list(fields)
+    warn_if_full_scan(db, query_dict)
     # This is a paging query so just return it whole instead of loading it
-    return query
+    return PrefetchingQuery(db, query_dict, page_size)
+
+
+def _since_key(since):
+    """View key prefix [start_day, start_time] for matches starting after since"""
+    # start_times are whole seconds, so this starts just after since
+    first_start_time = math.floor(since) + 1
+    return [first_start_time // couch_views.SECONDS_PER_DAY, first_start_time]
+
+
+class HeroMatchesQuery(PrefetchingQuery):
+    """Iterable over the matches with hero_id in them that started after
+    start_time, in start_time order.
+
+    Match ids are paged out of the hero_matches_by_time view and the
+    documents fetched with _all_docs, so only matches with the hero are
+    read. keep(doc), if given, filters the documents further.
+    """
+
+    def __init__(self, db, hero_id, start_time, keep=None, fields=None, page_size=None, prefetch=None):
+        super().__init__(db, {}, page_size, prefetch)
+        self.hero_id = int(hero_id)
+        self.start_time = start_time
+        self.keep = keep
+        self.fields = fields
+
+    def fetch_page(self, bookmark=None):
+        """(docs, bookmark) for the page starting at bookmark's view row"""
+        if bookmark is None:
+            params = dict(startkey=[self.hero_id] + _since_key(self.start_time))
+        else:
+            startkey, startkey_docid = bookmark
+            params = dict(startkey=startkey, startkey_docid=startkey_docid)
+        # One row more than a page, to start the next page from
+        rows = couch_views.query_view(
+            self.db,
+            "hero_matches_by_time",
+            design_doc_id=couch_views.COUNTS_DESIGN_DOC_ID,
+            endkey=[self.hero_id, {}],
+            reduce=False,
+            limit=self.page_size + 1,
+            **params,
+        )
+        if len(rows) > self.page_size:
+            next_row = rows.pop()
+            bookmark = (next_row["key"], next_row["id"])
+        else:
+            bookmark = None
+
+        docs = []
+        if rows:
+            for row in _all_docs(self.db, [row["id"] for row in rows], include_docs=True):
+                doc = row.get("doc")
+                if doc is None or (self.keep is not None and not self.keep(doc)):
+                    continue
+                if self.fields is not None:
+                    doc = {field: doc[field] for field in self.fields if field in doc}
+                docs.append(doc)
+        return docs, bookmark
+
+
+def _is_parsed(doc):
+    return any("purchase_log" in player for player in doc.get("players", []))
 
 
 def get_all_matches_with_hero_after_start_time(
-    db: cloudant.database.CouchDatabase, start_time, hero_names=None, potential_hero_names=None
+    db: cloudant.database.CouchDatabase, start_time, hero_names=None, potential_hero_names=None, fields=None,
+    parsed_only=False, page_size=None,
 ):
+    """Matches after start_time with all of hero_names and, if given, any of
+    potential_hero_names in them.
 
+    Unless potential_hero_names is all there is and names several heroes,
+    this pages through one hero's matches in the hero_matches_by_time view
+    and checks the rest of the heroes on the documents themselves.
+    """
     if hero_names is None:
         hero_names = []
     if potential_hero_names is None:
@@ -64,36 +316,120 @@ def get_all_matches_with_hero_after_start_time(
     potential_hero_names = [name for name in potential_hero_names if name]
     heroes = [opendota.find_hero(name) for name in hero_names]
     potential_heroes = [opendota.find_hero(name) for name in potential_hero_names]
+
+    if heroes or len(potential_heroes) == 1:
+        hero_ids = {hero["id"] for hero in heroes}
+        potential_hero_ids = {hero["id"] for hero in potential_heroes}
+
+        def keep(doc):
+            doc_hero_ids = {player.get("hero_id") for player in doc.get("players", [])}
+            return (
+                hero_ids <= doc_hero_ids
+                and (not potential_hero_ids or bool(potential_hero_ids & doc_hero_ids))
+                and (not parsed_only or _is_parsed(doc))
+            )
+
+        return HeroMatchesQuery(
+            db, (heroes or potential_heroes)[0]["id"], start_time, keep, fields, page_size
+        )
+
     query_dict = {
         "selector": {
             "start_time": {"$gt": start_time},
         },
         "sort": ["start_time"],
     }
-    if len(heroes) + len(potential_heroes) == 1:
-        query_dict["selector"]["players"] = {
-            "$elemMatch": {"hero_id": heroes[0]["id"]},
-        }
-    elif heroes or potential_heroes:
-        selector = [
-            {"players": {"$elemMatch": {"hero_id": hero["id"]}}} for hero in heroes
-        ]
-        if selector:
-            query_dict["selector"]["$and"] = selector
-        selector = [
+    if fields is not None:
+        query_dict["fields"] = list(fields)
+    if potential_heroes:
+        query_dict["selector"]["$or"] = [
             {"players": {"$elemMatch": {"hero_id": hero["id"]}}} for hero in potential_heroes
         ]
-        if selector:
-            query_dict["selector"]["$or"] = selector
-    query = db.get_query_result(**query_dict)
-    return query
+    if parsed_only:
+        _parsed_only(query_dict)
+    warn_if_full_scan(db, query_dict)
+    return PrefetchingQuery(db, query_dict, page_size)
+
+
+class BulkMatchWriter:
+    """Buffers match documents and writes them with _bulk_docs.
 
+    A flush happens once max_docs documents or max_bytes of JSON are
+    buffered, or on the first add()/flush_if_due() after the oldest buffered
+    document has waited max_age seconds. A conflict means the match is
+    already stored, which is counted and otherwise ignored; any other
+    per-document error is kept in self.errors.
 
-def store_match_to_db(db: cloudant.database.CouchDatabase, match: dict):
-    match["_id"] = str(match["match_id"])
-    document = db.create_document(match)
-    assert document.exists()
-    return document
+    transform, eg. match_schema.prepare_match, maps each match to the
+    document actually stored.
+    """
+
+    def __init__(self, db, max_docs=500, max_bytes=16 * 1024 ** 2, max_age=10, transform=None):
+        self.db = db
+        self.transform = transform
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.stats = dict(stored=0, already_stored=0, errors=0, flushes=0)
+        self.errors = []
+        self._buffer = []
+        self._buffered_bytes = 0
+        self._oldest = None
+
+    def add(self, match: dict):
+        if self.transform is not None:
+            match = self.transform(match)
+        match["_id"] = str(match["match_id"])
+        # Encode once here; flush() splices the encoded docs into the body
+        encoded = json.dumps(match)
+        if not self._buffer:
+            self._oldest = time.monotonic()
+        self._buffer.append(encoded)
+        self._buffered_bytes += len(encoded)
+
+        if len(self._buffer) >= self.max_docs or self._buffered_bytes >= self.max_bytes:
+            return self.flush()
+        return self.flush_if_due()
+
+    def flush_if_due(self):
+        if self._buffer and time.monotonic() - self._oldest >= self.max_age:
+            return self.flush()
+        return None
+
+    def flush(self):
+        """Write everything buffered. Returns the _bulk_docs results."""
+        if not self._buffer:
+            return []
+        body = '{"docs": [' + ", ".join(self._buffer) + "]}"
+        resp = self.db.r_session.post(
+            f"{self.db.database_url}/_bulk_docs",
+            data=body,
+            headers={"Content-Type": "application/json"},
+        )
+        resp.raise_for_status()
+        results = resp.json()
+        # Only now, so a failed request can be retried with another flush()
+        self._buffer = []
+        self._buffered_bytes = 0
+        self._oldest = None
+        self.stats["flushes"] += 1
+        for result in results:
+            error = result.get("error")
+            if error is None:
+                self.stats["stored"] += 1
+            elif error == "conflict":
+                self.stats["already_stored"] += 1
+            else:
+                self.stats["errors"] += 1
+                self.errors.append(result)
+                print(f"Failed to store match {result.get('id')}: {error} {result.get('reason')}")
+        return results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
 
 
 def get_last_match_by_start_time(db):
@@ -107,38 +443,85 @@ def get_last_match_by_start_time(db):
     assert len(result) == 1
     return result[0]
 
-def get_num_matches_since_time(db, time):
-    selector={"start_time": {"$gt": time}}
-    res = db.get_query_result(selector)
-    print(time)
+def count_matches(db, since=None, hero_id=None, by_day=False):
+    """Number of stored matches, optionally only those starting after since
+    and/or with hero_id in them. With by_day, {date: count} instead.
 
-    return len([_ for _ in res])
+    Answered by the zeus_counts reduce views without reading any documents,
+    which migration 0004 installs.
+    """
+    if hero_id is None:
+        view_name, prefix = "matches_by_time", []
+    else:
+        view_name, prefix = "hero_matches_by_time", [int(hero_id)]
+
+    params = {}
+    if since is not None:
+        params["startkey"] = prefix + _since_key(since)
+    elif prefix:
+        params["startkey"] = prefix
+    if prefix:
+        params["endkey"] = prefix + [{}]
+    if by_day:
+        params["group_level"] = len(prefix) + 1
+
+    rows = couch_views.query_view(
+        db, view_name, design_doc_id=couch_views.COUNTS_DESIGN_DOC_ID, **params
+    )
+    if not by_day:
+        return rows[0]["value"] if rows else 0
+    return {
+        EPOCH_DATE + datetime.timedelta(days=row["key"][-1]): row["value"]
+        for row in rows
+    }
+
+
+def get_num_matches_since_time(db, time):
+    return count_matches(db, since=time)
 
 
 @contextlib.contextmanager
 def dbcontext(dbname=MATCHES_DBNAME):
-    with couch(
-        "admin",
-        "password",
-        url="http://127.0.0.1:5984",
-    ) as couch_client:
-        yield couch_client[dbname]
+    """Shared handle on dbname. Nested contexts reuse the same client, which
+    is logged out when the outermost one exits."""
+    global _context_depth
+    with _lock:
+        _context_depth += 1
+    try:
+        yield get_matches_db(dbname)
+    finally:
+        with _lock:
+            _context_depth -= 1
+            last_out = _context_depth == 0
+        if last_out:
+            close_client()
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--display-stats", action="store_true")
     parser.add_argument("--start", type=str, default="")
+    parser.add_argument("--hero", type=str, default="")
+    parser.add_argument("--by-day", action="store_true")
+    parser.add_argument("--install-views", action="store_true")
     args = parser.parse_args()
-    start_time = dateparser.parse(args.start).timestamp()
+    start_time = dateparser.parse(args.start).timestamp() if args.start else None
+    hero_id = opendota.get_hero_id(args.hero) if args.hero else None
+
+    if args.install_views:
+        couch_views.ensure_design_doc(get_matches_db())
+        couch_views.ensure_design_doc(get_matches_db(), couch_views.items_design_doc())
+        couch_views.ensure_design_doc(get_matches_db(), couch_views.COUNTS_DESIGN_DOC)
 
     if args.display_stats:
         matches_db = get_matches_db()
         if not args.start:
-            all_docs = matches_db.all_docs()
-            print(f"Num fully parsed matches: {all_docs['total_rows']}")
+            print(f"Num matches: {count_matches(matches_db, hero_id=hero_id)}")
         else:
-            print(f"Num matches since input-time: {get_num_matches_since_time(matches_db, start_time)}")
+            print(f"Num matches since input-time: {count_matches(matches_db, start_time, hero_id)}")
+        if args.by_day:
+            for day, count in sorted(count_matches(matches_db, start_time, hero_id, by_day=True).items()):
+                print(f"{day}: {count}")
         print(
             f"Last match start_time {datetime.datetime.fromtimestamp(get_last_match_by_start_time(matches_db)['start_time'])}"
         )
@@ -16,15 +16,15 @@ import opendota
 import stratz
 
 def team_of_interest(game, hero_ids, potential_hero_ids):
-    heroes_on_radiant = [player['player_slot'] < 127 for player in game['players'] if player['hero_id'] in hero_ids]
-    potential_heroes_on_radiant = [player['player_slot'] < 127 for player in game['players'] if player['hero_id'] in potential_hero_ids]
+    heroes_on_radiant = [player.is_radiant for player in game.players if player.hero_id in hero_ids]
+    potential_heroes_on_radiant = [player.is_radiant for player in game.players if player.hero_id in potential_hero_ids]
     heroes_all_on_radiant = all(heroes_on_radiant) and any(potential_heroes_on_radiant)
     heroes_all_on_dire = bool(not any(heroes_on_radiant)) and bool(not all(potential_heroes_on_radiant))
     return heroes_all_on_radiant, heroes_all_on_dire
 
 
 def games_with_heroes_on_same_team(dbquery, hero_ids, potential_hero_ids):
-    for game in dbquery:
+    for game in matchlib.iterate_match_records(dbquery):
         heroes_all_on_radiant, heroes_all_on_dire = team_of_interest(game, hero_ids, potential_hero_ids)
         heroes_on_same_team = heroes_all_on_radiant or heroes_all_on_dire
         if heroes_on_same_team:
@@ -36,12 +36,12 @@ def calculate_winrate_for_opposing_heroes(game, heroes, potential_heroes):
     games = collections.Counter()
     
     if heroes_all_on_radiant:
-        dire_heroes = [player['hero_id'] for player in game['players'] if player['player_slot'] >= 127]
-        wins.update([hero_id for hero_id in dire_heroes if not game['radiant_win']])
+        dire_heroes = [player.hero_id for player in game.players if not player.is_radiant]
+        wins.update([hero_id for hero_id in dire_heroes if not game.radiant_win])
         games.update(dire_heroes)
     if heroes_all_on_dire:
-        radiant_heroes = [player['hero_id'] for player in game['players'] if player['player_slot'] < 127]
-        wins.update([hero_id for hero_id in radiant_heroes if game['radiant_win']])
+        radiant_heroes = [player.hero_id for player in game.players if player.is_radiant]
+        wins.update([hero_id for hero_id in radiant_heroes if game.radiant_win])
         games.update(radiant_heroes)
 
     return wins, games
@@ -24,7 +24,7 @@ def _score_hero_name(hero_name, input):
     return 0
 
 def match(input):
-    heroes = opendota.load_hero_list().values()
+    heroes = opendota.all_heroes()
     best_score = 0
     best_match = None
     for hero in heroes:
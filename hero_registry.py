@@ -0,0 +1,85 @@
+import threading
+import types
+
+import constants_store
+
+_registry = None
+_registry_source = None
+_lock = threading.Lock()
+
+
+class HeroRegistry:
+    """Immutable, indexed view over the hero constants table.
+
+    Lookups by id, localized name and npc name are all dict hits, and every
+    hero id is assigned a dense index in [0, len(registry)) so matrix code can
+    use plain lists/arrays instead of dicts keyed by sparse hero ids.
+    """
+
+    __slots__ = ("_by_str_id", "_by_id", "_by_name", "_by_npc_name", "_ids", "_index")
+
+    def __init__(self, hero_dict):
+        by_id = {int(hero["id"]): hero for hero in hero_dict.values()}
+        ids = tuple(sorted(by_id))
+
+        self._by_str_id = types.MappingProxyType(
+            {str(hero_id): by_id[hero_id] for hero_id in ids}
+        )
+        self._by_id = types.MappingProxyType(by_id)
+        self._by_name = types.MappingProxyType(
+            {hero["localized_name"]: hero for hero in by_id.values()}
+        )
+        self._by_npc_name = types.MappingProxyType(
+            {hero["name"]: hero for hero in by_id.values()}
+        )
+        self._ids = ids
+        self._index = types.MappingProxyType(
+            {hero_id: i for i, hero_id in enumerate(ids)}
+        )
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __iter__(self):
+        return iter(self._by_id.values())
+
+    def __contains__(self, hero_id):
+        return self.by_id(hero_id) is not None
+
+    def as_dict(self):
+        """Read-only mapping keyed by str(hero_id), same shape as hero_dict.json"""
+        return self._by_str_id
+
+    def by_id(self, hero_id):
+        try:
+            return self._by_id.get(int(hero_id))
+        except (TypeError, ValueError):
+            return None
+
+    def by_name(self, localized_name):
+        return self._by_name.get(localized_name)
+
+    def by_npc_name(self, npc_name):
+        return self._by_npc_name.get(npc_name)
+
+    def index_of(self, hero_id):
+        return self._index[int(hero_id)]
+
+    def id_at(self, index):
+        return self._ids[index]
+
+    @property
+    def ids(self):
+        return self._ids
+
+
+def get_hero_registry():
+    """Registry over the current heroes table, rebuilt when constants_store
+    hands back a different copy of it, eg. after a refresh"""
+    global _registry, _registry_source
+    heroes = constants_store.get_table("heroes")
+    with _lock:
+        if _registry is None or _registry_source is not heroes:
+            _registry = HeroRegistry(heroes)
+            _registry_source = heroes
+        return _registry
@@ -0,0 +1,73 @@
+import requests
+import requests.adapters
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_TIMEOUT = (5, 30)  # (connect, read) seconds
+
+
+class PooledSession:
+    """A requests.Session with a sized keep-alive connection pool.
+
+    All calls made through one PooledSession share TCP/TLS connections, so a
+    scrape that makes thousands of calls to the same host only handshakes
+    pool_size times. connection_stats() reports how many requests actually
+    reused a connection.
+    """
+
+    def __init__(
+        self, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT, headers=None
+    ):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._adapter = requests.adapters.HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=pool_size,
+            pool_block=False,
+        )
+        self._session = requests.Session()
+        self._session.mount("https://", self._adapter)
+        self._session.mount("http://", self._adapter)
+        self._session.headers.update(
+            {
+                "Accept-Encoding": "gzip, deflate",
+                "Connection": "keep-alive",
+            }
+        )
+        if headers:
+            self._session.headers.update(headers)
+
+    def request(self, method, url, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = self.timeout
+        return self._session.request(method, url, timeout=timeout, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def connection_stats(self):
+        pools = self._adapter.poolmanager.pools
+        opened = 0
+        requests_made = 0
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            opened += pool.num_connections
+            requests_made += pool.num_requests
+        return dict(
+            requests=requests_made,
+            connections_opened=opened,
+            connections_reused=max(requests_made - opened, 0),
+        )
+
+    def close(self):
+        self._session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
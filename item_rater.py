@@ -4,21 +4,28 @@ import math
 import dateparser
 import tabulate
 
+import constants_store
+import couch_views
 import couchdb
+import match_stats
 import matchlib
 import opendota
 
+# Match fields calculate_item_winrates reads, so queries can skip the rest.
+# Mango can't project inside arrays, so players comes back whole.
+QUERY_FIELDS = ["match_id", "start_time", "radiant_win", "players", "radiant_gold_adv"]
+
 
 def calculate_item_winrates(item_info, db_query):
     heroes = {}
+    components = matchlib.item_components(item_info)
 
     for match in db_query:
         if not matchlib.is_fully_parsed(match):
             continue
-        filtered_item_purchases = matchlib.parse_match(match)
-        for hero_purchases in filtered_item_purchases:
-            hero_name = hero_purchases["hero"]["localized_name"]
-            counted_already = set()
+        record = matchlib.MatchRecord(match)
+        for player, purchase_keys in zip(record.players, record.pruned_purchase_keys()):
+            hero_name = opendota.find_hero_name_by_id(player.hero_id)
             heroes.setdefault(hero_name, {})
 
             heroes[hero_name].setdefault("wins", 0)
@@ -26,37 +33,59 @@ def calculate_item_winrates(item_info, db_query):
             heroes[hero_name].setdefault("items", {})
 
             heroes[hero_name]["games"] += 1
-            if hero_purchases["player_won"]:
+            if player.player_won:
                 heroes[hero_name]["wins"] += 1
 
-            for purchase in hero_purchases["purchases"]:
-                if purchase["key"] in counted_already:
-                    # TODO: Handle consumables, probably via buckets, ie. 1 sentry, 2-4 sentries, 4-8, etc
-                    continue
-                counted_already.add(purchase["key"])
-
+            # TODO: Handle consumables, probably via buckets, ie. 1 sentry, 2-4 sentries, 4-8, etc
+            for purchase_key in matchlib.counted_item_keys(purchase_keys, components):
                 heroes[hero_name]["items"].setdefault(
-                    purchase["key"], {"wins": 0, "games": 0}
+                    purchase_key, {"wins": 0, "games": 0}
                 )
-                heroes[hero_name]["items"][purchase["key"]]["games"] += 1
-                heroes[hero_name]["items"][purchase["key"]]["wins"] += int(
-                    hero_purchases["player_won"]
+                heroes[hero_name]["items"][purchase_key]["games"] += 1
+                heroes[hero_name]["items"][purchase_key]["wins"] += int(
+                    player.player_won
                 )
 
-                components = item_info[purchase["key"]]["components"]
-                if not components:
-                    continue
-                for component in components:
-                    if not component in heroes[hero_name]["items"]:
-                        continue
-                    heroes[hero_name]["items"][component]["games"] -= 1
-                    heroes[hero_name]["items"][component]["wins"] -= int(
-                        hero_purchases["player_won"]
-                    )
+    return heroes
 
+
+def item_winrates_from_counts(hero_totals, hero_item_counts):
+    """Same shape as calculate_item_winrates, built from pre-aggregated
+    {hero_id: (wins, games)} and {hero_id: {item_key: (wins, games)}} counts,
+    which already leave out components built into other items"""
+    heroes = {}
+    for row_hero_id, (wins, games) in hero_totals.items():
+        items = {
+            key: {"wins": item_wins, "games": item_games}
+            for key, (item_wins, item_games) in hero_item_counts.get(row_hero_id, {}).items()
+        }
+        hero_name = opendota.find_hero_name_by_id(row_hero_id)
+        heroes[hero_name] = dict(wins=wins, games=games, items=items)
     return heroes
 
 
+def calculate_item_winrates_from_views(item_info, db, hero_id=None):
+    """calculate_item_winrates over every stored match, from the couch_views
+    grouped counts"""
+    couch_views.ensure_design_doc(db)
+    couch_views.ensure_design_doc(
+        db, couch_views.items_design_doc(matchlib.item_components(item_info))
+    )
+    return item_winrates_from_counts(
+        couch_views.hero_counts(db, hero_id),
+        couch_views.hero_item_counts(db, hero_id),
+    )
+
+
+def calculate_item_winrates_from_stats(stats, hero_id=None):
+    """calculate_item_winrates over every match folded into a
+    match_stats.MatchStats"""
+    return item_winrates_from_counts(
+        stats.hero_counts(hero_id),
+        stats.hero_item_counts(hero_id),
+    )
+
+
 def normalize_item_winrates_by_cost_and_hero_winrate(
     hero_table, item_info, min_num_games=30
 ):
@@ -101,25 +130,50 @@ def normalize_item_winrates_by_cost_and_hero_winrate(
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--hero", type=str, default="")
-    parser.add_argument("--start-time", type=str, default='Jan 1 2020')
+    parser.add_argument("--start-time", type=str, help="Default Jan 1 2020")
     parser.add_argument("--all-heroes", action="store_true")
     parser.add_argument("--min-num-games", type=int, default=30)
     parser.add_argument("--num-hero-item-pairs", type=int, default=100)
-    args = parser.parse_args()
-
-    db = couchdb.get_matches_db()
-    start_time = dateparser.parse(args.start_time).timestamp()
-    dbquery = couchdb.get_all_matches_with_hero_after_start_time(
-        db,
-        start_time,
-        [args.hero],
+    parser.add_argument(
+        "--use-views",
+        action="store_true",
+        help="Read win counts from CouchDB views. Covers every match, so no --start-time",
     )
-
-    item_info = opendota.get_item_table()
-    item_winrates = calculate_item_winrates(
-        item_info,
-        dbquery,
+    parser.add_argument(
+        "--use-stats",
+        action="store_true",
+        help="Read win counts materialized by match_stats. Covers every match, so no --start-time",
     )
+    args = parser.parse_args()
+    if args.start_time is not None and (args.use_views or args.use_stats):
+        parser.error("--use-views and --use-stats cover every match, they can't take --start-time")
+
+    with couchdb.dbcontext() as db:
+        item_info = constants_store.get_table("items", max_age=constants_store.ONE_DAY)
+        if args.use_stats:
+            item_winrates = calculate_item_winrates_from_stats(
+                match_stats.load_stats(db),
+                opendota.get_hero_id(args.hero) if args.hero else None,
+            )
+        elif args.use_views:
+            item_winrates = calculate_item_winrates_from_views(
+                item_info,
+                db,
+                opendota.get_hero_id(args.hero) if args.hero else None,
+            )
+        else:
+            start_time = dateparser.parse(args.start_time or "Jan 1 2020").timestamp()
+            dbquery = couchdb.get_all_matches_with_hero_after_start_time(
+                db,
+                start_time,
+                [args.hero],
+                fields=QUERY_FIELDS,
+                parsed_only=True,
+            )
+            item_winrates = calculate_item_winrates(
+                item_info,
+                dbquery,
+            )
 
     hero_winrates = [
         (hero_name, iw["wins"], iw["games"], (iw["wins"] / iw["games"]) * 100)
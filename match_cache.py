@@ -0,0 +1,152 @@
+"""Read-through disk cache for OpenDota match payloads.
+
+A fully parsed match never changes, so once we've downloaded one there's no
+reason to fetch it again for a backfill or a DB rebuild. Entries are gzipped
+JSON sharded by a hash of the match id; unparsed matches are kept only for
+a short TTL so the next lookup re-checks whether parsing has finished.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+import matchlib
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "match_cache"
+)
+DEFAULT_MAX_BYTES = 5 * 1024**3
+DEFAULT_UNPARSED_TTL = 10 * 60
+# After going over max_bytes, evict down to this fraction of it so we don't
+# rescan the directory on every following write.
+EVICT_TO_FRACTION = 0.9
+
+
+class MatchCache:
+    def __init__(
+        self,
+        cache_dir=DEFAULT_CACHE_DIR,
+        max_bytes=DEFAULT_MAX_BYTES,
+        unparsed_ttl=DEFAULT_UNPARSED_TTL,
+    ):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.unparsed_ttl = unparsed_ttl
+        self.stats = dict(hits=0, misses=0, expired=0, writes=0, evictions=0)
+        self._size = None
+        self._lock = threading.Lock()
+
+    def path_for(self, match_id):
+        match_id = str(match_id)
+        shard = hashlib.md5(match_id.encode()).hexdigest()[:2]
+        return os.path.join(self.cache_dir, shard, f"{match_id}.json.gz")
+
+    def get(self, match_id):
+        path = self.path_for(match_id)
+        try:
+            with gzip.open(path, "rb") as f:
+                entry = json.loads(f.read())
+        except (FileNotFoundError, OSError, ValueError):
+            self.stats["misses"] += 1
+            return None
+
+        if (
+            not entry["fully_parsed"]
+            and time.time() - entry["fetched_at"] > self.unparsed_ttl
+        ):
+            self.stats["expired"] += 1
+            return None
+
+        self.stats["hits"] += 1
+        # Bump mtime so eviction treats this entry as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return entry["match"]
+
+    def put(self, match_id, match):
+        entry = dict(
+            fetched_at=time.time(),
+            fully_parsed=matchlib.is_fully_parsed(match),
+            match=match,
+        )
+        path = self.path_for(match_id)
+        shard_dir = os.path.dirname(path)
+        os.makedirs(shard_dir, exist_ok=True)
+
+        # Write to a temp file in the same directory and rename over the
+        # target so readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=shard_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as raw, gzip.GzipFile(fileobj=raw, mode="wb") as f:
+                f.write(json.dumps(entry).encode())
+            try:
+                replaced_size = os.path.getsize(path)
+            except FileNotFoundError:
+                replaced_size = 0
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+        self.stats["writes"] += 1
+        if self.max_bytes is None:
+            # Unbounded, eg. an archive; never scan or evict
+            return
+        with self._lock:
+            if self._size is None:
+                self._size = self._scan_size()
+            else:
+                self._size += os.path.getsize(path) - replaced_size
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _entries(self):
+        for root, _, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                if not filename.endswith(".json.gz"):
+                    continue
+                path = os.path.join(root, filename)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, st.st_size, st.st_mtime
+
+    def _scan_size(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict(self):
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        size = sum(size for _, size, _ in entries)
+        target = self.max_bytes * EVICT_TO_FRACTION
+        for path, entry_size, _ in entries:
+            if size <= target:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+            self.stats["evictions"] += 1
+        self._size = size
+
+
+_cache = None
+
+
+def configure_cache(**cache_kwargs):
+    global _cache
+    _cache = MatchCache(**cache_kwargs)
+    return _cache
+
+
+def get_cache():
+    if _cache is None:
+        return configure_cache()
+    return _cache
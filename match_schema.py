@@ -0,0 +1,144 @@
+"""The slim match document zeus stores in place of the raw OpenDota payload.
+
+OpenDota matches carry chat, cosmetics, per-second logs, teamfights and
+more that nothing here reads; a parsed match is ~250kB of which the raters,
+views and match_stats use a small fraction. Documents are slimmed on write
+to MATCH_FIELDS and PLAYER_FIELDS and tagged with SCHEMA_VERSION. The full
+payload can optionally be kept in a gzipped on-disk archive.
+
+Bump SCHEMA_VERSION when the field lists change; slim_stored_matches()
+rewrites documents stored under an older version (or none) in the background.
+"""
+
+import argparse
+import json
+
+import couchdb
+import match_cache
+
+SCHEMA_VERSION = 1
+
+MATCH_FIELDS = (
+    "_id",
+    "_rev",
+    "match_id",
+    "start_time",
+    "duration",
+    "radiant_win",
+    "game_mode",
+    "lobby_type",
+    "patch",
+    "version",
+    "radiant_gold_adv",
+    "radiant_xp_adv",
+    "objectives",
+    "picks_bans",
+)
+
+PLAYER_FIELDS = (
+    "account_id",
+    "hero_id",
+    "player_slot",
+    "rank_tier",
+    "lane_role",
+    "kills",
+    "deaths",
+    "assists",
+    "last_hits",
+    "gold_per_min",
+    "xp_per_min",
+    "times",
+    "purchase_log",
+    "ability_upgrades_arr",
+)
+
+DEFAULT_ARCHIVE_DIR = "match_archive"
+
+_archive = None
+
+
+def configure_archive(archive_dir=DEFAULT_ARCHIVE_DIR):
+    """Keep a gzipped copy of every full payload prepare_match() slims.
+    Pass archive_dir=None to stop archiving."""
+    global _archive
+    if archive_dir is None:
+        _archive = None
+    else:
+        _archive = match_cache.MatchCache(
+            archive_dir, max_bytes=None, unparsed_ttl=float("inf")
+        )
+    return _archive
+
+
+def get_archive():
+    return _archive
+
+
+def slim_match(match, match_fields=MATCH_FIELDS, player_fields=PLAYER_FIELDS):
+    """A copy of match with only the listed fields, tagged with SCHEMA_VERSION"""
+    slim = {field: match[field] for field in match_fields if field in match}
+    if "players" in match:
+        slim["players"] = [
+            {field: player[field] for field in player_fields if field in player}
+            for player in match["players"]
+        ]
+    slim["schema_version"] = SCHEMA_VERSION
+    return slim
+
+
+def prepare_match(match):
+    """The write-time transform: archive the full payload if configured,
+    then return the slim document to store"""
+    if _archive is not None:
+        _archive.put(match["match_id"], match)
+    return slim_match(match)
+
+
+def needs_slimming(doc):
+    return doc.get("schema_version", 0) < SCHEMA_VERSION and "match_id" in doc
+
+
+def slim_stored_matches(db, batch_size=100):
+    """Rewrite every stored match older than SCHEMA_VERSION in its slim form.
+
+    Walks _all_docs by id, which stays stable while documents are rewritten,
+    and writes each batch back with _bulk_docs. Safe to stop and re-run.
+    """
+    writer = couchdb.BulkMatchWriter(db, max_docs=batch_size, transform=prepare_match)
+    counts = dict(checked=0, slimmed=0)
+    params = dict(include_docs="true", limit=batch_size + 1)
+    while True:
+        resp = db.r_session.get(f"{db.database_url}/_all_docs", params=params)
+        resp.raise_for_status()
+        rows = resp.json()["rows"]
+        for row in rows[:batch_size]:
+            counts["checked"] += 1
+            if row.get("doc") and needs_slimming(row["doc"]):
+                writer.add(row["doc"])
+                counts["slimmed"] += 1
+        if len(rows) <= batch_size:
+            break
+        params["startkey"] = json.dumps(rows[-1]["id"])
+        print(f"Checked {counts['checked']} docs, slimmed {counts['slimmed']}")
+    writer.flush()
+    counts["write_errors"] = writer.stats["errors"]
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--slim-stored",
+        action="store_true",
+        help="Slim matches stored under an older schema",
+    )
+    parser.add_argument(
+        "--archive-dir", type=str, default="", help="Archive full payloads here first"
+    )
+    parser.add_argument("--batch-size", type=int, default=100)
+    args = parser.parse_args()
+
+    if args.archive_dir:
+        configure_archive(args.archive_dir)
+    if args.slim_stored:
+        print(slim_stored_matches(couchdb.get_matches_db(), args.batch_size))
@@ -1,49 +1,137 @@
 import argparse
+import asyncio
 import datetime
 import pprint
 
 import dateparser
 
 import couchdb
+import match_schema
 import matchlib
 import opendota
+import opendota_async
 import parse_requester
+import rate_limiter
 import redis_queue
 
+# Unparsed matches are queued for parsing in batches of this many
+PARSE_REQUEST_BATCH_SIZE = 50
+
+
+def filter_new_match_ids(db, redis_client, match_ids, stats=None):
+    """Claim match_ids in the seen set and drop any already stored, or already
+    claimed by another scrape. Ids that are stored stay claimed, so the next
+    page doesn't look them up again."""
+    claimed = redis_queue.claim_match_ids(redis_client, match_ids)
+    try:
+        stored = couchdb.existing_match_ids(db, claimed)
+    except BaseException:
+        redis_queue.forget_match_ids(redis_client, claimed)
+        raise
+    new_ids = [match_id for match_id in claimed if str(match_id) not in stored]
+    if stats is not None:
+        stats["already_claimed"] += len(match_ids) - len(claimed)
+        stats["already_stored"] += len(claimed) - len(new_ids)
+    return new_ids
+
+
+def new_match_ids(db, redis_client, pages, stats, pending):
+    """Yield the new match ids on each page, adding them to pending until the
+    caller has stored or queued them"""
+    for rows in pages:
+        match_ids = [row["match_id"] for row in rows]
+        new_ids = filter_new_match_ids(db, redis_client, match_ids, stats)
+        stats["total_matches"] += len(match_ids)
+        pending.update(new_ids)
+        yield from new_ids
+
+
+def populate_matches_from_start_time(
+    start_time, num_matches=1000, concurrency=opendota_async.DEFAULT_CONCURRENCY
+):
+    opendota_async.size_session_for(concurrency)
+    return asyncio.run(
+        _populate_matches_from_start_time(start_time, num_matches, concurrency)
+    )
+
+
+async def _populate_matches_from_start_time(start_time, num_matches, concurrency):
+    loop = asyncio.get_running_loop()
+
+    def blocking(func, *args):
+        # CouchDB writes and parse requests, kept off the event loop so they
+        # don't stall the fetches in flight
+        return loop.run_in_executor(None, func, *args)
 
-def populate_matches_from_start_time(start_time, num_matches=1000):
     matches_db = couchdb.get_matches_db()
     redis_client = redis_queue.make_redis_client()
+    rate_limiter.install(redis_client)
+    opendota.RETRY_POLICY.breaker.share(redis_client)
     stats = dict(
         total_matches=0,
         fully_parsed_stored=0,
         parse_requested=0,
         already_stored=0,
+        already_claimed=0,
+        fetch_failed=0,
         highwater_mark=datetime.datetime.fromtimestamp(start_time),
     )
-    for match_info in matchlib.iterate_matches(start_time, limit=num_matches):
-        match_data = opendota.get_match_by_id(match_info["match_id"])
-        stats["total_matches"] += 1
-
-        if str(match_data["match_id"]) in matches_db:
-            stats["already_stored"] += 1
-            continue
-
-        stats["highwater_mark"] = datetime.datetime.fromtimestamp(
-            match_data["start_time"]
-        )
+    writer = couchdb.BulkMatchWriter(matches_db, transform=match_schema.prepare_match)
+    client = opendota_async.AsyncOpenDota(concurrency)
+    # Claimed ids not yet stored or queued, released if the scrape fails
+    pending = set()
+    match_ids = new_match_ids(
+        matches_db,
+        redis_client,
+        matchlib.iterate_match_pages(start_time, limit=num_matches),
+        stats,
+        pending,
+    )
+    unparsed = []
+    try:
+        async for result in client.fetch_matches(match_ids):
+            if result.error is not None:
+                print(f"Skipping {result.match_id}: {result.error}")
+                stats["fetch_failed"] += 1
+                redis_queue.forget_match_ids(redis_client, [result.match_id])
+                pending.discard(result.match_id)
+                continue
+            match_data = result.match
 
-        if matchlib.is_fully_parsed(match_data):
-            couchdb.store_match_to_db(matches_db, match_data)
-            stats["fully_parsed_stored"] += 1
-        else:
-            parse_requester.request_parse_for_match(
-                match_data,
-                redis_client,
-                delay=60,
+            stats["highwater_mark"] = max(
+                stats["highwater_mark"],
+                datetime.datetime.fromtimestamp(match_data["start_time"]),
             )
-            stats["parse_requested"] += 1
 
+            if matchlib.is_fully_parsed(match_data):
+                await blocking(writer.add, match_data)
+            else:
+                unparsed.append(match_data)
+                if len(unparsed) >= PARSE_REQUEST_BATCH_SIZE:
+                    stats["parse_requested"] += len(
+                        await blocking(parse_requester.request_parses, unparsed, redis_client)
+                    )
+                    pending.difference_update(match["match_id"] for match in unparsed)
+                    unparsed = []
+
+        stats["parse_requested"] += len(
+            await blocking(parse_requester.request_parses, unparsed, redis_client)
+        )
+        await blocking(writer.flush)
+        # Everything left is stored, bar the write errors released below
+        pending.clear()
+    finally:
+        try:
+            # Keep what was fetched even if the scrape failed part way
+            await blocking(writer.flush)
+        finally:
+            redis_queue.forget_match_ids(redis_client, list(pending))
+            client.close()
+    redis_queue.forget_match_ids(redis_client, [int(error["id"]) for error in writer.errors])
+    stats["fully_parsed_stored"] = writer.stats["stored"]
+    stats["already_stored"] += writer.stats["already_stored"]
+    stats["store_failed"] = writer.stats["errors"]
+    stats["opendota"] = opendota.client_stats()
     return stats
 
 
@@ -53,23 +141,28 @@ if __name__ == "__main__":
     parser.add_argument("--use-highwater-db-time", action="store_true")
     parser.add_argument("--check-highwater-db-time", action="store_true")
     parser.add_argument("--num-matches", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=opendota_async.DEFAULT_CONCURRENCY)
+    parser.add_argument("--archive-dir", type=str, default="", help="Keep full payloads here")
     args = parser.parse_args()
+    if args.archive_dir:
+        match_schema.configure_archive(args.archive_dir)
 
     start_time = dateparser.parse(args.start).timestamp()
     with couchdb.dbcontext() as db:
         highwater_start_time = couchdb.get_last_match_by_start_time(db)["start_time"]
 
-    if args.check_highwater_db_time:
-        print(datetime.datetime.fromtimestamp(highwater_start_time))
-        exit(0)
+        if args.check_highwater_db_time:
+            print(datetime.datetime.fromtimestamp(highwater_start_time))
+            exit(0)
 
-    if args.use_highwater_db_time:
-        start_time = highwater_start_time
+        if args.use_highwater_db_time:
+            start_time = highwater_start_time
 
-    print(f'Fetching {args.num_matches} matches from time {datetime.datetime.fromtimestamp(start_time)}')
+        print(f'Fetching {args.num_matches} matches from time {datetime.datetime.fromtimestamp(start_time)}')
 
-    stats = populate_matches_from_start_time(
-        start_time,
-        num_matches=args.num_matches,
-    )
+        stats = populate_matches_from_start_time(
+            start_time,
+            num_matches=args.num_matches,
+            concurrency=args.concurrency,
+        )
     pprint.pprint(stats)
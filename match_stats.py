@@ -0,0 +1,320 @@
+"""Rater aggregates kept up to date from the zeus_matches _changes feed.
+
+Following the feed from a checkpointed last_seq, every new match is folded
+into per-hero win/game counts, per-hero item counts after winmore pruning,
+per-hero talent counts and per tower configuration gpm/xpm slope sums. The
+aggregates and the last_seq they cover are saved together in one _local
+document, so a crash between batches replays nothing twice.
+
+Each match is folded once, the first time the feed shows a fully parsed
+revision of it: a later revision is a rewrite of a match already counted,
+such as match_schema slimming it. The feed coalesces revisions, so a new
+match can first show up at any revision, which is why the ids folded are
+kept rather than going by revision numbers.
+
+Bump STATS_VERSION whenever the folding or pruning changes; stats saved
+under another version, or with item components other than the current
+items table's, are rebuilt from seq 0.
+"""
+
+import argparse
+import hashlib
+import json
+import time
+
+import constants_store
+import couchdb
+import matchlib
+
+STATS_VERSION = 3
+STATS_DOC_ID = "_local/zeus_match_stats"
+DEFAULT_BATCH_SIZE = 500
+# Seconds a caught-up longpoll waits for new changes before returning empty
+POLL_TIMEOUT = 60
+
+
+def _tower_configuration_key(configuration):
+    return "".join(str(towers) for towers in configuration)
+
+
+def components_hash(components):
+    """Digest of an {item_key: component keys} table, saved with the stats"""
+    if components is None:
+        return None
+    return hashlib.sha1(json.dumps(components, sort_keys=True).encode()).hexdigest()
+
+
+class MatchStats:
+    """Aggregates over every match folded in so far.
+
+    Keys are ints (hero, ability ids, levels) and tuples (tower
+    configurations) in memory; to_doc() stringifies them for JSON.
+    """
+
+    def __init__(
+        self,
+        last_seq="0",
+        advantage_threshold=matchlib.MAX_GPM_ADV,
+        item_components=None,
+    ):
+        self.last_seq = last_seq
+        self.advantage_threshold = advantage_threshold
+        # {item_key: component keys}, by default from the constants_store
+        # items table the first time a match is folded
+        self.item_components = item_components
+        self.matches = 0
+        # Ids of the matches folded in, so rewrites aren't counted again
+        self.match_ids = set()
+        # {hero_id: [wins, games]}
+        self.heroes = {}
+        # {hero_id: {item_key: [wins, games]}}
+        self.items = {}
+        # {hero_id: {ability_id: {level_taken: [wins, games]}}}
+        self.talents = {}
+        # {tower configuration: [gpm slope sum, xpm slope sum, samples]}
+        self.towers = {}
+        self._rev = None
+
+    def fold_match(self, match):
+        """Add one match document. Returns False if it wasn't fully parsed
+        or was already folded in."""
+        if not matchlib.is_fully_parsed(match) or match["match_id"] in self.match_ids:
+            return False
+        record = matchlib.MatchRecord(match)
+        self.matches += 1
+        self.match_ids.add(match["match_id"])
+        if self.item_components is None:
+            self.item_components = matchlib.item_components(
+                constants_store.get_table("items")
+            )
+
+        for player, purchase_keys in zip(
+            record.players, record.pruned_purchase_keys(self.advantage_threshold)
+        ):
+            won = int(player.player_won)
+            hero = self.heroes.setdefault(player.hero_id, [0, 0])
+            hero[0] += won
+            hero[1] += 1
+
+            hero_items = self.items.setdefault(player.hero_id, {})
+            for purchase_key in matchlib.counted_item_keys(
+                purchase_keys, self.item_components
+            ):
+                item = hero_items.setdefault(purchase_key, [0, 0])
+                item[0] += won
+                item[1] += 1
+
+            if player.ability_upgrades is None:
+                continue
+            hero_talents = self.talents.setdefault(player.hero_id, {})
+            for i, ability_id in enumerate(player.ability_upgrades):
+                talent = hero_talents.setdefault(ability_id, {}).setdefault(
+                    i + 1, [0, 0]
+                )
+                talent[0] += won
+                talent[1] += 1
+
+        if len(record.gold_adv_per_min):
+            for (
+                configuration,
+                gpm_slope,
+                xpm_slope,
+            ) in matchlib.tower_configuration_slopes(record):
+                tower = self.towers.setdefault(configuration, [0.0, 0.0, 0])
+                tower[0] += gpm_slope
+                tower[1] += xpm_slope
+                tower[2] += 1
+        return True
+
+    def hero_counts(self, hero_id=None):
+        """{hero_id: (wins, games)}, same shape as couch_views.hero_counts"""
+        return {
+            some_hero_id: tuple(counts)
+            for some_hero_id, counts in self.heroes.items()
+            if hero_id is None or some_hero_id == hero_id
+        }
+
+    def hero_item_counts(self, hero_id=None):
+        """{hero_id: {item_key: (wins, games)}}"""
+        return {
+            some_hero_id: {key: tuple(counts) for key, counts in items.items()}
+            for some_hero_id, items in self.items.items()
+            if hero_id is None or some_hero_id == hero_id
+        }
+
+    def hero_talent_counts(self, hero_id):
+        """{ability_id: {level_taken: (wins, games)}} for one hero"""
+        return {
+            ability_id: {level: tuple(counts) for level, counts in levels.items()}
+            for ability_id, levels in self.talents.get(hero_id, {}).items()
+        }
+
+    def tower_configuration_averages(self):
+        """Same shape as objective_rater.calculate_average_gpm_for_tower_configs"""
+        return {
+            configuration: (gpm_sum / samples, xpm_sum / samples, samples)
+            for configuration, (gpm_sum, xpm_sum, samples) in self.towers.items()
+        }
+
+    def to_doc(self):
+        doc = {
+            "_id": STATS_DOC_ID,
+            "version": STATS_VERSION,
+            "advantage_threshold": self.advantage_threshold,
+            "last_seq": self.last_seq,
+            "item_components_hash": components_hash(self.item_components),
+            "matches": self.matches,
+            "match_ids": sorted(self.match_ids),
+            "heroes": {str(hero_id): counts for hero_id, counts in self.heroes.items()},
+            "items": {str(hero_id): items for hero_id, items in self.items.items()},
+            "talents": {
+                str(hero_id): {
+                    str(ability_id): {
+                        str(level): counts for level, counts in levels.items()
+                    }
+                    for ability_id, levels in talents.items()
+                }
+                for hero_id, talents in self.talents.items()
+            },
+            "towers": {
+                _tower_configuration_key(configuration): sums
+                for configuration, sums in self.towers.items()
+            },
+        }
+        if self._rev is not None:
+            doc["_rev"] = self._rev
+        return doc
+
+    @classmethod
+    def from_doc(cls, doc):
+        stats = cls(doc["last_seq"], doc["advantage_threshold"])
+        stats.matches = doc["matches"]
+        stats.match_ids = set(doc["match_ids"])
+        stats.heroes = {
+            int(hero_id): counts for hero_id, counts in doc["heroes"].items()
+        }
+        stats.items = {int(hero_id): items for hero_id, items in doc["items"].items()}
+        stats.talents = {
+            int(hero_id): {
+                int(ability_id): {
+                    int(level): counts for level, counts in levels.items()
+                }
+                for ability_id, levels in talents.items()
+            }
+            for hero_id, talents in doc["talents"].items()
+        }
+        stats.towers = {
+            tuple(int(towers) for towers in key): sums
+            for key, sums in doc["towers"].items()
+        }
+        stats._rev = doc.get("_rev")
+        return stats
+
+
+def _stats_doc_url(db):
+    return f"{db.database_url}/{STATS_DOC_ID}"
+
+
+def load_stats(db):
+    """The saved MatchStats, or empty stats from seq 0 if there are none or
+    they were built by a different STATS_VERSION, pruning threshold or
+    items table"""
+    resp = db.r_session.get(_stats_doc_url(db))
+    if resp.status_code == 404:
+        return MatchStats()
+    resp.raise_for_status()
+    doc = resp.json()
+    saved_components_hash = doc.get("item_components_hash")
+    if (
+        doc.get("version") != STATS_VERSION
+        or doc.get("advantage_threshold") != matchlib.MAX_GPM_ADV
+        or (
+            saved_components_hash is not None
+            and saved_components_hash
+            != components_hash(
+                matchlib.item_components(constants_store.get_table("items"))
+            )
+        )
+    ):
+        print("Saved match stats are stale, they need a rebuild")
+        return reset_stats(doc["_rev"])
+    return MatchStats.from_doc(doc)
+
+
+def reset_stats(rev=None):
+    """Empty stats from seq 0 that will overwrite the saved revision rev"""
+    stats = MatchStats()
+    stats._rev = rev
+    return stats
+
+
+def save_stats(db, stats):
+    resp = db.r_session.put(
+        _stats_doc_url(db),
+        data=json.dumps(stats.to_doc()),
+        headers={"Content-Type": "application/json"},
+    )
+    resp.raise_for_status()
+    stats._rev = resp.json()["rev"]
+
+
+def read_changes(db, since, limit=DEFAULT_BATCH_SIZE, poll_timeout=None):
+    """One page of the _changes feed with docs: (results, last_seq). With
+    poll_timeout, waits up to that many seconds for a change to arrive."""
+    params = dict(since=since, limit=limit, include_docs="true")
+    if poll_timeout is not None:
+        params.update(feed="longpoll", timeout=int(poll_timeout * 1000))
+    resp = db.r_session.get(f"{db.database_url}/_changes", params=params)
+    resp.raise_for_status()
+    body = resp.json()
+    return body["results"], body["last_seq"]
+
+
+def update_stats(
+    db, stats, batch_size=DEFAULT_BATCH_SIZE, follow=False, poll_timeout=POLL_TIMEOUT
+):
+    """Fold changes since stats.last_seq into stats, checkpointing after each
+    batch. Returns once caught up, or never with follow=True."""
+    counts = dict(batches=0, folded=0, skipped=0)
+    while True:
+        results, last_seq = read_changes(
+            db, stats.last_seq, batch_size, poll_timeout if follow else None
+        )
+        for change in results:
+            doc = change.get("doc")
+            if (
+                change.get("deleted")
+                or doc is None
+                or change["id"].startswith("_design/")
+            ):
+                counts["skipped"] += 1
+            elif stats.fold_match(doc):
+                counts["folded"] += 1
+            else:
+                counts["skipped"] += 1
+
+        if results or last_seq != stats.last_seq:
+            stats.last_seq = last_seq
+            save_stats(db, stats)
+            counts["batches"] += 1
+        if results:
+            print(f"Folded {counts['folded']} matches, {stats.matches} total")
+        if not follow and len(results) < batch_size:
+            return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--follow", action="store_true", help="Keep following the feed")
+    parser.add_argument("--rebuild", action="store_true", help="Start over from seq 0")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    args = parser.parse_args()
+
+    with couchdb.dbcontext() as db:
+        stats = load_stats(db)
+        if args.rebuild:
+            stats = reset_stats(stats._rev)
+
+        start = time.monotonic()
+        counts = update_stats(db, stats, args.batch_size, follow=args.follow)
+    print(f"{counts} in {time.monotonic() - start:.1f}s, now at seq {stats.last_seq}")
@@ -1,6 +1,14 @@
+import array
+import collections
+import concurrent.futures
+import itertools
+import math
+import sys
 from string import Template
 
 import dateparser
+import more_itertools
+import numpy as np
 
 import opendota
 
@@ -8,8 +16,7 @@ comeback_match_id = 6084764514
 stomp_match_id = 6081301206
 MAX_GPM_ADV = 500
 DEFAULT_QUERY_PAGE_SIZE = 100
-
-HEROES = opendota.load_hero_list()
+MAX_QUERY_PAGE_SIZE = 1000
 
 towers_we_care_about = {
     "npc_dota_goodguys_tower1_bot": 0,
@@ -63,54 +70,81 @@ def extract_item_purchases_from_player_data(player_data):
     )
 
 
+def advantage_per_min(radiant_advantage):
+    """Radiant gold/xp advantage at each minute divided by the minute, ie. the
+    average advantage gained per minute so far"""
+    advantage = np.asarray(radiant_advantage, dtype=float)
+    return advantage / np.maximum(np.arange(len(advantage)), 1)
+
+
+def minute_buckets(times, purchase_times):
+    """Index into times of the last minute mark before each purchase time.
+    Purchases before the horn map to minute 0, purchases in the final minute
+    to the last mark."""
+    idx = np.searchsorted(times, purchase_times, side="left") - 1
+    return np.clip(idx, 0, len(times) - 1)
+
+
+def winmore_keep_mask(
+    times, gold_adv_per_min, purchase_times, counts, is_radiant, player_won,
+    advantage_threshold=MAX_GPM_ADV,
+):
+    """Boolean array over the concatenated purchase_times of several players
+    (counts[i] purchases for player i), False where a purchase was winmore
+    or losemore."""
+    buckets = minute_buckets(times, purchase_times)
+    # A player's bucket never moves backwards even if their log isn't sorted.
+    # Offsetting each player by len(times) keeps the running max per player.
+    offsets = np.repeat(np.arange(len(counts)) * len(times), counts)
+    buckets = np.maximum.accumulate(buckets + offsets) - offsets
+
+    sign = np.repeat([1 if radiant else -1 for radiant in is_radiant], counts)
+    player_won = np.repeat(np.array([bool(won) for won in player_won], dtype=bool), counts)
+    gold_advantage_at_that_time = sign * gold_adv_per_min[buckets]
+
+    # TODO: Maybe also prune by benchmark key
+    # TODO: Make pruner a strategy somehow
+    winmore = player_won & (gold_advantage_at_that_time >= advantage_threshold)
+    losemore = ~player_won & (gold_advantage_at_that_time < -advantage_threshold)
+    return ~((times[buckets] > 600) & (winmore | losemore))
+
+
 def prune_winmore_purchases(
     full_match_data, item_purchases, advantage_threshold=MAX_GPM_ADV
 ):
     # Pretty sure this is just [i * 60 for i in range(<duration>)]
-    times = full_match_data["players"][0]["times"]
-
-    gold_adv_per_min = []
-    for i, radiant_adv in enumerate(full_match_data["radiant_gold_adv"]):
-        if i == 0:
-            gold_adv_per_min.append(radiant_adv / 1)
-        else:
-            gold_adv_per_min.append(radiant_adv / i)
-
-    for item_purchase_data in item_purchases:
-        pruned_purchase_log = []
-        current_time_idx = 0
-        for item_purchase in item_purchase_data["purchases"]:
-            item_purchase_time = item_purchase["time"]
-            # Advance current time to just before the item is purchased
-            try:
-                while item_purchase_time > times[current_time_idx + 1]:
-                    current_time_idx += 1
-            except IndexError:
-                # Item was purchased in last minute of game
-                assert times[current_time_idx] == times[-1]
-            gold_advantage_at_that_time = gold_adv_per_min[current_time_idx]
-            if not item_purchase_data["is_radiant"]:
-                gold_advantage_at_that_time *= -1
-            # TODO: Maybe also prune by benchmark key
-            # TODO: Make pruner a strategy somehow
-            if times[current_time_idx] > 600:
-                if bool(
-                    gold_advantage_at_that_time >= advantage_threshold
-                    and item_purchase_data["player_won"]
-                ):
-                    # print(
-                    #     f"Excluding {item_purchase} for {item_purchase_data['hero']['localized_name']} because of winmore"
-                    # )
-                    continue
-                if bool(
-                    gold_advantage_at_that_time < -advantage_threshold
-                    and not item_purchase_data["player_won"]
-                ):
-                    # print(f"Excluding {item_purchase} for {item_purchase_data['hero']['localized_name']} because of losemore")
-                    continue
-
-            pruned_purchase_log.append(item_purchase)
-        item_purchase_data["purchases"] = pruned_purchase_log
+    times = np.asarray(full_match_data["players"][0]["times"])
+    gold_adv_per_min = advantage_per_min(full_match_data["radiant_gold_adv"])
+
+    # Bucket every player's purchases in one pass over the concatenated logs
+    counts = [len(data["purchases"]) for data in item_purchases]
+    purchase_times = np.fromiter(
+        (
+            purchase["time"]
+            for data in item_purchases
+            for purchase in data["purchases"]
+        ),
+        dtype=float,
+        count=sum(counts),
+    )
+    keep = winmore_keep_mask(
+        times,
+        gold_adv_per_min,
+        purchase_times,
+        counts,
+        [data["is_radiant"] for data in item_purchases],
+        [data["player_won"] for data in item_purchases],
+        advantage_threshold,
+    )
+
+    start = 0
+    for item_purchase_data, count in zip(item_purchases, counts):
+        item_purchase_data["purchases"] = list(
+            itertools.compress(
+                item_purchase_data["purchases"], keep[start:start + count].tolist()
+            )
+        )
+        start += count
     return item_purchases
 
 
@@ -124,6 +158,163 @@ def parse_match(full_match_data):
     return revised_item_purchases
 
 
+class PlayerRecord:
+    """The parts of one player's match data the raters use"""
+
+    __slots__ = (
+        "hero_id",
+        "is_radiant",
+        "player_won",
+        "purchase_times",
+        "purchase_keys",
+        "ability_upgrades",
+    )
+
+    def __init__(self, player_data, radiant_win):
+        self.hero_id = player_data["hero_id"]
+        self.is_radiant = bool(player_data["player_slot"] < 127)
+        self.player_won = self.is_radiant == bool(radiant_win)
+
+        purchases = player_data.get("purchase_log") or []
+        self.purchase_times = array.array("i", [purchase["time"] for purchase in purchases])
+        self.purchase_keys = tuple(sys.intern(purchase["key"]) for purchase in purchases)
+
+        ability_upgrades = player_data.get("ability_upgrades_arr")
+        self.ability_upgrades = (
+            None if ability_upgrades is None else array.array("i", ability_upgrades)
+        )
+
+
+class MatchRecord:
+    """Compact, decoded-once view of an OpenDota match document.
+
+    Holds only what item_rater, talent_rater, objective_rater and
+    counterpicker read, with side/win flags and per-minute advantages
+    derived up front, so the full match dict can be dropped as soon as the
+    record is built.
+    """
+
+    __slots__ = (
+        "match_id",
+        "start_time",
+        "radiant_win",
+        "players",
+        "times",
+        "gold_adv_per_min",
+        "xp_adv_per_min",
+        "tower_kills",
+    )
+
+    def __init__(self, match_data):
+        self.match_id = match_data["match_id"]
+        self.start_time = match_data.get("start_time")
+        self.radiant_win = bool(match_data["radiant_win"])
+        self.players = tuple(
+            PlayerRecord(player, self.radiant_win) for player in match_data["players"]
+        )
+        self.times = np.asarray(match_data["players"][0].get("times") or [])
+        self.gold_adv_per_min = advantage_per_min(match_data.get("radiant_gold_adv") or [])
+        self.xp_adv_per_min = advantage_per_min(match_data.get("radiant_xp_adv") or [])
+        # (time, tower key) in the order the towers fell
+        self.tower_kills = tuple(
+            (objective["time"], objective["key"])
+            for objective in match_data.get("objectives") or []
+            if objective.get("key", "") in towers_we_care_about
+        )
+
+    def pruned_purchase_keys(self, advantage_threshold=MAX_GPM_ADV):
+        """Per player, the purchased item keys left after winmore pruning"""
+        counts = [len(player.purchase_times) for player in self.players]
+        purchase_times = np.concatenate(
+            [np.frombuffer(player.purchase_times, dtype=np.int32) for player in self.players]
+        )
+        keep = winmore_keep_mask(
+            self.times,
+            self.gold_adv_per_min,
+            purchase_times,
+            counts,
+            [player.is_radiant for player in self.players],
+            [player.player_won for player in self.players],
+            advantage_threshold,
+        ).tolist()
+
+        pruned = []
+        start = 0
+        for player, count in zip(self.players, counts):
+            pruned.append(
+                list(itertools.compress(player.purchase_keys, keep[start:start + count]))
+            )
+            start += count
+        return pruned
+
+
+def item_components(item_info):
+    """{item_key: component keys} for the items in a constants items table
+    that are built from others"""
+    return {key: item["components"] for key, item in item_info.items() if item.get("components")}
+
+
+def counted_item_keys(purchase_keys, components):
+    """The distinct keys one player's purchases count towards in item
+    winrates. A component the player built into another item they bought is
+    part of that item rather than a choice of its own, so isn't counted."""
+    keys = set(purchase_keys)
+    built = {component for key in keys for component in components.get(key, ())}
+    return keys - built
+
+
+def calculate_gpm_slope_from_times(
+    t1, t2, gpm_advantage_histogram, xpm_advantage_histogram
+):
+    idx1 = int(math.floor(t1 / 60))
+    idx2 = int(math.floor(t2 / 60))
+    if idx1 == idx2:
+        # If the tower state didn't exist for long, ignore the gpm during that
+        # tower state.
+        return None, None
+
+    return (
+        sum(gpm_advantage_histogram[idx1:idx2]) / (idx2 - idx1),
+        sum(xpm_advantage_histogram[idx1:idx2]) / (idx2 - idx1),
+    )
+
+
+def tower_configuration_slopes(record):
+    """Yield (tower configuration, gpm slope, xpm slope) for each tower state
+    of a matchlib.MatchRecord that lasted long enough to measure"""
+    # for each match, get the tower configurations with times
+    tower_configurations_with_times = []
+    match_tower_configuration = [3, 3, 3, 3, 3, 3]
+    tower_configurations_with_times.append((tuple(match_tower_configuration), 0))
+    for kill_time, tower_key in record.tower_kills:
+        match_tower_configuration[towers_we_care_about[tower_key]] -= 1
+        tower_configurations_with_times.append(
+            (tuple(match_tower_configuration), kill_time)
+        )
+
+    gold_adv_per_min = record.gold_adv_per_min.tolist()
+    xp_adv_per_min = record.xp_adv_per_min.tolist()
+
+    for conf1, conf2 in more_itertools.pairwise(tower_configurations_with_times):
+        gpm_slope, xpm_slope = calculate_gpm_slope_from_times(
+            conf1[1],
+            conf2[1],
+            gold_adv_per_min,
+            xp_adv_per_min,
+        )
+        if gpm_slope is None:
+            # We've been told that the configuration didn't last long enough
+            # to be relevant, ignore it
+            continue
+
+        yield tuple(conf1[0]), gpm_slope, xpm_slope
+
+
+def iterate_match_records(matches):
+    for match in matches:
+        yield MatchRecord(match)
+
+
 MATCHFINDER_QUERY = Template(
     """
 SELECT
@@ -136,30 +327,85 @@ FROM
 WHERE
     public_matches.avg_mmr > 4000
     AND public_matches.game_mode IN (1, 2, 3, 4, 5, 22)
-    AND public_matches.start_time > $start_time
-ORDER BY public_matches.start_time ASC
+    AND (public_matches.start_time, public_matches.match_id) > ($start_time, $match_id)
+ORDER BY public_matches.start_time ASC, public_matches.match_id ASC
 LIMIT $query_limit
 """
 )
 
+# Keyset position in the explorer's (start_time, match_id) ordering. Paging
+# resumes strictly after the cursor, so matches sharing a start_time are
+# neither skipped nor repeated across pages.
+MatchCursor = collections.namedtuple("MatchCursor", ["start_time", "match_id"])
+
+# Pairs with a start_time to mean "after every match starting at that second"
+_AFTER_ALL_MATCH_IDS = 2 ** 63 - 1
+
+
+def cursor_for(row):
+    """Cursor to pass as resume_from to continue after this explorer row"""
+    return MatchCursor(int(row["start_time"]), int(row["match_id"]))
+
+
+def _parse_start_time(date_string):
+    if isinstance(date_string, (int, float)):
+        return int(date_string)
+    return int(dateparser.parse(str(date_string)).timestamp())
+
+
+def _query_match_page(cursor, page_size):
+    query = MATCHFINDER_QUERY.substitute(
+        start_time=cursor.start_time,
+        match_id=cursor.match_id,
+        query_limit=page_size,
+    )
+    return opendota.query_explorer(query)["rows"]
+
+
+def iterate_matches(
+    date_string, limit=200, page_size=DEFAULT_QUERY_PAGE_SIZE, resume_from=None
+):
+    """Yield explorer rows for matches starting after date_string, oldest first.
+
+    The next page is requested in the background while the current one is
+    being consumed. Pass resume_from=cursor_for(last_row_seen) to continue
+    an interrupted backfill exactly where it stopped.
+    """
+    for rows in iterate_match_pages(date_string, limit, page_size, resume_from):
+        yield from rows
+
+
+def iterate_match_pages(
+    date_string, limit=200, page_size=DEFAULT_QUERY_PAGE_SIZE, resume_from=None
+):
+    """iterate_matches a page of rows at a time, for callers that batch their
+    own lookups per page. At most limit rows are yielded in total."""
+    page_size = min(page_size, MAX_QUERY_PAGE_SIZE)
+    if resume_from is not None:
+        cursor = MatchCursor(*resume_from)
+    else:
+        cursor = MatchCursor(_parse_start_time(date_string), _AFTER_ALL_MATCH_IDS)
 
-def iterate_matches(date_string, limit=200, page_size=DEFAULT_QUERY_PAGE_SIZE):
-    start = int(dateparser.parse(str(date_string)).timestamp())
     count = 0
-    while count < limit:
-        query = MATCHFINDER_QUERY.substitute(
-            start_time=start,
-            query_limit=page_size,
-        )
-        # TODO: Handle rate limit
-        result = opendota.query_explorer(query)
-        for row in result["rows"]:
-            yield row
-            count += 1
-            if count >= limit:
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    try:
+        next_page = executor.submit(_query_match_page, cursor, page_size)
+        while count < limit:
+            rows = next_page.result()
+            if not rows:
+                return
+            more_pages = len(rows) == page_size
+            rows = rows[:limit - count]
+            count += len(rows)
+            if more_pages and count < limit:
+                next_page = executor.submit(
+                    _query_match_page, cursor_for(rows[-1]), page_size
+                )
+            yield rows
+            if not more_pages:
                 return
-        time_of_last_match_in_query = result["rows"][-1]["start_time"]
-        start = int(dateparser.parse(str(time_of_last_match_in_query)).timestamp())
+    finally:
+        executor.shutdown(wait=False)
 
 
 def is_fully_parsed(match):
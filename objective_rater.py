@@ -1,13 +1,20 @@
-import math
+import argparse
 import pprint
-import sys
 
-import more_itertools
-
-from item_rater import calculate_item_winrates
 import couchdb
+import match_stats
 import matchlib
 
+# Match fields the tower configuration calculation reads
+QUERY_FIELDS = [
+    "match_id",
+    "radiant_win",
+    "players",
+    "objectives",
+    "radiant_gold_adv",
+    "radiant_xp_adv",
+]
+
 
 def is_valid_tower_configuration(tower_configuration):
     """Syntax arg checker for when we eventually wanna pass in tower configurations
@@ -15,76 +22,22 @@ def is_valid_tower_configuration(tower_configuration):
     pass
 
 
-def calculate_gpm_slope_from_times(
-    t1, t2, gpm_advantage_histogram, xpm_advantage_histogram
-):
-    idx1 = int(math.floor(t1 / 60))
-    idx2 = int(math.floor(t2 / 60))
-    if idx1 == idx2:
-        # If the tower state didn't exist for long, ignore the gpm during that
-        # tower state.
-        return None, None
-
-    return (
-        sum(gpm_advantage_histogram[idx1:idx2]) / (idx2 - idx1),
-        sum(xpm_advantage_histogram[idx1:idx2]) / (idx2 - idx1),
-    )
-
-
 def calculate_gpm_advantage_for_all_tower_configurations(db):
     """Calculate the GPM advantage for each tower configuration"""
 
-    matches = couchdb.get_all_parsed_matches_more_recent_than(db, 0)
+    matches = couchdb.get_all_parsed_matches_more_recent_than(
+        db, 0, fields=QUERY_FIELDS
+    )
 
     configuration_to_gpm_map = {}
 
-    for match in matches:
-        # for each match, get the tower configurations with times
-        tower_configurations_with_times = []
-        match_tower_configuration = [3, 3, 3, 3, 3, 3]
-        tower_configurations_with_times.append((tuple(match_tower_configuration), 0))
-        for objective in matchlib.extract_objectives_dict_from_match(match):
-            if objective.get("key", None) in matchlib.towers_we_care_about:
-                match_tower_configuration[
-                    matchlib.towers_we_care_about[objective["key"]]
-                ] -= 1
-                tower_configurations_with_times.append(
-                    (tuple(match_tower_configuration), objective["time"])
-                )
-
-        gold_adv_per_min = []
-        for i, radiant_adv in enumerate(match["radiant_gold_adv"]):
-            if i == 0:
-                gold_adv_per_min.append(radiant_adv / 1)
-            else:
-                gold_adv_per_min.append(radiant_adv / i)
-
-        xp_adv_per_min = []
-        for i, radiant_adv in enumerate(match["radiant_xp_adv"]):
-            if i == 0:
-                xp_adv_per_min.append(radiant_adv / 1)
-            else:
-                xp_adv_per_min.append(radiant_adv / i)
-
-        for conf1, conf2 in more_itertools.pairwise(tower_configurations_with_times):
-            gpm_slope, xpm_slope = calculate_gpm_slope_from_times(
-                conf1[1],
-                conf2[1],
-                gold_adv_per_min,
-                xp_adv_per_min,
-            )
-            if gpm_slope is None:
-                # We've been told that the configuration didn't last long enough
-                # to be relevant, ignore it
-                continue
-
-            key = tuple(conf1[0])
-
+    for record in matchlib.iterate_match_records(matches):
+        for key, gpm_slope, xpm_slope in matchlib.tower_configuration_slopes(record):
             configuration_to_gpm_map.setdefault(key, []).append(
                 (
                     gpm_slope,
                     xpm_slope,
-                    match["match_id"],
+                    record.match_id,
                 )
             )
 
@@ -112,12 +65,24 @@ def calculate_adjacent_states(current_state):
 
 
 if __name__ == "__main__":
-    db = couchdb.get_matches_db()
-    configuration_map = calculate_gpm_advantage_for_all_tower_configurations(db)
-    final_map = calculate_average_gpm_for_tower_configs(configuration_map)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("current_state", nargs="?", default="")
+    parser.add_argument(
+        "--use-stats",
+        action="store_true",
+        help="Read tower configuration sums materialized by match_stats",
+    )
+    args = parser.parse_args()
+
+    with couchdb.dbcontext() as db:
+        if args.use_stats:
+            final_map = match_stats.load_stats(db).tower_configuration_averages()
+        else:
+            configuration_map = calculate_gpm_advantage_for_all_tower_configurations(db)
+            final_map = calculate_average_gpm_for_tower_configs(configuration_map)
 
-    if len(sys.argv) == 2:
-        current_state_str = sys.argv[1]
+    if args.current_state:
+        current_state_str = args.current_state
         current_state = tuple([int(i) for i in current_state_str])
         print("")
         print(current_state, final_map[current_state])
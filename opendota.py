@@ -1,61 +1,130 @@
-import requests
 import json
 import json.decoder
 import secret
 import time
 import functools
 
+import hero_registry
+import match_cache
+import matchlib
+import rate_limiter
+import retry_policy
+from http_session import PooledSession
+
 
 API_ROOT = "https://api.opendota.com/api"
 
+RETRY_POLICY = retry_policy.RetryPolicy(
+    breaker=retry_policy.CircuitBreaker("opendota"),
+)
+# Tries at a GET whose 200 body wasn't valid JSON, each already retried by
+# RETRY_POLICY at the HTTP level
+JSON_RETRY_ATTEMPTS = 2
+
+_session = None
+
+
+def configure_session(**session_kwargs):
+    """Replace the shared session, eg. configure_session(pool_size=32)"""
+    global _session
+    if _session is not None:
+        _session.close()
+    _session = PooledSession(**session_kwargs)
+    return _session
+
+
+def get_session():
+    if _session is None:
+        return configure_session()
+    return _session
+
+
+def client_stats():
+    """Connection reuse, per endpoint retries and circuit breaker trips so far"""
+    return dict(
+        connections=get_session().connection_stats(),
+        retries=RETRY_POLICY.stats,
+        breaker_opened=RETRY_POLICY.breaker.times_opened,
+    )
+
+
+def _endpoint_class(path):
+    """Rate limit bucket for an API path, eg. /matches/123 -> matches"""
+    return path.split("/")[1]
+
+
+def _api_request(method, path, headers=None, **params):
+    endpoint = _endpoint_class(path)
+
+    def send():
+        rate_limiter.acquire("opendota", endpoint)
+        return get_session().request(
+            method,
+            f"{API_ROOT}{path}",
+            params=dict(api_key=secret.OPENDOTA_API_KEY, **params),
+            headers=headers,
+        )
+
+    return RETRY_POLICY.call(endpoint, send)
+
+
+def _api_get(path, headers=None, **params):
+    return _api_request("GET", path, headers=headers, **params)
+
+
+def _api_post(path, **params):
+    return _api_request("POST", path, **params)
+
 # get/find matches
 
 
 def opendota_retry(func):
+    """Retry a GET whose response body wasn't valid JSON.
+
+    HTTP level failures (429, 5xx, timeouts) are already retried by
+    RETRY_POLICY; this catches the odd truncated or HTML body on a 200.
+    Don't use it on POSTs: repeating one repeats its side effect, eg.
+    queueing a second parse job.
+    """
     @functools.wraps(func)
     def with_retry(*args, **kwargs):
-        for _ in range(3):
+        for attempt in range(JSON_RETRY_ATTEMPTS):
             try:
                 resp = func(*args, **kwargs)
                 return resp
-            except json.decoder.JSONDecodeError:
-                time.sleep(10)
+            except json.decoder.JSONDecodeError as e:
+                last_error = e
+                if attempt + 1 < JSON_RETRY_ATTEMPTS:
+                    time.sleep(RETRY_POLICY.backoff(attempt))
+        raise retry_policy.RetriesExhausted(func.__name__, JSON_RETRY_ATTEMPTS, last_error)
     return with_retry
 
 
-@opendota_retry
 def request_parse(match_id):
-    response = requests.post(
-        f"{API_ROOT}/request/{match_id}",
-        params=dict(api_key=secret.OPENDOTA_API_KEY),
-    )
+    response = _api_post(f"/request/{match_id}")
     return response.json()
 
 def check_job(job_id):
-    response = requests.get(
-        f"{API_ROOT}/request/{job_id}",
-        params=dict(api_key=secret.OPENDOTA_API_KEY),
-    )
+    response = _api_get(f"/request/{job_id}")
     return response
 
 def all_heroes():
-    return load_hero_list().values()
+    return list(hero_registry.get_hero_registry())
 
 
 def find_hero(heroname):
-    for hero in load_hero_list().values():
-        if hero["localized_name"] == heroname:
-            return hero
-    print("Didn't find the hero")
-    return
+    hero = hero_registry.get_hero_registry().by_name(heroname)
+    if hero is None:
+        print("Didn't find the hero")
+    return hero
 
 
 def find_hero_by_id(hero_id):
-    return load_hero_list().get(str(hero_id))
+    return hero_registry.get_hero_registry().by_id(hero_id)
 
 
 def find_hero_name_by_id(hero_id):
-    return load_hero_list().get(str(hero_id))["localized_name"]
+    return hero_registry.get_hero_registry().by_id(hero_id)["localized_name"]
 
 
 def get_hero_id(heroname):
@@ -63,109 +132,92 @@ def get_hero_id(heroname):
 
 
 def get_hero_list():
-    response = requests.get(
-        f"{API_ROOT}/heroes", params=dict(api_key=secret.OPENDOTA_API_KEY)
-    )
+    response = _api_get("/heroes")
     return response.json()
 
 
+def get_match_by_id(match_id, use_cache=True):
+    """Fetch a match, reading through the local match_cache.
+
+    Only fully parsed matches are cached; an unparsed one is re-fetched on
+    every call so a parse re-check sees it as soon as it finishes. Error
+    payloads (eg. {"error": "Not Found"}) are returned but not cached.
+    """
+    if use_cache:
+        match = match_cache.get_cache().get(match_id)
+        if match is not None:
+            return match
+
+    match = _fetch_match_by_id(match_id)
+    if use_cache and matchlib.is_fully_parsed(match):
+        match_cache.get_cache().put(match_id, match)
+    return match
+
+
 @opendota_retry
-def get_match_by_id(match_id):
-    response = requests.get(
-        f"{API_ROOT}/matches/{match_id}",
-        params=dict(api_key=secret.OPENDOTA_API_KEY),
-    )
+def _fetch_match_by_id(match_id):
+    response = _api_get(f"/matches/{match_id}")
     return response.json()
 
 
 def get_item_table():
-    response = requests.get(
-        f"{API_ROOT}/constants/items",
-        params=dict(
-            api_key=secret.OPENDOTA_API_KEY,
-        ),
-    )
+    response = _api_get("/constants/items")
     return response.json()
 
 
 @opendota_retry
 def get_heroes_table():
-    response = requests.get(
-        f"{API_ROOT}/constants/heroes",
-        params=dict(
-            api_key=secret.OPENDOTA_API_KEY,
-        ),
-    )
+    response = _api_get("/constants/heroes")
     return response.json()
 
 @opendota_retry
 def get_abilities():
-    response = requests.get(
-        f"{API_ROOT}/constants/abilities",
-        params=dict(
-            api_key=secret.OPENDOTA_API_KEY,
-        ),
-    )
+    response = _api_get("/constants/abilities")
     return response.json()
 
 @opendota_retry
 def get_ability_ids():
-    response = requests.get(
-        f"{API_ROOT}/constants/ability_ids",
-        params=dict(
-            api_key=secret.OPENDOTA_API_KEY,
-        ),
-    )
+    response = _api_get("/constants/ability_ids")
     return response.json()
 
+def get_constants(table, etag=None, last_modified=None):
+    """Conditional GET of a /constants table. Returns the raw response, which
+    is a 304 when the table matches etag/last_modified."""
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    return _api_get(f"/constants/{table}", headers=headers)
+
 @opendota_retry
 def get_matchups(hero_id):
-    response = requests.get(
-        f"{API_ROOT}/heroes/{hero_id}/matchups",
-        params=dict(
-            api_key=secret.OPENDOTA_API_KEY,
-        ),
-    )
+    response = _api_get(f"/heroes/{hero_id}/matchups")
     return response.json()
 
 
 @opendota_retry
 def query_explorer(query):
-    response = requests.get(
-        f"{API_ROOT}/explorer",
-        params=dict(
-            api_key=secret.OPENDOTA_API_KEY,
-            sql=query,
-        ),
-    )
+    response = _api_get("/explorer", sql=query)
     return response.json()
 
 
 @opendota_retry
 def parsed_matches(last_match_id=None):
-    params = dict(
-        api_key=secret.OPENDOTA_API_KEY,
-    )
+    params = dict()
     if last_match_id is not None:
         params["less_than_match_id"] = last_match_id
-    response = requests.get(
-        f"{API_ROOT}/parsedMatches",
-        params=params,
-    )
+    response = _api_get("/parsedMatches", **params)
     return response.json()
 
 
 def make_example_call():
-    response = requests.get(
-        f"{API_ROOT}/matches/5705824607",
-        params=dict(api_key=secret.OPENDOTA_API_KEY),
-    )
+    response = _api_get("/matches/5705824607")
     return response.json()
 
 
 def load_hero_list():
-    with open("hero_dict.json") as f:
-        return json.loads(f.read())
+    return hero_registry.get_hero_registry().as_dict()
 
 
 if __name__ == "__main__":
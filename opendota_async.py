@@ -0,0 +1,109 @@
+"""asyncio front end for opendota with a bounded number of requests in flight.
+
+Each call runs the regular blocking opendota function on a worker thread,
+so it goes through the same pooled session, rate limiter and retry policy as
+synchronous callers. Only the concurrency is new.
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import functools
+
+import opendota
+
+DEFAULT_CONCURRENCY = 16
+
+_EXHAUSTED = object()
+
+MatchFetchResult = collections.namedtuple(
+    "MatchFetchResult", ["match_id", "match", "error"]
+)
+
+
+def size_session_for(concurrency):
+    """Give opendota's shared session a connection per concurrent request.
+    Call at startup: replacing the session closes the old one, under any
+    thread still using it."""
+    if opendota.get_session().pool_size < concurrency:
+        opendota.configure_session(pool_size=concurrency)
+
+
+class AsyncOpenDota:
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY):
+        self.concurrency = concurrency
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+        self._semaphore = None
+
+    async def _call(self, func, *args, **kwargs):
+        if self._semaphore is None:
+            # Created lazily so it binds to the running loop
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                self._executor, functools.partial(func, *args, **kwargs)
+            )
+
+    async def get_match_by_id(self, match_id):
+        return await self._call(opendota.get_match_by_id, match_id)
+
+    async def request_parse(self, match_id):
+        return await self._call(opendota.request_parse, match_id)
+
+    async def query_explorer(self, query):
+        return await self._call(opendota.query_explorer, query)
+
+    async def _fetch_one(self, match_id):
+        try:
+            match = await self.get_match_by_id(match_id)
+        except Exception as e:
+            return MatchFetchResult(match_id, None, e)
+        return MatchFetchResult(match_id, match, None)
+
+    async def fetch_matches(self, match_ids):
+        """Yield a MatchFetchResult per match id, in completion order.
+
+        match_ids may be any iterable, including a lazy generator; at most
+        `concurrency` ids are pulled from it ahead of the results consumed.
+        Pulling runs off the event loop, so a generator that blocks (eg. on
+        the next page of ids) doesn't stall fetches in flight. A failed fetch
+        is yielded with its exception instead of raising.
+        """
+        loop = asyncio.get_running_loop()
+        match_ids = iter(match_ids)
+        in_flight = set()
+        exhausted = False
+        while True:
+            while not exhausted and len(in_flight) < self.concurrency:
+                match_id = await loop.run_in_executor(None, next, match_ids, _EXHAUSTED)
+                if match_id is _EXHAUSTED:
+                    exhausted = True
+                    break
+                in_flight.add(asyncio.ensure_future(self._fetch_one(match_id)))
+
+            if not in_flight:
+                return
+
+            done, in_flight = await asyncio.wait(
+                in_flight, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                yield task.result()
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+
+async def _collect(match_ids, concurrency):
+    client = AsyncOpenDota(concurrency)
+    try:
+        return [result async for result in client.fetch_matches(match_ids)]
+    finally:
+        client.close()
+
+
+def fetch_matches(match_ids, concurrency=DEFAULT_CONCURRENCY):
+    """Blocking helper: fetch all match_ids concurrently, in completion order"""
+    size_session_for(concurrency)
+    return asyncio.run(_collect(match_ids, concurrency))
@@ -1,67 +1,305 @@
 import argparse
-import datetime
-import json
+import math
+import multiprocessing
+import os
 import random
+import signal
 import time
 
 import couchdb
+import match_schema
 import matchlib
 import opendota
+import rate_limiter
 import redis_queue
+import retry_policy
 
+# Seconds a worker blocks waiting for the queue before checking on the
+# delayed items and its writer again
+POP_TIMEOUT = 1
+# BLMOVE treats 0 as "block forever"
+MIN_POP_TIMEOUT = 0.01
+REAP_INTERVAL = 30
+
+# A supervisor runs one worker per this many due matches, up to as many as
+# the OpenDota rate limit can keep busy, assuming an unthrottled worker makes
+# about WORKER_REQUEST_RATE requests a second
+MATCHES_PER_WORKER = 50
+WORKER_REQUEST_RATE = 2
+SUPERVISE_INTERVAL = 10
+# Seconds a stopping worker gets to store what it holds before it's killed
+WORKER_STOP_TIMEOUT = 60
+
+
+def request_parses(matches, redis_client, delay=None):
+    """Claim every match not already in flight, ask OpenDota to parse it and
+    queue them in one round trip, by default to be checked when most parses
+    have finished. Returns the match ids queued."""
+    if delay is None:
+        delay = redis_queue.recheck_delay(redis_client, 0, 0)
+    match_ids = list(dict.fromkeys(match["match_id"] for match in matches))
+    claimed = set(redis_queue.claim_in_flight(redis_client, match_ids))
+    entries = []
+    requested = set()
+    try:
+        for match in matches:
+            match_id = match["match_id"]
+            if match_id not in claimed or match_id in requested:
+                continue
+            print(f"Queueing {match_id} for parsing")
+            job_id = opendota.request_parse(match_id)["job"]["jobId"]
+            entries.append((match, job_id))
+            requested.add(match_id)
+    finally:
+        # Queue the parses already requested even if a later request failed,
+        # and let the rest be claimed again
+        redis_queue.finish_match_ids(redis_client, list(claimed - requested))
+        redis_queue.enqueue_unparsed_matches(redis_client, entries, delay=delay)
+    return [match["match_id"] for match, _ in entries]
 
-def request_parse_for_match(match, redis_client, delay=60):
-    match_id = match["match_id"]
-    print(f"Queueing {match_id} for parsing")
-    job_id = opendota.request_parse(match_id)["job"]["jobId"]
-    redis_queue.push_unparsed_match_to_queue(
-        redis_client,
-        match,
-        job_id,
-        delay=delay,
-    )
 
+def request_parse_for_match(match, redis_client, delay=None):
+    return bool(request_parses([match], redis_client, delay=delay))
 
-def request_parsing_for_unparsed_matches(unparsed_matches, delay=60):
+
+def request_parsing_for_unparsed_matches(unparsed_matches, delay=None):
     redis_client = redis_queue.make_redis_client()
-    for match in unparsed_matches:
-        request_parse_for_match(match, redis_client, delay=delay)
+    rate_limiter.install(redis_client)
+    return request_parses(list(unparsed_matches), redis_client, delay=delay)
 
 
-def process_unparsed_match_queue():
+def process_unparsed_match_queue(stop=None):
     redis_client = redis_queue.make_redis_client()
-    while True:
-        redis_queue.enqueue_delayed(redis_client)
-        match_payload = redis_queue.pop_match_json_from_queue(redis_client)
-        if match_payload is None:
-            print("Sleeping because pulled nothing")
-            time.sleep(10)
-            continue
-
-        print(match_payload)
-
-        if datetime.datetime.now() - datetime.datetime.fromtimestamp(
-            match_payload["last_checked_time"]
-        ) < datetime.timedelta(minutes=1):
-            redis_queue.requeue_payload(redis_client, match_payload)
-            continue
-
-        match_json = opendota.get_match_by_id(match_payload["match_id"])
-        if matchlib.is_fully_parsed(match_json):
-            couchdb.store_match_to_db(couchdb.get_matches_db(), match_json)
-        else:
-            queue_time = datetime.datetime.fromtimestamp(match_payload["queued_time"])
-            if datetime.datetime.now() - queue_time > datetime.timedelta(minutes=5):
+    rate_limiter.install(redis_client)
+    opendota.RETRY_POLICY.breaker.share(redis_client)
+    with couchdb.dbcontext() as db, couchdb.BulkMatchWriter(
+        db, max_docs=50, transform=match_schema.prepare_match
+    ) as writer:
+        try:
+            _process_unparsed_match_queue(redis_client, writer, stop)
+        finally:
+            print(f"Worker {os.getpid()} OpenDota client: {opendota.client_stats()}")
+
+
+def _ack_flushed(consumer, unflushed, flush_results):
+    """Ack the queue items of stored matches once the writer has flushed them.
+    Items whose write failed stay unacked, so they are redelivered once their
+    visibility timeout passes."""
+    if flush_results:
+        errors = {
+            result["id"]
+            for result in flush_results
+            if result.get("error") not in (None, "conflict")
+        }
+        stored = [
+            item for item in unflushed if str(item.payload["match_id"]) not in errors
+        ]
+        for item in stored:
+            consumer.ack(item)
+        redis_queue.finish_match_ids(
+            consumer.r, [item.payload["match_id"] for item in stored]
+        )
+        unflushed.clear()
+
+
+def _process_unparsed_match_queue(redis_client, writer, stop=None):
+    """Work the parse queue until stop (an Event) is set, then store and ack
+    what's in hand and hand back anything else"""
+    consumer = redis_queue.QueueConsumer(redis_client)
+    unflushed = []
+    last_reap = 0
+    try:
+        while stop is None or not stop.is_set():
+            _ack_flushed(consumer, unflushed, writer.flush_if_due())
+            _, next_due = redis_queue.promote_delayed(redis_client)
+            if time.monotonic() - last_reap > REAP_INTERVAL:
+                redis_queue.reap_expired(redis_client)
+                last_reap = time.monotonic()
+
+            # Wake up in time to promote the next delayed item
+            pop_timeout = POP_TIMEOUT
+            if next_due is not None:
+                pop_timeout = min(
+                    POP_TIMEOUT, max(MIN_POP_TIMEOUT, next_due - time.time())
+                )
+            item = consumer.pop(timeout=pop_timeout)
+            if item is None:
                 continue
-            if match_payload["num_retries"] > 4:
+            match_payload = item.payload
+
+            print(match_payload)
+
+            now = time.time()
+            since_last_check = now - match_payload["last_checked_time"]
+            if since_last_check < redis_queue.MIN_RECHECK_DELAY:
+                # Redelivered or pushed without a delay; put it back on the schedule
+                consumer.delay(item, redis_queue.MIN_RECHECK_DELAY - since_last_check)
+                continue
+
+            try:
+                # Never a cached copy from before the parse finished
+                match_json = opendota.get_match_by_id(
+                    match_payload["match_id"], use_cache=False
+                )
+            except retry_policy.RetriesExhausted as e:
+                print(f"Failed to fetch {match_payload['match_id']}, delaying: {e}")
+                match_json = {}
+
+            if matchlib.is_fully_parsed(match_json):
+                # It finished somewhere between the previous check and this one
+                finished_after = max(
+                    match_payload["last_checked_time"], match_payload["queued_time"]
+                )
+                redis_queue.record_parse_latency(
+                    redis_client,
+                    (finished_after + now) / 2 - match_payload["queued_time"],
+                )
+                redis_queue.record_outcome(
+                    redis_client, f"stored_on_check_{match_payload['num_retries'] + 1}"
+                )
+                unflushed.append(item)
+                _ack_flushed(consumer, unflushed, writer.add(match_json))
                 continue
-            redis_queue.delay_queue(
+
+            match_payload["num_retries"] += 1
+            match_payload["last_checked_time"] = now
+            delay = redis_queue.recheck_delay(
                 redis_client,
-                "zeus:parsed_queue",
-                json.dumps(match_payload),
-                delay=120,
+                match_payload["num_retries"],
+                now - match_payload["queued_time"],
+            )
+            if delay is None:
+                # Giving up; let a later scrape pick the match up again
+                redis_queue.record_expired(
+                    redis_client, now - match_payload["queued_time"]
+                )
+                redis_queue.forget_match_ids(redis_client, [match_payload["match_id"]])
+                redis_queue.finish_match_ids(redis_client, [match_payload["match_id"]])
+                consumer.ack(item)
+                continue
+            redis_queue.record_outcome(redis_client, "rechecked")
+            consumer.delay(item, delay, payload=match_payload)
+    finally:
+        try:
+            _ack_flushed(consumer, unflushed, writer.flush())
+        finally:
+            # Anything not acked goes straight back for another worker
+            consumer.release()
+
+
+class _WorkerStop:
+    """A worker's stop Event, also set by SIGTERM or SIGINT to the worker or
+    by its supervisor going away without setting it. The signal handler only
+    flips a flag: setting the Event from it could deadlock on the lock
+    is_set() holds."""
+
+    def __init__(self, stop):
+        self.stop = stop
+        self.signalled = False
+        self.supervisor_pid = os.getppid()
+        signal.signal(signal.SIGINT, self._handle_signal)
+        signal.signal(signal.SIGTERM, self._handle_signal)
+
+    def _handle_signal(self, signum, frame):
+        self.signalled = True
+
+    def is_set(self):
+        # Orphaned workers are reparented, eg. if the supervisor was killed
+        return (
+            self.signalled or os.getppid() != self.supervisor_pid or self.stop.is_set()
+        )
+
+
+def _run_worker(stop, archive_dir):
+    if archive_dir:
+        match_schema.configure_archive(archive_dir)
+    # Either way the worker finishes the match in hand first
+    process_unparsed_match_queue(_WorkerStop(stop))
+
+
+def queue_depth(redis_client):
+    """Matches waiting on the queue plus delayed ones already due"""
+    return redis_client.llen(redis_queue.QUEUE_NAME) + redis_client.zcount(
+        "delayed:", "-inf", time.time()
+    )
+
+
+def target_workers(depth, max_workers, limits=None):
+    limits = rate_limiter.RATE_LIMITS if limits is None else limits
+    rate, _ = limits[("opendota", None)]
+    budget = max(1, int(rate / WORKER_REQUEST_RATE))
+    return max(1, min(max_workers, budget, math.ceil(depth / MATCHES_PER_WORKER)))
+
+
+def _stored_count(queue_stats):
+    return sum(
+        count
+        for outcome, count in queue_stats.items()
+        if outcome.startswith("stored_on_check_")
+    )
+
+
+def supervise(max_workers, archive_dir="", interval=SUPERVISE_INTERVAL):
+    """Run between 1 and max_workers queue workers in their own processes,
+    scaled to the queue depth, until SIGTERM or ctrl-c. Workers drain what
+    they hold before exiting."""
+    redis_client = redis_queue.make_redis_client()
+    # Handle SIGTERM like ctrl-c
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    workers = []
+    started = time.monotonic()
+    initial = redis_queue.parse_queue_stats(redis_client)
+    previous = initial
+    try:
+        while True:
+            # Forget workers that exited (eg. crashed, their items get reaped)
+            # or were asked to stop, once they have
+            workers = [(worker, stop) for worker, stop in workers if worker.is_alive()]
+            running = [(worker, stop) for worker, stop in workers if not stop.is_set()]
+            depth = queue_depth(redis_client)
+            target = target_workers(depth, max_workers)
+            for _ in range(target - len(running)):
+                stop = multiprocessing.Event()
+                # Daemonic, so they don't outlive a supervisor that exits
+                worker = multiprocessing.Process(
+                    target=_run_worker, args=(stop, archive_dir), daemon=True
+                )
+                worker.start()
+                workers.append((worker, stop))
+            for _, stop in running[target:]:
+                stop.set()
+
+            queue_stats = redis_queue.parse_queue_stats(redis_client)
+            stored = _stored_count(queue_stats) - _stored_count(previous)
+            print(
+                f"{target} workers, {depth} due, stored {stored} in the last {interval}s "
+                f"({stored * 60 / interval:.1f}/min)"
             )
-            time.sleep(0.01)
+            previous = queue_stats
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(f"Stopping {len(workers)} workers")
+        for _, stop in workers:
+            stop.set()
+        deadline = time.monotonic() + WORKER_STOP_TIMEOUT
+        for worker, _ in workers:
+            worker.join(max(deadline - time.monotonic(), 0))
+            if worker.is_alive():
+                # What it held is redelivered once its visibility timeout passes
+                print(f"Worker {worker.pid} didn't stop in time, killing it")
+                worker.kill()
+                worker.join()
+        elapsed = max(time.monotonic() - started, 1)
+        final = redis_queue.parse_queue_stats(redis_client)
+        totals = {
+            outcome: count - initial.get(outcome, 0) for outcome, count in final.items()
+        }
+        stored = _stored_count(totals)
+        print(
+            f"Stored {stored} matches in {elapsed:.0f}s ({stored * 60 / elapsed:.1f}/min): {totals}"
+        )
 
 
 if __name__ == "__main__":
@@ -70,7 +308,30 @@ if __name__ == "__main__":
     parser.add_argument("--process-queue", action="store_true")
     parser.add_argument("--populate-queue", action="store_true")
     parser.add_argument("--max-matches-to-queue", type=int, default=5)
+    parser.add_argument(
+        "--archive-dir", type=str, default="", help="Keep full payloads here"
+    )
+    parser.add_argument("--queue-stats", action="store_true")
+    parser.add_argument(
+        "--max-workers",
+        type=int,
+        default=1,
+        help="Scale out to this many worker processes",
+    )
 
     args = parser.parse_args()
-    if args.process_queue:
+    if args.queue_stats:
+        redis_client = redis_queue.make_redis_client()
+        print(
+            f"Queued: {redis_client.llen(redis_queue.QUEUE_NAME)}, delayed: {redis_client.zcard('delayed:')}"
+        )
+        print(
+            f"Check at (seconds after queueing): {redis_queue.recheck_latencies(redis_client)}"
+        )
+        print(redis_queue.parse_queue_stats(redis_client))
+    if args.archive_dir:
+        match_schema.configure_archive(args.archive_dir)
+    if args.process_queue and args.max_workers > 1:
+        supervise(args.max_workers, args.archive_dir)
+    elif args.process_queue:
         process_unparsed_match_queue()
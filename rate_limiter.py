@@ -0,0 +1,161 @@
+import threading
+import time
+
+# (tokens per second, burst capacity) for each bucket. A call is charged
+# against both its API-wide bucket (endpoint None) and its endpoint class
+# bucket, if one is configured, so explorer queries can be throttled harder
+# than match fetches without letting the two together exceed the API quota.
+RATE_LIMITS = {
+    ("opendota", None): (20, 40),
+    ("opendota", "explorer"): (1, 3),
+    ("opendota", "request"): (5, 10),
+    ("opendota", "constants"): (1, 5),
+    ("stratz", None): (4, 20),
+}
+
+KEY_PREFIX = "zeus:ratelimit"
+
+# Refill every bucket in KEYS from the server clock, then take ARGV[1] tokens
+# from all of them or from none. ARGV[2 * i], ARGV[2 * i + 1] are the
+# (rate, capacity) of KEYS[i]. Returns {granted, ms until a retry could succeed}.
+_TOKEN_BUCKET_SCRIPT = """
+local requested = tonumber(ARGV[1])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local tokens = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[2 * i])
+    local capacity = tonumber(ARGV[2 * i + 1])
+    local bucket = redis.call('HMGET', key, 'tokens', 'ts')
+    local available = tonumber(bucket[1])
+    local ts = tonumber(bucket[2])
+    if available == nil then
+        available = capacity
+        ts = now
+    end
+    available = math.min(capacity, available + math.max(0, now - ts) * rate)
+    tokens[i] = available
+    if available < requested then
+        wait = math.max(wait, (requested - available) / rate)
+    end
+end
+local granted = 0
+if wait == 0 then
+    granted = 1
+end
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[2 * i])
+    local capacity = tonumber(ARGV[2 * i + 1])
+    local available = tokens[i]
+    if granted == 1 then
+        available = available - requested
+    end
+    redis.call('HSET', key, 'tokens', tostring(available), 'ts', tostring(now))
+    redis.call('PEXPIRE', key, math.ceil(capacity / rate * 1000) + 1000)
+end
+return {granted, math.ceil(wait * 1000)}
+"""
+
+
+class RateLimitTimeout(Exception):
+    pass
+
+
+def _bucket_names(api, endpoint, limits):
+    names = [(api, None)]
+    if endpoint is not None and (api, endpoint) in limits:
+        names.append((api, endpoint))
+    return names
+
+
+class RedisRateLimiter:
+    """Token buckets shared by every process talking to the same redis"""
+
+    def __init__(self, redis_client, limits=None, key_prefix=KEY_PREFIX):
+        self.redis_client = redis_client
+        self.limits = RATE_LIMITS if limits is None else limits
+        self.key_prefix = key_prefix
+        self._script = redis_client.register_script(_TOKEN_BUCKET_SCRIPT)
+
+    def _key(self, api, endpoint):
+        return f"{self.key_prefix}:{api}:{endpoint or '*'}"
+
+    def try_acquire(self, api, endpoint=None, tokens=1):
+        """Take tokens without blocking. Returns (granted, seconds_to_wait)"""
+        names = _bucket_names(api, endpoint, self.limits)
+        args = [tokens]
+        for name in names:
+            args.extend(self.limits[name])
+        granted, wait_ms = self._script(
+            keys=[self._key(*name) for name in names],
+            args=args,
+        )
+        return bool(granted), wait_ms / 1000
+
+
+class LocalRateLimiter:
+    """In-process token buckets, used when no redis limiter is installed"""
+
+    def __init__(self, limits=None):
+        self.limits = RATE_LIMITS if limits is None else limits
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def try_acquire(self, api, endpoint=None, tokens=1):
+        names = _bucket_names(api, endpoint, self.limits)
+        now = time.monotonic()
+        with self._lock:
+            available = {}
+            wait = 0
+            for name in names:
+                rate, capacity = self.limits[name]
+                bucket_tokens, ts = self._buckets.get(name, (capacity, now))
+                bucket_tokens = min(capacity, bucket_tokens + (now - ts) * rate)
+                available[name] = bucket_tokens
+                if bucket_tokens < tokens:
+                    wait = max(wait, (tokens - bucket_tokens) / rate)
+            for name, bucket_tokens in available.items():
+                if not wait:
+                    bucket_tokens -= tokens
+                self._buckets[name] = (bucket_tokens, now)
+        return not wait, wait
+
+
+def acquire(api, endpoint=None, tokens=1, block=True, timeout=None, limiter=None):
+    """Take tokens from the api's buckets.
+
+    With block=False this returns immediately with whether tokens were
+    granted. Otherwise it sleeps until they are, raising RateLimitTimeout if
+    that takes longer than timeout seconds.
+    """
+    if limiter is None:
+        limiter = get_limiter()
+    if api not in {name[0] for name in limiter.limits}:
+        return True
+
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        granted, wait = limiter.try_acquire(api, endpoint, tokens)
+        if granted or not block:
+            return granted
+        if deadline is not None and time.monotonic() + wait > deadline:
+            raise RateLimitTimeout(f"Timed out waiting for {api}:{endpoint} rate limit")
+        time.sleep(wait)
+
+
+_limiter = None
+
+
+def install(redis_client, limits=None):
+    """Share rate limits with every other process using this redis"""
+    global _limiter
+    _limiter = RedisRateLimiter(redis_client, limits=limits)
+    return _limiter
+
+
+def get_limiter():
+    global _limiter
+    if _limiter is None:
+        _limiter = LocalRateLimiter()
+    return _limiter
@@ -1,4 +1,7 @@
+import collections
 import contextlib
+import os
+import socket
 import time
 import redis
 import datetime
@@ -6,6 +9,36 @@ import json
 import uuid
 
 QUEUE_NAME = "zeus:parsed_queue"
+# Each consumer moves what it pops onto its own processing list until it
+# acks. The deadlines zset holds when each popped payload is redelivered if
+# it hasn't been acked by then.
+PROCESSING_PREFIX = "zeus:processing:"
+CONSUMERS = "zeus:consumers"
+DEADLINES = "zeus:processing_deadlines"
+VISIBILITY_TIMEOUT = 5 * 60
+# Set with a TTL of the visibility timeout while a consumer is alive; the
+# reaper forgets consumers with neither a heartbeat nor anything to redeliver
+HEARTBEAT_PREFIX = "zeus:consumer_heartbeat:"
+
+# Recent seconds from requesting a parse to the match being parsed, newest
+# first, and counts of what happened to queued matches
+PARSE_LATENCIES = "zeus:parse_latencies"
+PARSE_QUEUE_STATS = "zeus:parse_queue_stats"
+LATENCY_SAMPLES = 500
+MIN_LATENCY_SAMPLES = 20
+# Check k (from 0) of an unparsed match is planned for when this fraction of
+# parses have finished. A match still unparsed after the last is given up.
+RECHECK_QUANTILES = (0.8, 0.95, 0.99)
+# Seconds after queueing for each check until enough latencies are observed
+DEFAULT_RECHECK_LATENCIES = (60, 180, 300)
+MIN_RECHECK_DELAY = 30
+# Match ids that are stored or on their way to being stored (being fetched
+# or waiting on a parse), so scrapers never fetch them again
+SEEN_MATCH_IDS = "zeus:seen_match_ids"
+# Match ids with a parse requested or queued, scored by when the claim lapses
+# in case a payload is lost without the match being stored or expiring
+IN_FLIGHT_MATCH_IDS = "zeus:in_flight_match_ids"
+IN_FLIGHT_TTL = 24 * 60 * 60
 
 
 def make_redis_client():
@@ -13,12 +46,57 @@ def make_redis_client():
 
 
 def push_unparsed_match_to_queue(r, match, job_id, delay):
-    queue_payload = make_queue_payload(match, job_id)
-    payload_json = json.dumps(queue_payload)
-    if not delay:
-        r.lpush("zeus:parsed_queue", payload_json)
-    else:
-        delay_queue(r, "zeus:parsed_queue", payload_json, delay=delay)
+    """Queue match unless it's already in flight. Returns whether it was."""
+    if not claim_in_flight(r, [match["match_id"]]):
+        return False
+    return bool(enqueue_unparsed_matches(r, [(match, job_id)], delay=delay))
+
+
+def claim_in_flight(r, match_ids):
+    """Claim match_ids in the in-flight set before requesting their parses,
+    returning the ones no one else holds a live claim on. Concurrent callers
+    never both claim the same id."""
+    now = time.time()
+    pipeline = r.pipeline()
+    pipeline.zremrangebyscore(IN_FLIGHT_MATCH_IDS, "-inf", now)
+    for match_id in match_ids:
+        pipeline.zadd(IN_FLIGHT_MATCH_IDS, {match_id: now + IN_FLIGHT_TTL}, nx=True)
+    return [
+        match_id for match_id, added in zip(match_ids, pipeline.execute()[1:]) if added
+    ]
+
+
+def enqueue_unparsed_matches(r, entries, delay=None):
+    """Queue a payload for every (match, job_id) in entries, whose ids the
+    caller has claimed, in one round trip. Returns the match ids queued."""
+    pipeline = r.pipeline()
+    for match, job_id in entries:
+        payload_json = json.dumps(make_queue_payload(match, job_id))
+        if delay:
+            delay_queue(pipeline, QUEUE_NAME, payload_json, delay=delay)
+        else:
+            pipeline.lpush(QUEUE_NAME, payload_json)
+    pipeline.execute()
+    return [match["match_id"] for match, _ in entries]
+
+
+def in_flight_match_ids(r, match_ids):
+    """The match_ids with a parse queued that hasn't been stored or expired"""
+    pipeline = r.pipeline(transaction=False)
+    for match_id in match_ids:
+        pipeline.zscore(IN_FLIGHT_MATCH_IDS, match_id)
+    now = time.time()
+    return [
+        match_id
+        for match_id, expires in zip(match_ids, pipeline.execute())
+        if expires is not None and expires > now
+    ]
+
+
+def finish_match_ids(r, match_ids):
+    """Matches that were stored or given up on may be queued again"""
+    if match_ids:
+        r.zrem(IN_FLIGHT_MATCH_IDS, *match_ids)
 
 
 @contextlib.contextmanager
@@ -49,24 +127,255 @@ def delay_queue(redis_client, queue_name, payload, delay=5):
     return identifier
 
 
+# Move up to ARGV[2] items due by ARGV[1] from the delayed zset (KEYS[1])
+# onto the queues they name, in due order. Only the queues passed as the
+# rest of KEYS are touched, so every key the script uses is declared; items
+# for other queues are left waiting. Returns {items moved, score of the
+# first item not yet due or false}.
+_PROMOTE_SCRIPT = """
+local queues = {}
+for i = 2, #KEYS do
+    queues[KEYS[i]] = true
+end
+local limit = tonumber(ARGV[2])
+local moved = 0
+local skipped = 0
+while moved < limit do
+    local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', skipped, limit - moved)
+    if #due == 0 then
+        break
+    end
+    for _, item in ipairs(due) do
+        local identifier_queue_payload = cjson.decode(item)
+        if queues[identifier_queue_payload[2]] then
+            redis.call('RPUSH', identifier_queue_payload[2], identifier_queue_payload[3])
+            redis.call('ZREM', KEYS[1], item)
+            moved = moved + 1
+        else
+            skipped = skipped + 1
+        end
+    end
+end
+local next_item = redis.call('ZRANGEBYSCORE', KEYS[1], '(' .. ARGV[1], '+inf', 'WITHSCORES', 'LIMIT', 0, 1)
+return {moved, next_item[2] or false}
+"""
+PROMOTE_BATCH_SIZE = 1000
+
+
+def promote_delayed(redis_client, queue_names=(QUEUE_NAME,), limit=PROMOTE_BATCH_SIZE):
+    """Atomically move every due delayed item for queue_names, up to limit,
+    onto its queue. Returns (number moved, when the next delayed item is due
+    or None)."""
+    moved, next_due = redis_client.register_script(_PROMOTE_SCRIPT)(
+        keys=["delayed:", *queue_names], args=[time.time(), limit]
+    )
+    return moved, None if next_due is None else float(next_due)
+
+
 def enqueue_delayed(redis_client):
-    item = redis_client.zrange("delayed:", 0, 0, withscores=True)
+    return promote_delayed(redis_client)[0]
 
-    if not item or item[0][1] > time.time():
-        time.sleep(0.01)
-        return False
 
-    item = item[0][0]
-    identifier, queue, payload = json.loads(item)
-
-    with redis_lock(redis_client, identifier) as locked:
-        if not locked:
-            return False
-        if redis_client.zrem("delayed:", item):
-            # TODO: log debug
-            print("queueing job for processing")
-            redis_client.rpush(queue, payload)
-            return True
+def claim_match_ids(r, match_ids):
+    """Add match_ids to the seen set, returning the ones that weren't in it.
+    Concurrent scrapers never both claim the same id."""
+    pipeline = r.pipeline(transaction=False)
+    for match_id in match_ids:
+        pipeline.sadd(SEEN_MATCH_IDS, match_id)
+    return [match_id for match_id, added in zip(match_ids, pipeline.execute()) if added]
+
+
+def forget_match_ids(r, match_ids):
+    """Let match ids that were given up on be claimed again"""
+    if match_ids:
+        r.srem(SEEN_MATCH_IDS, *match_ids)
+
+
+QueueItem = collections.namedtuple("QueueItem", ["raw", "payload"])
+
+
+class QueueConsumer:
+    """Reliable consumer of a queue filled by LPUSH.
+
+    pop() blocks until a payload arrives and atomically moves it onto this
+    consumer's processing list, where it stays until ack(), requeue() or
+    delay(). If the worker dies in between, reap_expired() puts it back on
+    the queue once its visibility timeout has passed.
+    """
+
+    def __init__(
+        self,
+        r,
+        consumer_id=None,
+        queue_name=QUEUE_NAME,
+        visibility_timeout=VISIBILITY_TIMEOUT,
+    ):
+        self.r = r
+        self.consumer_id = consumer_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.queue_name = queue_name
+        self.processing_list = PROCESSING_PREFIX + self.consumer_id
+        self.heartbeat_key = HEARTBEAT_PREFIX + self.consumer_id
+        self.visibility_timeout = visibility_timeout
+        self._heartbeat_at = None
+        self.heartbeat()
+
+    def heartbeat(self):
+        """Register as a consumer, so a crash leaves the processing list to be
+        reaped, and stay registered for another visibility timeout"""
+        pipeline = self.r.pipeline()
+        pipeline.sadd(CONSUMERS, self.consumer_id)
+        pipeline.set(self.heartbeat_key, 1, ex=self.visibility_timeout)
+        pipeline.execute()
+        self._heartbeat_at = time.monotonic()
+
+    def pop(self, timeout=1):
+        """The next QueueItem, or None if nothing arrived within timeout seconds"""
+        if time.monotonic() - self._heartbeat_at >= self.visibility_timeout / 2:
+            self.heartbeat()
+        raw = self.r.blmove(
+            self.queue_name, self.processing_list, timeout, "RIGHT", "LEFT"
+        )
+        if raw is None:
+            return None
+        self.r.zadd(DEADLINES, {raw: time.time() + self.visibility_timeout})
+        return QueueItem(raw, json.loads(raw))
+
+    def _finish(self, pipeline, item):
+        pipeline.lrem(self.processing_list, 1, item.raw)
+        pipeline.zrem(DEADLINES, item.raw)
+
+    def ack(self, item):
+        pipeline = self.r.pipeline()
+        self._finish(pipeline, item)
+        pipeline.execute()
+
+    def requeue(self, item, payload=None):
+        """Put the item, or an updated payload for it, back on the queue"""
+        pipeline = self.r.pipeline()
+        pipeline.lpush(
+            self.queue_name, item.raw if payload is None else json.dumps(payload)
+        )
+        self._finish(pipeline, item)
+        pipeline.execute()
+
+    def delay(self, item, delay, payload=None):
+        """Like requeue, but via the delayed: zset in delay seconds"""
+        pipeline = self.r.pipeline()
+        delay_queue(
+            pipeline,
+            self.queue_name,
+            item.raw.decode() if payload is None else json.dumps(payload),
+            delay=delay,
+        )
+        self._finish(pipeline, item)
+        pipeline.execute()
+
+    def release(self):
+        """Hand back everything still on this consumer's processing list, eg.
+        on shutdown, and stop being a consumer"""
+        moved = 0
+        while (
+            self.r.lmove(self.processing_list, self.queue_name, "LEFT", "RIGHT")
+            is not None
+        ):
+            moved += 1
+        pipeline = self.r.pipeline()
+        pipeline.srem(CONSUMERS, self.consumer_id)
+        pipeline.delete(self.heartbeat_key)
+        pipeline.execute()
+        return moved
+
+
+# For every consumer's processing list, put payloads whose deadline has
+# passed back on the consuming end of the queue. A payload with no deadline
+# (its consumer died between BLMOVE and ZADD) is given one now. A consumer
+# left with an empty list and no heartbeat is gone, and is forgotten.
+# KEYS: queue, consumers set, deadlines zset, then each consumer's
+# processing list followed by each one's heartbeat. ARGV: now, visibility
+# timeout, then the consumer ids.
+_REAP_SCRIPT = """
+local now = tonumber(ARGV[1])
+local num_consumers = #ARGV - 2
+local moved = 0
+for i = 1, num_consumers do
+    local processing = KEYS[3 + i]
+    for _, raw in ipairs(redis.call('LRANGE', processing, 0, -1)) do
+        local deadline = redis.call('ZSCORE', KEYS[3], raw)
+        if not deadline then
+            redis.call('ZADD', KEYS[3], now + tonumber(ARGV[2]), raw)
+        elseif tonumber(deadline) <= now then
+            redis.call('LREM', processing, 1, raw)
+            redis.call('ZREM', KEYS[3], raw)
+            redis.call('RPUSH', KEYS[1], raw)
+            moved = moved + 1
+        end
+    end
+    if redis.call('LLEN', processing) == 0 and redis.call('EXISTS', KEYS[3 + num_consumers + i]) == 0 then
+        redis.call('SREM', KEYS[2], ARGV[2 + i])
+    end
+end
+return moved
+"""
+
+
+def reap_expired(r, queue_name=QUEUE_NAME, visibility_timeout=VISIBILITY_TIMEOUT):
+    """Redeliver payloads whose consumer didn't ack within the visibility
+    timeout. Returns how many were put back on the queue."""
+    consumers = sorted(consumer.decode() for consumer in r.smembers(CONSUMERS))
+    keys = [queue_name, CONSUMERS, DEADLINES]
+    keys += [PROCESSING_PREFIX + consumer for consumer in consumers]
+    keys += [HEARTBEAT_PREFIX + consumer for consumer in consumers]
+    return r.eval(
+        _REAP_SCRIPT, len(keys), *keys, time.time(), visibility_timeout, *consumers
+    )
+
+
+def record_parse_latency(r, seconds):
+    pipeline = r.pipeline()
+    pipeline.lpush(PARSE_LATENCIES, seconds)
+    pipeline.ltrim(PARSE_LATENCIES, 0, LATENCY_SAMPLES - 1)
+    pipeline.execute()
+
+
+def record_expired(r, elapsed):
+    """Count a match given up on elapsed seconds after it was queued. It took
+    at least that long to parse, so it's also kept as a (right-censored)
+    latency sample; otherwise only parses that beat the last check would be
+    sampled and the schedule would keep shrinking."""
+    record_parse_latency(r, elapsed)
+    record_outcome(r, "expired")
+
+
+def recheck_latencies(r):
+    """Seconds after queueing to check a match at, one per RECHECK_QUANTILES,
+    from the observed parse latencies"""
+    samples = sorted(float(sample) for sample in r.lrange(PARSE_LATENCIES, 0, -1))
+    if len(samples) < MIN_LATENCY_SAMPLES:
+        return DEFAULT_RECHECK_LATENCIES
+    return tuple(
+        samples[min(len(samples) - 1, int(quantile * len(samples)))]
+        for quantile in RECHECK_QUANTILES
+    )
+
+
+def recheck_delay(r, num_checks, elapsed):
+    """Seconds until check number num_checks of a match queued elapsed
+    seconds ago, or None if it should be given up on instead"""
+    latencies = recheck_latencies(r)
+    if num_checks >= len(latencies):
+        return None
+    return max(MIN_RECHECK_DELAY, latencies[num_checks] - elapsed)
+
+
+def record_outcome(r, outcome):
+    r.hincrby(PARSE_QUEUE_STATS, outcome, 1)
+
+
+def parse_queue_stats(r):
+    return {
+        outcome.decode(): int(count)
+        for outcome, count in r.hgetall(PARSE_QUEUE_STATS).items()
+    }
 
 
 def make_queue_payload(match, job_id):
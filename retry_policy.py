@@ -0,0 +1,174 @@
+import email.utils
+import random
+import time
+
+import requests
+
+RETRYABLE_STATUS_CODES = frozenset([429, 500, 502, 503, 504])
+CIRCUIT_KEY_PREFIX = "zeus:circuit"
+
+
+class RetriesExhausted(Exception):
+    def __init__(self, endpoint, attempts, last_error):
+        super().__init__(f"{endpoint} failed after {attempts} attempts: {last_error}")
+        self.endpoint = endpoint
+        self.attempts = attempts
+        self.last_error = last_error
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header (delta-seconds or HTTP-date)"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(retry_at.timestamp() - time.time(), 0)
+
+
+class CircuitBreaker:
+    """Stops all calls to an API for reset_timeout seconds after
+    failure_threshold consecutive failures.
+
+    Once shared through redis, tripping the breaker in one worker makes
+    every worker back off, not just the one that saw the failures.
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=60, redis_client=None):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.redis_client = redis_client
+        self.consecutive_failures = 0
+        self.times_opened = 0
+        self._open_until = 0
+
+    def share(self, redis_client):
+        self.redis_client = redis_client
+
+    @property
+    def _key(self):
+        return f"{CIRCUIT_KEY_PREFIX}:{self.name}"
+
+    def remaining_open_time(self):
+        remaining = self._open_until - time.time()
+        if self.redis_client is not None:
+            shared_ttl_ms = self.redis_client.pttl(self._key)
+            if shared_ttl_ms and shared_ttl_ms > 0:
+                remaining = max(remaining, shared_ttl_ms / 1000)
+        return max(remaining, 0)
+
+    def is_open(self):
+        return self.remaining_open_time() > 0
+
+    def record_success(self):
+        self.consecutive_failures = 0
+
+    def record_failure(self):
+        self.consecutive_failures += 1
+        if self.consecutive_failures < self.failure_threshold:
+            return
+        print(f"Circuit breaker {self.name} open for {self.reset_timeout}s")
+        self.times_opened += 1
+        self._open_until = time.time() + self.reset_timeout
+        if self.redis_client is not None:
+            self.redis_client.set(self._key, 1, px=int(self.reset_timeout * 1000))
+
+
+class RetryPolicy:
+    """Retries 429s, 5xxs, timeouts and connection errors with exponential
+    backoff and full jitter, honoring Retry-After when the server sends it.
+
+    Non-retryable responses (eg. a 404) are returned to the caller as is.
+    """
+
+    def __init__(
+        self,
+        max_attempts=5,
+        base_delay=1,
+        max_delay=60,
+        breaker=None,
+        block_while_open=True,
+    ):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker = breaker
+        self.block_while_open = block_while_open
+        self.stats = {}
+
+    def backoff(self, attempt, retry_after=None):
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def _endpoint_stats(self, endpoint):
+        return self.stats.setdefault(
+            endpoint,
+            dict(calls=0, retries=0, failures=0, total_latency=0.0, max_latency=0.0),
+        )
+
+    def _wait_for_breaker(self):
+        if self.breaker is None:
+            return
+        remaining = self.breaker.remaining_open_time()
+        if not remaining:
+            return
+        if not self.block_while_open:
+            raise CircuitOpen(
+                f"Circuit {self.breaker.name} is open for {remaining:.1f}s"
+            )
+        time.sleep(remaining)
+
+    def call(self, endpoint, send):
+        """Call send() until it returns a non-retryable response"""
+        stats = self._endpoint_stats(endpoint)
+        last_error = None
+        for attempt in range(self.max_attempts):
+            if attempt:
+                stats["retries"] += 1
+            self._wait_for_breaker()
+
+            start = time.monotonic()
+            retry_after = None
+            try:
+                response = send()
+            except (
+                requests.exceptions.Timeout,
+                requests.exceptions.ConnectionError,
+            ) as e:
+                last_error = e
+            else:
+                if response.status_code not in RETRYABLE_STATUS_CODES:
+                    self._record_latency(stats, time.monotonic() - start)
+                    stats["calls"] += 1
+                    if self.breaker is not None:
+                        self.breaker.record_success()
+                    return response
+                last_error = f"HTTP {response.status_code}"
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+
+            self._record_latency(stats, time.monotonic() - start)
+            stats["calls"] += 1
+            if self.breaker is not None:
+                self.breaker.record_failure()
+            if attempt + 1 < self.max_attempts:
+                time.sleep(self.backoff(attempt, retry_after))
+
+        stats["failures"] += 1
+        raise RetriesExhausted(endpoint, self.max_attempts, last_error)
+
+    @staticmethod
+    def _record_latency(stats, latency):
+        stats["total_latency"] += latency
+        stats["max_latency"] = max(stats["max_latency"], latency)
@@ -14,12 +14,19 @@ from bs4 import BeautifulSoup
 from tabulate import tabulate
 
 import opendota
+import rate_limiter
+import retry_policy
 import secret
 from ad2l import scrape_team
 from fuzzy_hero_names import match
 
 
 url = "https://api.stratz.com/graphql"
+
+RETRY_POLICY = retry_policy.RetryPolicy(
+    breaker=retry_policy.CircuitBreaker("stratz"),
+)
+
 hero_stats_query = """    {}: matchUp(heroId: {}, bracketBasicIds: DIVINE_IMMORTAL, take: 137, matchLimit: 200){{
       with {{
         heroId1
@@ -90,10 +97,17 @@ def now_minus_weeks(weeks_ago=0):
     return int(now - (weeks_ago * 7 * 24 * 60 * 60))
 
 
-def do_query(query):
+def do_query(query, variables=None):
     headers = {"Authorization": f"Bearer {secret.STRATZ_API_KEY}", "User-Agent": "STRATZ_API"}
-    resp = requests.post(url, json={'query': query}, headers=headers)
-    return resp
+    body = {'query': query}
+    if variables is not None:
+        body['variables'] = variables
+
+    def send():
+        rate_limiter.acquire("stratz")
+        return requests.post(url, json=body, headers=headers)
+
+    return RETRY_POLICY.call("graphql", send)
 
 def build_query(heroes):
     hero_query_strings = [hero_stats_query.format("hero" + str(hero["id"]), str(hero["id"])) for hero in heroes]
@@ -114,8 +128,6 @@ def build_hero_matchups():
 
         matchup_by_heroes.update(response_body["data"]["heroStats"])
 
-        time.sleep(0.1) # Be nice to stratz API, rate limiting is a little aggressive
-
 
     return matchup_by_heroes
 
@@ -274,8 +286,6 @@ def get_versus_values_for_heroes(hero_list):
         for hero_id, hero_data in hero_stats.items():
             versus_matrix[hero_id] = hero_data[0]["vs"]
 
-        time.sleep(0.1)  # Be nice to the API
-
     return versus_matrix
 
 def get_versus_matrix(hero_list):
@@ -307,8 +317,6 @@ def get_versus_matrix(hero_list):
                 opponent_id = matchup["heroId2"]
                 versus_matrix[hero_id][opponent_id] = matchup
 
-        time.sleep(0.1)  # Be nice to the API
-
     return versus_matrix
 
 def get_draft_prep_matrix(hero_list):
@@ -497,8 +505,7 @@ query ($playerId: Long!) {
         variables = {"playerId": player_id}
 
         # Make the request to the Stratz API
-        headers = {"Authorization": f"Bearer {secret.STRATZ_API_KEY}", "User-Agent": "STRATZ_API"}
-        response = requests.post(url, json={"query": player_query, "variables": variables}, headers=headers)
+        response = do_query(player_query, variables)
 
         if response.status_code != 200:
             raise Exception(f"Query failed with status code {response.status_code}: {response.text}")
@@ -509,7 +516,6 @@ query ($playerId: Long!) {
             raise Exception(f"GraphQL query returned errors: {data['errors']}")
 
         results.append(data["data"]["player"])
-        time.sleep(0.2)
 
     return results
 
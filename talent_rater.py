@@ -1,30 +1,26 @@
 import argparse
 import math
-import json
 
 import dateparser
 import tabulate
 
+import constants_store
+import couch_views
 import couchdb
+import match_stats
 import matchlib
 import opendota
 
-def fetch_and_store_ability_constants():
-    # TODO: Probably should generalize this to refresh all local constants
-    abilities = opendota.get_abilities()
-    with open('abilities.json', 'w') as f:
-        f.write(json.dumps(abilities))
+# Match fields calculate_talent_winrates reads
+QUERY_FIELDS = ["match_id", "radiant_win", "players"]
 
-    ability_ids = opendota.get_ability_ids()
-    with open('ability_ids.json', 'w') as f:
-        f.write(json.dumps(ability_ids))
+def fetch_and_store_ability_constants():
+    constants_store.refresh('abilities')
+    constants_store.refresh('ability_ids')
 
 def load_ability_constants():
-    with open('abilities.json') as f:
-        abilities = json.loads(f.read())
-
-    with open('ability_ids.json') as f:
-        ability_ids = json.loads(f.read())
+    abilities = constants_store.get_table('abilities')
+    ability_ids = constants_store.get_table('ability_ids')
     return abilities, ability_ids
     
 
@@ -53,15 +49,14 @@ def calculate_talent_winrates(dbquery, hero_name, max_level=16):
     ability_wins_and_games = {}
     hero = opendota.find_hero(hero_name)
     all_games = 0
-    for game in dbquery:
-        for player_game in game['players']:
-            if player_game['hero_id'] != hero['id']:
+    for record in matchlib.iterate_match_records(dbquery):
+        for player in record.players:
+            if player.hero_id != hero['id']:
                 continue
-            ability_data = extract_ability_upgrades_from_player_data(player_game)
-            if ability_data['ability_ids'] is None:
+            if player.ability_upgrades is None:
                 continue
             all_games += 1
-            for i, ability_id in enumerate(ability_data['ability_ids'][:max_level]):
+            for i, ability_id in enumerate(player.ability_upgrades[:max_level]):
                 ability_name = ability_ids.get(str(ability_id), None)
                 if ability_name is None:
                     continue
@@ -78,7 +73,7 @@ def calculate_talent_winrates(dbquery, hero_name, max_level=16):
                     ability_wins_and_games[full_ability_info['dname']]['earliest_taken'] = i + 1
 
                 ability_wins_and_games[full_ability_info['dname']].setdefault('wins', 0)
-                ability_wins_and_games[full_ability_info['dname']]['wins'] += ability_data['player_won']
+                ability_wins_and_games[full_ability_info['dname']]['wins'] += player.player_won
                 ability_wins_and_games[full_ability_info['dname']].setdefault('games', 0)
                 ability_wins_and_games[full_ability_info['dname']]['games'] += 1
 
@@ -86,23 +81,88 @@ def calculate_talent_winrates(dbquery, hero_name, max_level=16):
     return ability_wins_and_games
 
 
+def talent_winrates_from_counts(talent_counts, max_level=16):
+    """Same shape as calculate_talent_winrates, from pre-aggregated
+    {ability_id: {level_taken: (wins, games)}} counts for one hero"""
+    abilities, ability_ids = load_ability_constants()
+    ability_wins_and_games = {}
+    for ability_id, counts_by_level in talent_counts.items():
+        ability_name = ability_ids.get(str(ability_id), None)
+        if ability_name is None:
+            continue
+
+        full_ability_info = abilities[ability_name]
+        if not full_ability_info:
+            continue
+        if not _is_talent(full_ability_info):
+            continue
+
+        for level, (wins, games) in counts_by_level.items():
+            if level > max_level:
+                continue
+            talent = ability_wins_and_games.setdefault(
+                full_ability_info['dname'], {'earliest_taken': 30, 'wins': 0, 'games': 0}
+            )
+            talent['earliest_taken'] = min(talent['earliest_taken'], level)
+            talent['wins'] += wins
+            talent['games'] += games
+
+    return ability_wins_and_games
+
+
+def calculate_talent_winrates_from_views(db, hero_name, max_level=16):
+    """calculate_talent_winrates over every stored match, from the
+    hero_talents view's per-level counts"""
+    couch_views.ensure_design_doc(db)
+    hero = opendota.find_hero(hero_name)
+    return talent_winrates_from_counts(couch_views.hero_talent_counts(db, hero['id']), max_level)
+
+
+def calculate_talent_winrates_from_stats(stats, hero_name, max_level=16):
+    """calculate_talent_winrates over every match folded into a
+    match_stats.MatchStats"""
+    hero = opendota.find_hero(hero_name)
+    return talent_winrates_from_counts(stats.hero_talent_counts(hero['id']), max_level)
+
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--hero", type=str, default="")
-    parser.add_argument("--start-time", type=str, default='Jan 1 2020')
+    parser.add_argument("--start-time", type=str, help="Default Jan 1 2020")
     parser.add_argument("--max-level", type=int, default=16)
+    parser.add_argument(
+        "--use-views",
+        action="store_true",
+        help="Read win counts from CouchDB views. Covers every match, so no --start-time",
+    )
+    parser.add_argument(
+        "--use-stats",
+        action="store_true",
+        help="Read win counts materialized by match_stats. Covers every match, so no --start-time",
+    )
 
     args = parser.parse_args()
-
-    db = couchdb.get_matches_db()
-    start_time = dateparser.parse(args.start_time).timestamp()
-    dbquery = couchdb.get_all_matches_with_hero_after_start_time(
-        db,
-        start_time,
-        [args.hero],
-    )
-    talent_winrates = calculate_talent_winrates(dbquery, args.hero, args.max_level)
+    if args.start_time is not None and (args.use_views or args.use_stats):
+        parser.error("--use-views and --use-stats cover every match, they can't take --start-time")
+
+    with couchdb.dbcontext() as db:
+        if args.use_stats:
+            talent_winrates = calculate_talent_winrates_from_stats(
+                match_stats.load_stats(db), args.hero, args.max_level
+            )
+        elif args.use_views:
+            talent_winrates = calculate_talent_winrates_from_views(db, args.hero, args.max_level)
+        else:
+            start_time = dateparser.parse(args.start_time or "Jan 1 2020").timestamp()
+            dbquery = couchdb.get_all_matches_with_hero_after_start_time(
+                db,
+                start_time,
+                [args.hero],
+                fields=QUERY_FIELDS,
+                parsed_only=True,
+            )
+            talent_winrates = calculate_talent_winrates(dbquery, args.hero, args.max_level)
     talent_winrate_table = []
     for talent_name, game_info in talent_winrates.items():
         winrate = game_info['wins'] / game_info['games']
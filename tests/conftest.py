@@ -0,0 +1,140 @@
+import json
+import sys
+import types
+
+import fakeredis
+import pytest
+import requests
+
+try:
+    import secret  # noqa: F401
+except ImportError:
+    # secret.py holds developers' API keys and isn't checked in
+    secret = types.ModuleType("secret")
+    secret.OPENDOTA_API_KEY = ""
+    secret.STRATZ_API_KEY = ""
+    sys.modules["secret"] = secret
+
+
+@pytest.fixture
+def match_fixtures():
+    matches = []
+    for name in ["comeback_match", "stomp_match"]:
+        with open(f"tests/fixtures/{name}.json") as f:
+            matches.append(json.loads(f.read()))
+    return matches
+
+
+@pytest.fixture
+def redis_client():
+    return fakeredis.FakeRedis()
+
+
+class FakeResponse:
+    """The parts of a requests.Response the code under test reads"""
+
+    def __init__(self, body=None, status_code=200, headers=None):
+        self._body = body
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(
+                f"HTTP {self.status_code}", response=self
+            )
+
+    def json(self):
+        return self._body
+
+
+class FakeCouchSession:
+    """db.r_session over an in-memory database: documents, _local documents,
+    _all_docs and _bulk_docs. Every POST is kept in requests as (path, body).
+
+    Subclasses handle other paths by overriding get/post and falling back
+    to these.
+    """
+
+    def __init__(self, docs=()):
+        self.docs = {doc["_id"]: doc for doc in docs}
+        self.local_docs = {}
+        self.local_writes = 0
+        self.requests = []
+
+    def _path(self, url):
+        assert url.startswith(FakeDB.database_url)
+        return url[len(FakeDB.database_url) :]
+
+    def get(self, url, params=None):
+        path = self._path(url)
+        if path.startswith("/_local/"):
+            doc = self.local_docs.get(path[1:])
+            if doc is None:
+                return FakeResponse({"error": "not_found"}, 404)
+            return FakeResponse(json.loads(json.dumps(doc)))
+        assert path == "/_all_docs", f"unexpected GET {url}"
+        params = params or {}
+        ids = sorted(self.docs)
+        if "startkey" in params:
+            ids = [doc_id for doc_id in ids if doc_id >= json.loads(params["startkey"])]
+        if "limit" in params:
+            ids = ids[: int(params["limit"])]
+        return FakeResponse({"rows": [self._row(doc_id, params) for doc_id in ids]})
+
+    def put(self, url, data, headers):
+        path = self._path(url)
+        assert path.startswith("/_local/"), f"unexpected PUT {url}"
+        doc = json.loads(data)
+        assert doc.get("_rev") == self.local_docs.get(path[1:], {}).get("_rev")
+        self.local_writes += 1
+        doc["_rev"] = f"0-{self.local_writes}"
+        self.local_docs[path[1:]] = doc
+        return FakeResponse({"ok": True, "id": doc["_id"], "rev": doc["_rev"]})
+
+    def post(self, url, data, headers, params=None):
+        path = self._path(url)
+        body = json.loads(data)
+        self.requests.append((path, body))
+        if path == "/_all_docs":
+            return FakeResponse(
+                {"rows": [self._row(key, params or {}) for key in body["keys"]]}
+            )
+        assert path == "/_bulk_docs", f"unexpected POST {url}"
+        return FakeResponse([self._write(doc) for doc in body["docs"]])
+
+    def _row(self, doc_id, params):
+        doc = self.docs.get(doc_id)
+        if doc is None:
+            return {"key": doc_id, "error": "not_found"}
+        row = {"id": doc_id, "key": doc_id, "value": {"rev": doc.get("_rev")}}
+        if params.get("include_docs") == "true":
+            row["doc"] = doc
+        return row
+
+    def _write(self, doc):
+        existing = self.docs.get(doc["_id"])
+        if doc.get("bad"):
+            return {"id": doc["_id"], "error": "forbidden", "reason": "nope"}
+        if existing is not None and doc.get("_rev") != existing.get("_rev"):
+            return {
+                "id": doc["_id"],
+                "error": "conflict",
+                "reason": "Document update conflict.",
+            }
+        generation = 1 if existing is None else int(existing["_rev"].split("-")[0]) + 1
+        self.docs[doc["_id"]] = dict(doc, _rev=f"{generation}-x")
+        return {"id": doc["_id"], "rev": f"{generation}-x"}
+
+
+class FakeDB:
+    database_url = "http://127.0.0.1:5984/zeus_matches"
+    database_name = "zeus_matches"
+
+    def __init__(self, r_session=None):
+        self.r_session = FakeCouchSession() if r_session is None else r_session
+
+
+def stored_docs(*doc_ids):
+    """Minimal stored documents with the given ids"""
+    return [{"_id": doc_id, "_rev": "1-x"} for doc_id in doc_ids]
@@ -0,0 +1,56 @@
+import pytest
+
+import constants_store
+import opendota
+from tests.conftest import FakeResponse
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(constants_store, "CONSTANTS_DIR", str(tmp_path))
+    constants_store.clear_memo()
+    yield constants_store
+    constants_store.clear_memo()
+
+
+def test_heroes_seeded_without_network(store, monkeypatch):
+    monkeypatch.setattr(opendota, "get_constants", None)
+    heroes = store.get_table("heroes")
+    assert heroes["8"]["localized_name"] == "Juggernaut"
+    assert store.read_entry("heroes")["version"] == 0
+
+
+def test_refresh_is_conditional_and_memoized(store, monkeypatch):
+    requests_made = []
+
+    def fake_get_constants(table, etag=None, last_modified=None):
+        requests_made.append((table, etag))
+        if etag == '"v1"':
+            return FakeResponse(status_code=304)
+        return FakeResponse({"blink": {"cost": 2250}}, headers={"ETag": '"v1"'})
+
+    monkeypatch.setattr(opendota, "get_constants", fake_get_constants)
+
+    assert store.get_table("items")["blink"]["cost"] == 2250
+    assert store.get_table("items") is store.get_table("items")
+    assert requests_made == [("items", None)]
+
+    entry = store.refresh("items")
+    assert requests_made[-1] == ("items", '"v1"')
+    assert entry["version"] == 1
+    assert entry["data"]["blink"]["cost"] == 2250
+
+
+def test_stale_table_falls_back_to_local_copy_offline(store, monkeypatch):
+    monkeypatch.setattr(
+        opendota,
+        "get_constants",
+        lambda table, **kwargs: FakeResponse({"blink": {}}),
+    )
+    store.refresh("items")
+
+    def offline(table, **kwargs):
+        raise constants_store.requests.exceptions.ConnectionError()
+
+    monkeypatch.setattr(opendota, "get_constants", offline)
+    assert store.get_table("items", max_age=-1) == {"blink": {}}
@@ -0,0 +1,67 @@
+import json
+
+import constants_store
+import couch_migrations
+import couch_views
+import couchdb
+from tests.conftest import FakeCouchSession, FakeDB, FakeResponse
+
+
+class FakeMigrationSession(FakeCouchSession):
+    """Adds _index, keeping the index definitions posted"""
+
+    def __init__(self):
+        super().__init__()
+        self.indexes = []
+
+    def post(self, url, data, headers, params=None):
+        if not url.endswith("/_index"):
+            return super().post(url, data, headers, params)
+        body = json.loads(data)
+        result = "exists" if body in self.indexes else "created"
+        self.indexes.append(body)
+        return FakeResponse({"result": result, "name": body.get("name")})
+
+
+def test_migrate_applies_each_migration_once(monkeypatch):
+    installed = []
+    monkeypatch.setattr(
+        couch_views,
+        "ensure_design_doc",
+        lambda db, design_doc: installed.append(design_doc["_id"]),
+    )
+    monkeypatch.setattr(constants_store, "get_table", lambda table: {})
+    db = FakeDB(FakeMigrationSession())
+    migrations = couch_migrations.load_migrations()
+    names = [name for name, _ in migrations]
+    assert names == sorted(names)
+
+    assert couch_migrations.migrate(db) == names
+    assert set(
+        db.r_session.local_docs[couch_migrations.METADATA_DOC_ID]["applied"]
+    ) == set(names)
+    assert installed == [
+        couch_views.COUNTS_DESIGN_DOC_ID,
+        couch_views.DESIGN_DOC_ID,
+        couch_views.ITEMS_DESIGN_DOC_ID,
+        couch_views.DESIGN_DOC_ID,
+    ]
+    assert couch_migrations.migrate(db) == []
+
+    # A migration added later is the only one applied on the next run
+    new_index = {
+        "index": {"fields": ["match_id"]},
+        "name": "match_id_idx",
+        "type": "json",
+    }
+    assert couch_migrations.migrate(db, migrations + [("9999_new", new_index)]) == [
+        "9999_new"
+    ]
+    assert db.r_session.indexes[-1] == new_index
+
+
+def test_parsed_index_partial_filter_matches_queries():
+    migrations = dict(couch_migrations.load_migrations())
+    index = migrations["0003_create_parsed_start_time_index"]
+    assert index["name"] == couchdb.PARSED_START_TIME_INDEX
+    assert index["index"]["partial_filter_selector"] == couchdb.PARSED_MATCHES_SELECTOR
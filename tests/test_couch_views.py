@@ -0,0 +1,192 @@
+import collections
+import datetime
+import json
+import shutil
+import subprocess
+
+import pytest
+
+import couch_views
+import couchdb
+import item_rater
+import matchlib
+
+
+def run_map(map_function, docs):
+    """Run a view's map function under node, returning (key, value) pairs"""
+    if shutil.which("node") is None:
+        pytest.skip("node isn't installed")
+    script = f"""
+var emitted = [];
+function emit(key, value) {{ emitted.push([key, value]); }}
+var map = {map_function};
+var docs = JSON.parse(require("fs").readFileSync(0, "utf8"));
+docs.forEach(function (doc) {{ map(doc); }});
+process.stdout.write(JSON.stringify(emitted));
+"""
+    result = subprocess.run(
+        ["node", "-e", script],
+        input=json.dumps(docs).encode(),
+        stdout=subprocess.PIPE,
+        check=True,
+    )
+    return json.loads(result.stdout)
+
+
+def reduce_sum(emitted):
+    totals = collections.defaultdict(lambda: [0, 0])
+    for key, (wins, games) in emitted:
+        totals[tuple(key)][0] += wins
+        totals[tuple(key)][1] += games
+    return dict(totals)
+
+
+def test_hero_items_map_matches_python_pruning(match_fixtures):
+    expected = collections.defaultdict(lambda: [0, 0])
+    for match in match_fixtures:
+        record = matchlib.MatchRecord(match)
+        for player, keys in zip(record.players, record.pruned_purchase_keys()):
+            for key in set(keys):
+                expected[(player.hero_id, key)][0] += int(player.player_won)
+                expected[(player.hero_id, key)][1] += 1
+
+    assert reduce_sum(run_map(couch_views.hero_items_map({}), match_fixtures)) == dict(
+        expected
+    )
+
+
+def test_hero_items_map_leaves_out_built_components(match_fixtures):
+    with open("tests/fixtures/item_components.json") as f:
+        components = json.loads(f.read())
+    item_info = collections.defaultdict(lambda: {"components": None})
+    item_info.update({key: {"components": parts} for key, parts in components.items()})
+
+    hero_totals = collections.defaultdict(lambda: [0, 0])
+    for (hero_id, _), (wins, games) in reduce_sum(
+        run_map(couch_views.HERO_WEEKS_MAP, match_fixtures)
+    ).items():
+        hero_totals[hero_id][0] += wins
+        hero_totals[hero_id][1] += games
+    item_counts = collections.defaultdict(dict)
+    for (hero_id, key), counts in reduce_sum(
+        run_map(couch_views.hero_items_map(components), match_fixtures)
+    ).items():
+        item_counts[hero_id][key] = tuple(counts)
+
+    assert item_rater.item_winrates_from_counts(hero_totals, item_counts) == (
+        item_rater.calculate_item_winrates(item_info, match_fixtures)
+    )
+
+
+def test_hero_weeks_and_talents_maps(match_fixtures):
+    hero_weeks = reduce_sum(run_map(couch_views.HERO_WEEKS_MAP, match_fixtures))
+    assert sum(games for _, games in hero_weeks.values()) == 20
+    assert sum(wins for wins, _ in hero_weeks.values()) == 10
+
+    stomp = match_fixtures[1]
+    player = stomp["players"][0]
+    talents = run_map(couch_views.HERO_TALENTS_MAP, [stomp])
+    assert [key[1] for key, _ in talents if key[0] == player["hero_id"]] == player[
+        "ability_upgrades_arr"
+    ]
+
+
+def test_hero_counts_since_week_is_one_query(match_fixtures, monkeypatch):
+    docs = [
+        dict(match, start_time=week * couch_views.SECONDS_PER_WEEK)
+        for week, match in enumerate(match_fixtures * 2)
+    ]
+    hero_weeks = reduce_sum(run_map(couch_views.HERO_WEEKS_MAP, docs))
+    requests = []
+
+    def query_view(db, view_name, group_level, startkey=None, endkey=None):
+        requests.append(group_level)
+        grouped = collections.defaultdict(lambda: [0, 0])
+        for key, (wins, games) in sorted(hero_weeks.items()):
+            if startkey is None or key[0] == startkey[0]:
+                grouped[key[:group_level]][0] += wins
+                grouped[key[:group_level]][1] += games
+        return [{"key": list(key), "value": value} for key, value in grouped.items()]
+
+    monkeypatch.setattr(couch_views, "query_view", query_view)
+    hero_id = match_fixtures[0]["players"][0]["hero_id"]
+    assert sum(games for _, games in couch_views.hero_counts(None).values()) == 40
+    assert (
+        sum(games for _, games in couch_views.hero_counts(None, since_week=2).values())
+        == 20
+    )
+    assert couch_views.hero_counts(None, hero_id, since_week=1)[hero_id] == tuple(
+        map(
+            sum,
+            zip(
+                *(
+                    value
+                    for key, value in hero_weeks.items()
+                    if key[0] == hero_id and key[1] >= 1
+                )
+            ),
+        )
+    )
+    assert requests == [1, 2, 2]
+
+
+def _collation_key(key):
+    # CouchDB sorts numbers before objects; {} is the usual "max" sentinel
+    return [(1, 0) if isinstance(part, dict) else (0, part) for part in key]
+
+
+def fake_count_view(emitted):
+    def query_view(
+        db, view_name, design_doc_id=None, startkey=None, endkey=None, group_level=None
+    ):
+        keys = [
+            key
+            for key in emitted[view_name]
+            if (startkey is None or _collation_key(key) >= _collation_key(startkey))
+            and (endkey is None or _collation_key(key) <= _collation_key(endkey))
+        ]
+        if group_level is None:
+            return [{"key": None, "value": len(keys)}] if keys else []
+        grouped = collections.Counter(tuple(key[:group_level]) for key in keys)
+        return [
+            {"key": list(key), "value": count} for key, count in sorted(grouped.items())
+        ]
+
+    return query_view
+
+
+def test_count_matches_from_count_views(match_fixtures, monkeypatch):
+    docs = []
+    for day, match in enumerate(match_fixtures * 2):
+        docs.append(
+            dict(match, start_time=1600000000 + day * couch_views.SECONDS_PER_DAY)
+        )
+    emitted = {
+        "matches_by_time": [
+            key for key, _ in run_map(couch_views.MATCHES_BY_TIME_MAP, docs)
+        ],
+        "hero_matches_by_time": [
+            key for key, _ in run_map(couch_views.HERO_MATCHES_BY_TIME_MAP, docs)
+        ],
+    }
+    monkeypatch.setattr(couch_views, "query_view", fake_count_view(emitted))
+
+    hero_id = match_fixtures[0]["players"][1]["hero_id"]
+    assert couchdb.count_matches(None) == 4
+    assert couchdb.count_matches(None, since=docs[1]["start_time"]) == 2
+    assert couchdb.count_matches(None, since=docs[1]["start_time"] - 0.5) == 3
+    assert couchdb.count_matches(None, hero_id=hero_id) == 2
+    assert (
+        couchdb.count_matches(None, since=docs[0]["start_time"], hero_id=hero_id) == 1
+    )
+    assert couchdb.count_matches(None, by_day=True) == {
+        datetime.date(2020, 9, 13): 1,
+        datetime.date(2020, 9, 14): 1,
+        datetime.date(2020, 9, 15): 1,
+        datetime.date(2020, 9, 16): 1,
+    }
+    assert couchdb.count_matches(None, hero_id=hero_id, by_day=True) == {
+        datetime.date(2020, 9, 13): 1,
+        datetime.date(2020, 9, 15): 1,
+    }
+    assert couchdb.count_matches(None, since=docs[3]["start_time"]) == 0
@@ -0,0 +1,252 @@
+import json
+import threading
+
+import pytest
+
+import couchdb
+from tests.conftest import FakeCouchSession, FakeDB, FakeResponse, stored_docs
+
+
+def bulk_posts(db):
+    return [
+        body["docs"] for path, body in db.r_session.requests if path == "/_bulk_docs"
+    ]
+
+
+def test_bulk_writer_flushes_by_count_and_reports_results():
+    db = FakeDB(FakeCouchSession(stored_docs("2")))
+    writer = couchdb.BulkMatchWriter(db, max_docs=3)
+    with writer:
+        for match_id in range(1, 6):
+            writer.add({"match_id": match_id, "bad": match_id == 5})
+        assert len(bulk_posts(db)) == 1
+
+    assert len(bulk_posts(db)) == 2
+    assert [doc["_id"] for doc in bulk_posts(db)[0]] == ["1", "2", "3"]
+    assert writer.stats == dict(stored=3, already_stored=1, errors=1, flushes=2)
+    assert writer.errors[0]["id"] == "5"
+
+
+def test_bulk_writer_flushes_by_size_and_age():
+    db = FakeDB()
+    writer = couchdb.BulkMatchWriter(db, max_bytes=10)
+    writer.add({"match_id": 1})
+    assert len(bulk_posts(db)) == 1
+
+    writer = couchdb.BulkMatchWriter(db, max_age=0)
+    writer.add({"match_id": 2})
+    assert len(bulk_posts(db)) == 2
+    assert writer.flush_if_due() is None
+
+
+def test_bulk_writer_keeps_its_buffer_when_a_flush_fails():
+    db = FakeDB()
+    post = db.r_session.post
+
+    def flaky_post(url, data, headers, params=None):
+        db.r_session.post = post
+        raise ConnectionError("couch went away")
+
+    db.r_session.post = flaky_post
+    writer = couchdb.BulkMatchWriter(db)
+    writer.add({"match_id": 1})
+    with pytest.raises(ConnectionError):
+        writer.flush()
+
+    writer.add({"match_id": 2})
+    writer.flush()
+    assert [doc["_id"] for doc in bulk_posts(db)[0]] == ["1", "2"]
+    assert writer.stats["stored"] == 2
+
+
+class FakeClient:
+    def __init__(self):
+        self.all_dbs_calls = 0
+        self.disconnected = False
+
+    def all_dbs(self):
+        self.all_dbs_calls += 1
+        return [couchdb.MATCHES_DBNAME]
+
+    def __getitem__(self, dbname):
+        return FakeDB()
+
+    def disconnect(self):
+        self.disconnected = True
+
+
+def test_client_and_db_handles_are_shared(monkeypatch):
+    clients = []
+
+    def make_client():
+        clients.append(FakeClient())
+        return clients[-1]
+
+    monkeypatch.setattr(couchdb, "make_client", make_client)
+    couchdb.close_client()
+
+    with couchdb.dbcontext() as db:
+        with couchdb.dbcontext() as inner_db:
+            assert inner_db is db
+        assert not clients[0].disconnected
+        assert couchdb.get_matches_db() is db
+    assert len(clients) == 1
+    assert clients[0].all_dbs_calls == 1
+    assert clients[0].disconnected
+
+    assert couchdb.get_matches_db() is not db
+    assert len(clients) == 2
+    couchdb.close_client()
+
+
+class FakeExplainSession:
+    def __init__(self, index):
+        self.index = index
+
+    def post(self, url, data, headers):
+        assert url.endswith("/_explain")
+        return FakeResponse(
+            {"index": self.index, "selector": json.loads(data)["selector"]}
+        )
+
+
+def test_warn_if_full_scan(capsys):
+    query_dict = {"selector": {"start_time": {"$gt": 0}}}
+    all_docs = {"ddoc": None, "name": "_all_docs", "type": "special"}
+    assert couchdb.warn_if_full_scan(FakeDB(FakeExplainSession(all_docs)), query_dict)
+    assert "WARNING" in capsys.readouterr().out
+
+    start_time_idx = {"ddoc": "_design/abc", "name": "start_time_idx", "type": "json"}
+    assert not couchdb.warn_if_full_scan(
+        FakeDB(FakeExplainSession(start_time_idx)), query_dict
+    )
+
+
+class FakeFindSession:
+    def __init__(self, num_docs, fail_at_page=None):
+        self.docs = [{"_id": str(i), "match_id": i} for i in range(num_docs)]
+        self.fail_at_page = fail_at_page
+        self.bodies = []
+
+    def post(self, url, data, headers):
+        assert url.endswith("/_find")
+        body = json.loads(data)
+        self.bodies.append(body)
+        if len(self.bodies) == self.fail_at_page:
+            raise ConnectionError("couch went away")
+        start = int(body.get("bookmark", 0))
+        page = self.docs[start : start + body["limit"]]
+        return FakeResponse({"docs": page, "bookmark": str(start + len(page))})
+
+
+def test_prefetching_query_follows_bookmarks():
+    session = FakeFindSession(num_docs=10)
+    query = couchdb.PrefetchingQuery(
+        FakeDB(session), {"selector": {"start_time": {"$gt": 0}}}, page_size=4
+    )
+    assert [doc["match_id"] for doc in query] == list(range(10))
+    assert [body.get("bookmark") for body in session.bodies] == [None, "4", "8"]
+    assert all(
+        body["selector"] == {"start_time": {"$gt": 0}} for body in session.bodies
+    )
+
+    # A full last page takes one more, empty, request to notice the end
+    session = FakeFindSession(num_docs=8)
+    query = couchdb.PrefetchingQuery(FakeDB(session), {"selector": {}}, page_size=4)
+    assert len(list(query)) == 8
+    assert len(session.bodies) == 3
+
+
+def test_prefetching_query_raises_fetch_errors_and_stops_early(monkeypatch):
+    session = FakeFindSession(num_docs=10, fail_at_page=2)
+    query = couchdb.PrefetchingQuery(FakeDB(session), {"selector": {}}, page_size=4)
+    seen = []
+    with pytest.raises(ConnectionError):
+        for doc in query:
+            seen.append(doc)
+    assert len(seen) == 4
+
+    fetchers = []
+
+    class RecordedThread(threading.Thread):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            fetchers.append(self)
+
+    monkeypatch.setattr(couchdb.threading, "Thread", RecordedThread)
+    session = FakeFindSession(num_docs=1000)
+    iterator = iter(
+        couchdb.PrefetchingQuery(
+            FakeDB(session), {"selector": {}}, page_size=10, prefetch=2
+        )
+    )
+    next(iterator)
+    iterator.close()
+    fetchers[0].join(timeout=10)
+    assert not fetchers[0].is_alive()
+    # The fetcher stopped within a few pages of the consumer
+    assert len(session.bodies) <= 5
+
+
+class FakeHeroViewSession(FakeCouchSession):
+    """Adds the hero_matches_by_time view over the stored docs"""
+
+    def __init__(self, docs):
+        super().__init__(docs)
+        self.rows = sorted(
+            (
+                [player["hero_id"], doc["start_time"] // 86400, doc["start_time"]],
+                doc["_id"],
+            )
+            for doc in docs
+            for player in doc["players"]
+        )
+        self.view_requests = []
+
+    def get(self, url, params=None):
+        if not url.endswith("/_design/zeus_counts/_view/hero_matches_by_time"):
+            return super().get(url, params)
+        self.view_requests.append(params)
+        startkey = json.loads(params["startkey"])
+        endkey = json.loads(params["endkey"])
+        startkey_docid = params.get("startkey_docid", "")
+        rows = [
+            {"key": key, "id": doc_id, "value": None}
+            for key, doc_id in self.rows
+            if (key, doc_id) >= (startkey, startkey_docid) and key[0] == endkey[0]
+        ]
+        return FakeResponse({"rows": rows[: int(params["limit"])]})
+
+    def fetched_ids(self):
+        return [
+            key
+            for path, body in self.requests
+            if path == "/_all_docs"
+            for key in body["keys"]
+        ]
+
+
+def test_hero_query_reads_only_matches_with_the_hero(monkeypatch):
+    monkeypatch.setattr(couchdb.opendota, "find_hero", lambda name: {"id": int(name)})
+    docs = []
+    for i in range(10):
+        players = [{"hero_id": 1 if i % 2 else 2}, {"hero_id": 3}]
+        if i % 4 == 1:
+            players[0]["purchase_log"] = []
+        docs.append(
+            {"_id": str(i), "match_id": i, "start_time": 1000 + i, "players": players}
+        )
+    db = FakeDB(FakeHeroViewSession(docs))
+
+    query = couchdb.get_all_matches_with_hero_after_start_time(
+        db, 1002, ["1"], page_size=2
+    )
+    assert [doc["match_id"] for doc in query] == [3, 5, 7, 9]
+    assert db.r_session.fetched_ids() == ["3", "5", "7", "9"]
+    assert json.loads(db.r_session.view_requests[0]["startkey"]) == [1, 0, 1003]
+    assert db.r_session.view_requests[1]["startkey_docid"] == "7"
+
+    query = couchdb.get_all_matches_with_hero_after_start_time(
+        db, 0, ["3"], ["1"], fields=["match_id"], parsed_only=True
+    )
+    assert list(query) == [{"match_id": 1}, {"match_id": 5}, {"match_id": 9}]
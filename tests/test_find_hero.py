@@ -1,4 +1,7 @@
+import constants_store
 import opendota
+from hero_registry import get_hero_registry
+from tests.conftest import FakeResponse
 
 
 def test_find_juggernaut():
@@ -9,3 +12,46 @@ def test_find_juggernaut():
 def test_hero_id():
     juggernaut_id = opendota.get_hero_id("Juggernaut")
     assert juggernaut_id == 8
+
+
+def test_find_hero_by_id_accepts_str_and_int():
+    assert opendota.find_hero_by_id(8) is opendota.find_hero_by_id("8")
+    assert opendota.find_hero_name_by_id(8) == "Juggernaut"
+    assert opendota.find_hero_by_id("juggernaut") is None
+    assert opendota.find_hero_by_id(None) is None
+    assert "8" in get_hero_registry() and "abc" not in get_hero_registry()
+
+
+def test_hero_registry_indexes():
+    registry = get_hero_registry()
+    assert registry is get_hero_registry()
+    assert registry.by_npc_name("npc_dota_hero_juggernaut")["id"] == 8
+    assert registry.by_name("Juggernaut") is registry.by_id(8)
+    assert [registry.index_of(hero_id) for hero_id in registry.ids] == list(
+        range(len(registry))
+    )
+    assert registry.id_at(registry.index_of(8)) == 8
+    assert len(opendota.load_hero_list()) == len(registry)
+
+
+def test_hero_registry_follows_heroes_table_refresh(tmp_path, monkeypatch):
+    monkeypatch.setattr(constants_store, "CONSTANTS_DIR", str(tmp_path))
+    constants_store.clear_memo()
+    assert opendota.find_hero_by_id(999) is None
+
+    heroes = dict(constants_store.get_table("heroes"))
+    heroes["999"] = {
+        "id": 999,
+        "name": "npc_dota_hero_new",
+        "localized_name": "New Hero",
+    }
+    monkeypatch.setattr(
+        constants_store.opendota,
+        "get_constants",
+        lambda table, **kwargs: FakeResponse(heroes),
+    )
+    constants_store.refresh("heroes")
+
+    assert opendota.find_hero("New Hero")["id"] == 999
+    assert len(opendota.load_hero_list()) == len(heroes)
+    constants_store.clear_memo()
@@ -0,0 +1,58 @@
+import json
+import os
+
+import pytest
+
+import match_cache
+
+
+@pytest.fixture
+def stomp_match_data():
+    with open("tests/fixtures/stomp_match.json") as f:
+        return json.loads(f.read())
+
+
+def test_cache_roundtrip(tmp_path, stomp_match_data):
+    cache = match_cache.MatchCache(cache_dir=str(tmp_path))
+    match_id = stomp_match_data["match_id"]
+    assert cache.get(match_id) is None
+
+    cache.put(match_id, stomp_match_data)
+    assert cache.get(match_id) == stomp_match_data
+    assert os.path.exists(cache.path_for(match_id))
+    assert cache.stats["hits"] == 1
+    assert cache.stats["misses"] == 1
+
+
+def test_unparsed_matches_expire(tmp_path):
+    cache = match_cache.MatchCache(cache_dir=str(tmp_path), unparsed_ttl=-1)
+    cache.put(1, {"match_id": 1, "players": [{}]})
+    assert cache.get(1) is None
+    assert cache.stats["expired"] == 1
+
+
+def test_eviction_removes_least_recently_used(tmp_path, stomp_match_data):
+    cache = match_cache.MatchCache(cache_dir=str(tmp_path))
+    cache.put(1, stomp_match_data)
+    entry_size = os.path.getsize(cache.path_for(1))
+    os.utime(cache.path_for(1), (0, 0))
+    cache.put(2, stomp_match_data)
+    os.utime(cache.path_for(2), (1, 1))
+
+    cache.max_bytes = entry_size * 2.5
+    cache.get(1)
+    cache.put(3, stomp_match_data)
+
+    assert cache.get(2) is None
+    assert cache.get(1) == stomp_match_data
+    assert cache.get(3) == stomp_match_data
+    assert cache.stats["evictions"] == 1
+
+
+def test_overwriting_an_entry_does_not_grow_the_size(tmp_path, stomp_match_data):
+    cache = match_cache.MatchCache(cache_dir=str(tmp_path))
+    cache.put(1, stomp_match_data)
+    cache.put(2, stomp_match_data)
+    for _ in range(5):
+        cache.put(2, stomp_match_data)
+    assert cache._size == cache._scan_size()
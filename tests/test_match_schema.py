@@ -0,0 +1,66 @@
+import collections
+import json
+
+import item_rater
+import match_schema
+import match_stats
+import matchlib
+from tests.conftest import FakeCouchSession, FakeDB
+
+
+def test_slim_match_keeps_what_the_raters_read(match_fixtures):
+    slim_matches = [match_schema.slim_match(match) for match in match_fixtures]
+    for match, slim in zip(match_fixtures, slim_matches):
+        assert slim["schema_version"] == match_schema.SCHEMA_VERSION
+        assert len(json.dumps(slim)) < len(json.dumps(match)) / 4
+        assert "chat" not in slim and "cosmetics" not in slim["players"][0]
+
+        record, slim_record = matchlib.MatchRecord(match), matchlib.MatchRecord(slim)
+        assert slim_record.pruned_purchase_keys() == record.pruned_purchase_keys()
+        assert slim_record.tower_kills == record.tower_kills
+
+    # Only the component lists are read; components are discounted the same
+    # way either way, so leave them out
+    item_info = collections.defaultdict(lambda: {"components": None})
+    assert item_rater.calculate_item_winrates(item_info, slim_matches) == (
+        item_rater.calculate_item_winrates(item_info, match_fixtures)
+    )
+
+    full = match_stats.MatchStats(item_components={})
+    slim = match_stats.MatchStats(item_components={})
+    for match, slim_match in zip(match_fixtures, slim_matches):
+        full.fold_match(match)
+        slim.fold_match(slim_match)
+    assert slim.to_doc() == full.to_doc()
+
+
+def test_prepare_match_archives_the_full_payload(match_fixtures, tmp_path):
+    match = match_fixtures[0]
+    try:
+        match_schema.configure_archive(str(tmp_path))
+        slim = match_schema.prepare_match(match)
+        assert match_schema.get_archive().get(match["match_id"]) == match
+    finally:
+        match_schema.configure_archive(None)
+    assert "teamfights" in match and "teamfights" not in slim
+    assert not match_schema.needs_slimming(slim)
+    assert match_schema.needs_slimming(match)
+
+
+def test_slim_stored_matches_rewrites_old_documents(match_fixtures):
+    docs = [
+        dict(match, _id=str(match["match_id"]), _rev="1-x") for match in match_fixtures
+    ]
+    docs.append(dict(match_schema.slim_match(docs[0]), _id="1", match_id=1))
+    docs.append({"_id": "_design/zeus_stats", "_rev": "1-x", "views": {}})
+    db = FakeDB(FakeCouchSession(docs))
+
+    counts = match_schema.slim_stored_matches(db, batch_size=2)
+    assert counts == dict(checked=4, slimmed=2, write_errors=0)
+    for doc in docs[:2]:
+        stored = db.r_session.docs[doc["_id"]]
+        assert stored["_rev"] == "2-x"
+        assert stored == dict(match_schema.slim_match(doc), _rev="2-x")
+    assert db.r_session.docs["1"]["_rev"] == docs[2]["_rev"]
+
+    assert match_schema.slim_stored_matches(db, batch_size=2)["slimmed"] == 0
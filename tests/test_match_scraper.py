@@ -0,0 +1,73 @@
+import collections
+
+import pytest
+
+import couchdb
+import match_scraper
+import matchlib
+import opendota
+import parse_requester
+import rate_limiter
+import redis_queue
+import retry_policy
+from tests.conftest import FakeCouchSession, FakeDB, stored_docs
+
+
+def existence_checks(db):
+    return [
+        body["keys"] for path, body in db.r_session.requests if path == "/_all_docs"
+    ]
+
+
+def test_filter_new_match_ids_checks_each_page_once(redis_client):
+    db = FakeDB(FakeCouchSession(stored_docs("2", "4")))
+
+    assert match_scraper.filter_new_match_ids(db, redis_client, [1, 2, 3, 4]) == [1, 3]
+    assert existence_checks(db) == [["1", "2", "3", "4"]]
+
+    # Everything on the first page is now claimed or known stored
+    assert match_scraper.filter_new_match_ids(db, redis_client, [3, 4, 5]) == [5]
+    assert existence_checks(db)[-1] == ["5"]
+
+    redis_queue.forget_match_ids(redis_client, [3])
+    assert match_scraper.filter_new_match_ids(db, redis_client, [3, 4]) == [3]
+    assert match_scraper.filter_new_match_ids(db, redis_client, [1, 2]) == []
+    assert existence_checks(db)[-1] == ["3"]
+
+
+def test_already_claimed_ids_are_not_counted_as_stored(redis_client):
+    db = FakeDB(FakeCouchSession(stored_docs("2")))
+    redis_queue.claim_match_ids(redis_client, [3])
+    stats = collections.Counter()
+
+    assert match_scraper.filter_new_match_ids(db, redis_client, [1, 2, 3], stats) == [1]
+    assert stats == {"already_claimed": 1, "already_stored": 1}
+
+
+def test_failed_scrape_releases_its_claims(redis_client, monkeypatch):
+    db = FakeDB()
+    monkeypatch.setattr(couchdb, "get_matches_db", lambda: db)
+    monkeypatch.setattr(redis_queue, "make_redis_client", lambda: redis_client)
+    monkeypatch.setattr(rate_limiter, "install", lambda redis_client: None)
+    monkeypatch.setattr(
+        opendota.RETRY_POLICY.breaker, "share", lambda redis_client: None
+    )
+    monkeypatch.setattr(
+        matchlib,
+        "iterate_match_pages",
+        lambda start_time, limit: iter([[{"match_id": 1}, {"match_id": 2}]]),
+    )
+    monkeypatch.setattr(
+        opendota,
+        "get_match_by_id",
+        lambda match_id: {"match_id": match_id, "start_time": 0},
+    )
+
+    def request_parses(matches, redis_client):
+        raise retry_policy.RetriesExhausted("request_parse", 3, None)
+
+    monkeypatch.setattr(parse_requester, "request_parses", request_parses)
+
+    with pytest.raises(retry_policy.RetriesExhausted):
+        match_scraper.populate_matches_from_start_time(0, num_matches=2)
+    assert redis_client.smembers(redis_queue.SEEN_MATCH_IDS) == set()
@@ -0,0 +1,181 @@
+import collections
+import json
+
+import pytest
+
+import constants_store
+import couchdb
+import item_rater
+import match_stats
+import matchlib
+import objective_rater
+from tests.conftest import FakeCouchSession, FakeDB, FakeResponse
+
+
+@pytest.fixture(autouse=True)
+def item_info(monkeypatch):
+    with open("tests/fixtures/item_components.json") as f:
+        components = json.loads(f.read())
+    item_info = collections.defaultdict(lambda: {"components": None})
+    item_info.update({key: {"components": parts} for key, parts in components.items()})
+    get_table = constants_store.get_table
+    monkeypatch.setattr(
+        constants_store,
+        "get_table",
+        lambda table, **kwargs: (
+            item_info if table == "items" else get_table(table, **kwargs)
+        ),
+    )
+    return item_info
+
+
+class FakeChangesSession(FakeCouchSession):
+    """Adds a _changes feed over a list of docs"""
+
+    def __init__(self, docs):
+        super().__init__()
+        self.changes = [
+            {"seq": f"{i + 1}-x", "id": doc["_id"], "doc": doc}
+            for i, doc in enumerate(docs)
+        ]
+
+    def get(self, url, params=None):
+        if not url.endswith("/_changes"):
+            return super().get(url, params)
+        since = 0 if params["since"] == "0" else int(params["since"].split("-")[0])
+        results = self.changes[since : since + params["limit"]]
+        last_seq = results[-1]["seq"] if results else params["since"]
+        return FakeResponse({"results": results, "last_seq": last_seq})
+
+    def stats_doc(self):
+        return self.local_docs[match_stats.STATS_DOC_ID]
+
+
+def test_fold_matches_agrees_with_raters(match_fixtures, item_info, monkeypatch):
+    stats = match_stats.MatchStats()
+    for match in match_fixtures:
+        assert stats.fold_match(match)
+    assert not stats.fold_match({"match_id": 1, "radiant_win": True})
+    assert stats.matches == 2
+
+    components = matchlib.item_components(item_info)
+    expected_items = collections.defaultdict(dict)
+    for record in matchlib.iterate_match_records(match_fixtures):
+        for player, keys in zip(record.players, record.pruned_purchase_keys()):
+            for key in matchlib.counted_item_keys(keys, components):
+                wins, games = expected_items[player.hero_id].get(key, (0, 0))
+                expected_items[player.hero_id][key] = (
+                    wins + player.player_won,
+                    games + 1,
+                )
+    assert stats.hero_item_counts() == dict(expected_items)
+    assert sum(games for _, games in stats.hero_counts().values()) == 20
+
+    # Built components are left out per player, as calculate_item_winrates does
+    expected_winrates = item_rater.calculate_item_winrates(item_info, match_fixtures)
+    assert item_rater.calculate_item_winrates_from_stats(stats) == expected_winrates
+    wand_games = [
+        hero["items"].get("magic_wand", {}).get("games", 0)
+        for hero in expected_winrates.values()
+    ]
+    stick_games = [
+        hero["items"].get("magic_stick", {}).get("games", 0)
+        for hero in expected_winrates.values()
+    ]
+    assert sum(wand_games) == 14 and sum(stick_games) < 16
+    assert all(
+        item["wins"] >= 0 and item["games"] > 0
+        for hero in expected_winrates.values()
+        for item in hero["items"].values()
+    )
+
+    monkeypatch.setattr(
+        couchdb,
+        "get_all_parsed_matches_more_recent_than",
+        lambda *args, **kwargs: match_fixtures,
+    )
+    expected_towers = objective_rater.calculate_average_gpm_for_tower_configs(
+        objective_rater.calculate_gpm_advantage_for_all_tower_configurations(None)
+    )
+    assert stats.tower_configuration_averages() == pytest.approx(expected_towers)
+
+
+def test_update_stats_checkpoints_and_resumes(match_fixtures):
+    docs = [dict(match, _id=str(match["match_id"])) for match in match_fixtures]
+    docs.insert(1, {"_id": "_design/zeus_stats", "views": {}})
+    db = FakeDB(FakeChangesSession(docs[:2]))
+
+    stats = match_stats.load_stats(db)
+    counts = match_stats.update_stats(db, stats, batch_size=1)
+    assert counts == dict(batches=2, folded=1, skipped=1)
+    assert db.r_session.stats_doc()["last_seq"] == "2-x"
+
+    db.r_session.changes.append({"seq": "3-x", "id": docs[2]["_id"], "doc": docs[2]})
+    stats = match_stats.load_stats(db)
+    assert stats.matches == 1
+    match_stats.update_stats(db, stats, batch_size=10)
+
+    reloaded = match_stats.load_stats(db)
+    assert reloaded.last_seq == "3-x"
+    assert reloaded.matches == 2
+    assert reloaded.hero_item_counts() == stats.hero_item_counts()
+    assert reloaded.talents == stats.talents
+    assert (
+        reloaded.tower_configuration_averages() == stats.tower_configuration_averages()
+    )
+
+
+def test_stale_stats_are_rebuilt(monkeypatch):
+    db = FakeDB(FakeChangesSession([]))
+    match_stats.save_stats(db, match_stats.MatchStats("5-x"))
+    monkeypatch.setattr(match_stats, "STATS_VERSION", match_stats.STATS_VERSION + 1)
+
+    stats = match_stats.load_stats(db)
+    assert stats.last_seq == "0"
+    match_stats.save_stats(db, stats)
+    assert db.r_session.stats_doc()["version"] == match_stats.STATS_VERSION
+
+
+def test_rewritten_matches_are_not_counted_twice(match_fixtures):
+    first, second = [
+        dict(match, _id=str(match["match_id"]), _rev="1-x") for match in match_fixtures
+    ]
+    db = FakeDB(FakeChangesSession([first]))
+    stats = match_stats.load_stats(db)
+    match_stats.update_stats(db, stats)
+    assert stats.matches == 1
+
+    # eg. match_schema slimming the first match, then a new match whose
+    # first revisions the feed coalesced
+    db.r_session.changes.append(
+        {"seq": "2-x", "id": first["_id"], "doc": dict(first, _rev="2-y")}
+    )
+    db.r_session.changes.append(
+        {"seq": "3-x", "id": second["_id"], "doc": dict(second, _rev="2-z")}
+    )
+    match_stats.update_stats(db, stats)
+    assert stats.matches == 2
+    assert match_stats.load_stats(db).match_ids == {
+        first["match_id"],
+        second["match_id"],
+    }
+
+    # A rebuild only sees the latest revision, and counts it
+    rebuilt = match_stats.reset_stats(stats._rev)
+    db.r_session.changes = db.r_session.changes[1:]
+    match_stats.update_stats(db, rebuilt, batch_size=10)
+    assert rebuilt.matches == 2
+
+
+def test_stats_are_rebuilt_when_item_components_change(match_fixtures, item_info):
+    db = FakeDB(
+        FakeChangesSession(
+            [dict(match, _id=str(match["match_id"])) for match in match_fixtures]
+        )
+    )
+    match_stats.update_stats(db, match_stats.load_stats(db))
+    assert match_stats.load_stats(db).matches == 2
+
+    item_info["new_item"] = {"components": ["magic_wand"]}
+    stats = match_stats.load_stats(db)
+    assert stats.last_seq == "0" and stats.matches == 0
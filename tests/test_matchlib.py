@@ -1,5 +1,6 @@
 import json
 import os
+import re
 
 import pytest
 
@@ -115,3 +116,147 @@ def test_get_items():
     all_items = opendota.get_item_table()
     assert all_items["blink"]
     assert all_items["blades_of_attack"]
+
+
+def fake_explorer(rows):
+    queries = []
+
+    def query_explorer(query):
+        match = re.search(
+            r"> \((\d+), (\d+)\)\s+ORDER BY.*LIMIT (\d+)", query, re.DOTALL
+        )
+        cursor = (int(match.group(1)), int(match.group(2)))
+        page_size = int(match.group(3))
+        queries.append(cursor)
+        page = [row for row in rows if (row["start_time"], row["match_id"]) > cursor][
+            :page_size
+        ]
+        return {"rows": page}
+
+    return query_explorer, queries
+
+
+def test_iterate_matches_keyset_paging(monkeypatch):
+    # Several matches per start_time so pages split in the middle of a second
+    rows = [
+        {"match_id": match_id, "start_time": 1000 + match_id // 3}
+        for match_id in range(1, 26)
+    ]
+    query_explorer, queries = fake_explorer(rows)
+    monkeypatch.setattr(opendota, "query_explorer", query_explorer)
+
+    match_rows = list(matchlib.iterate_matches(1000, limit=100, page_size=4))
+    # start_time 1000 is excluded, like the old start_time > start query
+    assert match_rows == [row for row in rows if row["start_time"] > 1000]
+
+    resumed = list(
+        matchlib.iterate_matches(
+            1000,
+            limit=5,
+            page_size=4,
+            resume_from=matchlib.cursor_for(match_rows[6]),
+        )
+    )
+    assert resumed == match_rows[7:12]
+    assert queries[-1] == matchlib.cursor_for(match_rows[10])
+
+    pages = list(matchlib.iterate_match_pages(1000, limit=10, page_size=4))
+    assert [len(rows) for rows in pages] == [4, 4, 2]
+    assert sum(pages, []) == match_rows[:10]
+
+
+def _reference_prune_winmore_purchases(
+    full_match_data, item_purchases, advantage_threshold
+):
+    """The original per-purchase while loop, kept to check the rewrite against"""
+    times = full_match_data["players"][0]["times"]
+    gold_adv_per_min = [
+        radiant_adv / (i or 1)
+        for i, radiant_adv in enumerate(full_match_data["radiant_gold_adv"])
+    ]
+    for item_purchase_data in item_purchases:
+        pruned_purchase_log = []
+        current_time_idx = 0
+        for item_purchase in item_purchase_data["purchases"]:
+            try:
+                while item_purchase["time"] > times[current_time_idx + 1]:
+                    current_time_idx += 1
+            except IndexError:
+                pass
+            gold_advantage_at_that_time = gold_adv_per_min[current_time_idx]
+            if not item_purchase_data["is_radiant"]:
+                gold_advantage_at_that_time *= -1
+            if times[current_time_idx] > 600:
+                if (
+                    gold_advantage_at_that_time >= advantage_threshold
+                    and item_purchase_data["player_won"]
+                ):
+                    continue
+                if (
+                    gold_advantage_at_that_time < -advantage_threshold
+                    and not item_purchase_data["player_won"]
+                ):
+                    continue
+            pruned_purchase_log.append(item_purchase)
+        item_purchase_data["purchases"] = pruned_purchase_log
+    return item_purchases
+
+
+@pytest.mark.parametrize("advantage_threshold", [0, 20, 100, 500, 2000])
+def test_prune_winmore_matches_reference(
+    comeback_match_data, stomp_match_data, advantage_threshold
+):
+    for match_data in [comeback_match_data, stomp_match_data]:
+        expected = _reference_prune_winmore_purchases(
+            match_data,
+            [
+                matchlib.extract_item_purchases_from_player_data(player)
+                for player in match_data["players"]
+            ],
+            advantage_threshold,
+        )
+        actual = matchlib.prune_winmore_purchases(
+            match_data,
+            [
+                matchlib.extract_item_purchases_from_player_data(player)
+                for player in match_data["players"]
+            ],
+            advantage_threshold=advantage_threshold,
+        )
+        assert actual == expected
+
+
+def test_match_record_matches_dict_parsing(stomp_match_data):
+    record = matchlib.MatchRecord(stomp_match_data)
+    parsed = matchlib.parse_match(stomp_match_data)
+
+    assert record.match_id == stomp_match_data["match_id"]
+    assert len(record.players) == 10
+    assert [player.hero_id for player in record.players] == [
+        data["hero"]["id"] for data in parsed
+    ]
+    assert [player.player_won for player in record.players] == [
+        data["player_won"] for data in parsed
+    ]
+    assert record.pruned_purchase_keys() == [
+        [purchase["key"] for purchase in data["purchases"]] for data in parsed
+    ]
+    assert list(record.players[0].ability_upgrades) == (
+        stomp_match_data["players"][0]["ability_upgrades_arr"]
+    )
+    assert [key for _, key in record.tower_kills] == [
+        objective["key"]
+        for objective in matchlib.extract_objectives_dict_from_match(stomp_match_data)
+        if objective.get("key") in matchlib.towers_we_care_about
+    ]
+
+
+def test_match_record_from_projected_document(stomp_match_data):
+    projected = {
+        field: stomp_match_data[field]
+        for field in ["match_id", "radiant_win", "players"]
+    }
+    record = matchlib.MatchRecord(projected)
+    assert record.tower_kills == ()
+    assert len(record.gold_adv_per_min) == 0
+    assert record.players[0].hero_id == stomp_match_data["players"][0]["hero_id"]
@@ -0,0 +1,71 @@
+import asyncio
+import threading
+import time
+
+import opendota
+import opendota_async
+import retry_policy
+
+
+def test_fetch_matches_bounds_concurrency_and_reports_errors(monkeypatch):
+    lock = threading.Lock()
+    in_flight = []
+    max_in_flight = []
+
+    def fake_get_match_by_id(match_id):
+        with lock:
+            in_flight.append(match_id)
+            max_in_flight.append(len(in_flight))
+        time.sleep(0.01)
+        with lock:
+            in_flight.remove(match_id)
+        if match_id == 3:
+            raise retry_policy.RetriesExhausted("matches", 5, "HTTP 502")
+        return {"match_id": match_id}
+
+    monkeypatch.setattr(opendota, "get_match_by_id", fake_get_match_by_id)
+    results = opendota_async.fetch_matches(iter(range(10)), concurrency=4)
+
+    assert sorted(result.match_id for result in results) == list(range(10))
+    assert max(max_in_flight) <= 4
+    failed = [result for result in results if result.error is not None]
+    assert [result.match_id for result in failed] == [3]
+    assert failed[0].match is None
+    assert all(
+        result.match == {"match_id": result.match_id}
+        for result in results
+        if result.error is None
+    )
+
+
+def test_pulling_ids_does_not_block_the_event_loop(monkeypatch):
+    monkeypatch.setattr(
+        opendota, "get_match_by_id", lambda match_id: {"match_id": match_id}
+    )
+
+    def paged_ids():
+        yield from range(4)
+        # eg. waiting on the next explorer page
+        time.sleep(0.3)
+        yield from range(4, 8)
+
+    async def fetch_while_ticking():
+        ticks = []
+
+        async def tick():
+            while True:
+                ticks.append(time.monotonic())
+                await asyncio.sleep(0.01)
+
+        ticker = asyncio.ensure_future(tick())
+        client = opendota_async.AsyncOpenDota(concurrency=4)
+        try:
+            results = [result async for result in client.fetch_matches(paged_ids())]
+        finally:
+            client.close()
+            ticker.cancel()
+        return results, ticks
+
+    results, ticks = asyncio.run(fetch_while_ticking())
+    assert len(results) == 8
+    assert max(later - earlier for earlier, later in zip(ticks, ticks[1:])) < 0.2
@@ -0,0 +1,187 @@
+import json
+import os
+import signal
+import threading
+
+import pytest
+
+import match_cache
+import opendota
+import parse_requester
+import redis_queue
+import retry_policy
+
+
+class FakeWriter:
+    """Buffers matches until flush(), like BulkMatchWriter"""
+
+    def __init__(self, fail_ids=()):
+        self.fail_ids = fail_ids
+        self.pending = []
+        self.stored = []
+
+    def add(self, match):
+        self.pending.append(match)
+        return None
+
+    def flush_if_due(self):
+        return None
+
+    def flush(self):
+        results = []
+        for match in self.pending:
+            if match["match_id"] in self.fail_ids:
+                results.append(
+                    {"id": str(match["match_id"]), "error": "forbidden", "reason": "no"}
+                )
+            else:
+                results.append({"ok": True, "id": str(match["match_id"])})
+                self.stored.append(match)
+        self.pending = []
+        return results
+
+
+def test_target_workers_follows_depth_within_budget():
+    assert parse_requester.target_workers(0, 8) == 1
+    assert (
+        parse_requester.target_workers(parse_requester.MATCHES_PER_WORKER * 3, 8) == 3
+    )
+    assert parse_requester.target_workers(10**6, 4) == 4
+    limits = {("opendota", None): (parse_requester.WORKER_REQUEST_RATE * 2, 10)}
+    assert parse_requester.target_workers(10**6, 8, limits) == 2
+
+
+def test_stopped_worker_stores_what_it_holds(redis_client, monkeypatch):
+    stop = threading.Event()
+    parsed = {
+        "match_id": 1,
+        "start_time": 0,
+        "players": [{"purchase_log": [{"key": "tango"}]}],
+    }
+
+    def get_match_by_id(match_id, **kwargs):
+        # Asked to stop mid-fetch, eg. by SIGTERM
+        stop.set()
+        return parsed
+
+    monkeypatch.setattr(opendota, "get_match_by_id", get_match_by_id)
+    redis_queue.claim_in_flight(redis_client, [1, 2])
+    redis_queue.enqueue_unparsed_matches(
+        redis_client, [(parsed, "job"), ({"match_id": 2, "start_time": 0}, "job")]
+    )
+
+    writer = FakeWriter()
+    parse_requester._process_unparsed_match_queue(redis_client, writer, stop)
+
+    assert writer.stored == [parsed]
+    assert redis_queue.in_flight_match_ids(redis_client, [1, 2]) == [2]
+    assert redis_queue.parse_queue_stats(redis_client) == {"stored_on_check_1": 1}
+    # The unprocessed match is still queued, and the worker left nothing behind
+    assert redis_client.llen(redis_queue.QUEUE_NAME) == 1
+    assert redis_client.smembers(redis_queue.CONSUMERS) == set()
+    assert redis_client.zcard(redis_queue.DEADLINES) == 0
+
+
+def test_recheck_skips_a_cached_unparsed_copy(redis_client, tmp_path, monkeypatch):
+    stop = threading.Event()
+    unparsed = {"match_id": 1, "start_time": 0, "players": [{"purchase_log": None}]}
+    parsed = {
+        "match_id": 1,
+        "start_time": 0,
+        "players": [{"purchase_log": [{"key": "tango"}]}],
+    }
+    monkeypatch.setattr(match_cache, "_cache", None)
+    cache = match_cache.configure_cache(cache_dir=str(tmp_path))
+    cache.put(1, unparsed)
+
+    def fetch_match_by_id(match_id):
+        stop.set()
+        return parsed
+
+    monkeypatch.setattr(opendota, "_fetch_match_by_id", fetch_match_by_id)
+    redis_queue.enqueue_unparsed_matches(redis_client, [(unparsed, "job")])
+
+    writer = FakeWriter()
+    parse_requester._process_unparsed_match_queue(redis_client, writer, stop)
+    assert writer.stored == [parsed]
+
+    # The scraper's first fetch doesn't leave an unparsed copy behind either
+    cache = match_cache.configure_cache(cache_dir=str(tmp_path / "fresh"))
+    monkeypatch.setattr(opendota, "_fetch_match_by_id", lambda match_id: unparsed)
+    assert opendota.get_match_by_id(1) == unparsed
+    assert cache.get(1) is None
+
+
+def test_matches_that_fail_to_store_are_not_acked(redis_client, monkeypatch):
+    stop = threading.Event()
+
+    def get_match_by_id(match_id, **kwargs):
+        if match_id == 2:
+            stop.set()
+        return {
+            "match_id": match_id,
+            "start_time": 0,
+            "players": [{"purchase_log": [{"key": "tango"}]}],
+        }
+
+    monkeypatch.setattr(opendota, "get_match_by_id", get_match_by_id)
+    matches = [{"match_id": match_id, "start_time": 0} for match_id in (1, 2)]
+    redis_queue.claim_in_flight(redis_client, [1, 2])
+    redis_queue.enqueue_unparsed_matches(
+        redis_client, [(match, "job") for match in matches]
+    )
+
+    writer = FakeWriter(fail_ids={2})
+    parse_requester._process_unparsed_match_queue(redis_client, writer, stop)
+
+    assert [match["match_id"] for match in writer.stored] == [1]
+    assert redis_queue.in_flight_match_ids(redis_client, [1, 2]) == [2]
+    # Handed back on release rather than dropped
+    assert [
+        json.loads(raw)["match_id"]
+        for raw in redis_client.lrange(redis_queue.QUEUE_NAME, 0, -1)
+    ] == [2]
+
+
+def test_request_parses_claims_before_requesting(redis_client, monkeypatch):
+    requested = []
+
+    def request_parse(match_id):
+        if match_id == 3:
+            raise retry_policy.RetriesExhausted("request_parse", 3, "HTTP 502")
+        requested.append(match_id)
+        return {"job": {"jobId": f"job-{match_id}"}}
+
+    monkeypatch.setattr(opendota, "request_parse", request_parse)
+    # Another scraper got to 2 first
+    redis_queue.claim_in_flight(redis_client, [2])
+    matches = [{"match_id": match_id, "start_time": 0} for match_id in (1, 1, 2, 3, 4)]
+
+    with pytest.raises(retry_policy.RetriesExhausted):
+        parse_requester.request_parses(matches, redis_client, delay=0)
+    assert requested == [1]
+    # 1 was requested so stays queued; 3 failed and 4 was never tried
+    assert redis_queue.in_flight_match_ids(redis_client, [1, 2, 3, 4]) == [1, 2]
+    assert [
+        json.loads(raw)["match_id"]
+        for raw in redis_client.lrange(redis_queue.QUEUE_NAME, 0, -1)
+    ] == [1]
+
+    monkeypatch.setattr(
+        opendota, "request_parse", lambda match_id: {"job": {"jobId": "job"}}
+    )
+    assert parse_requester.request_parses(matches, redis_client, delay=60) == [3, 4]
+    assert redis_client.zcard("delayed:") == 2
+
+
+def test_worker_stops_on_sigterm():
+    handlers = signal.getsignal(signal.SIGINT), signal.getsignal(signal.SIGTERM)
+    try:
+        stop = parse_requester._WorkerStop(threading.Event())
+        assert not stop.is_set()
+        os.kill(os.getpid(), signal.SIGTERM)
+        assert stop.is_set()
+        assert not stop.stop.is_set()
+    finally:
+        signal.signal(signal.SIGINT, handlers[0])
+        signal.signal(signal.SIGTERM, handlers[1])
@@ -0,0 +1,96 @@
+import fakeredis
+import pytest
+
+import rate_limiter
+
+
+def test_local_limiter_charges_api_and_endpoint_buckets():
+    limiter = rate_limiter.LocalRateLimiter(
+        limits={("opendota", None): (100, 3), ("opendota", "explorer"): (1, 1)}
+    )
+    assert limiter.try_acquire("opendota", "explorer") == (True, 0)
+
+    granted, wait = limiter.try_acquire("opendota", "explorer")
+    assert not granted
+    assert 0 < wait <= 1
+
+    # A refused call doesn't spend tokens from the API-wide bucket
+    assert limiter.try_acquire("opendota", "matches")[0]
+    assert limiter.try_acquire("opendota", "matches")[0]
+    assert not limiter.try_acquire("opendota", "matches")[0]
+
+
+def test_acquire_nonblocking_and_timeout():
+    limiter = rate_limiter.LocalRateLimiter(limits={("stratz", None): (0.01, 1)})
+    assert rate_limiter.acquire("stratz", limiter=limiter)
+    assert not rate_limiter.acquire("stratz", block=False, limiter=limiter)
+    with pytest.raises(rate_limiter.RateLimitTimeout):
+        rate_limiter.acquire("stratz", timeout=1, limiter=limiter)
+    # APIs without configured limits are never throttled
+    assert rate_limiter.acquire("unlimited", block=False, limiter=limiter)
+
+
+@pytest.fixture
+def redis_server():
+    return fakeredis.FakeServer()
+
+
+def _rewind(redis_client, limiter, api, endpoint, seconds):
+    """Make a bucket look last refilled seconds earlier"""
+    key = limiter._key(api, endpoint)
+    ts = float(redis_client.hget(key, "ts"))
+    redis_client.hset(key, "ts", str(ts - seconds))
+
+
+def test_redis_limiter_caps_bursts_and_refills(redis_server):
+    redis_client = fakeredis.FakeRedis(server=redis_server)
+    limiter = rate_limiter.RedisRateLimiter(
+        redis_client, limits={("stratz", None): (0.5, 3)}
+    )
+    assert [limiter.try_acquire("stratz")[0] for _ in range(4)] == [
+        True,
+        True,
+        True,
+        False,
+    ]
+
+    # Two tokens' worth of refill
+    _rewind(redis_client, limiter, "stratz", None, 4)
+    assert [limiter.try_acquire("stratz")[0] for _ in range(3)] == [True, True, False]
+
+    # A long idle spell refills no further than the burst capacity
+    _rewind(redis_client, limiter, "stratz", None, 1000)
+    assert [limiter.try_acquire("stratz")[0] for _ in range(4)] == [
+        True,
+        True,
+        True,
+        False,
+    ]
+
+
+def test_redis_limiters_share_buckets(redis_server):
+    limits = {("opendota", None): (0.01, 2)}
+    first = rate_limiter.RedisRateLimiter(
+        fakeredis.FakeRedis(server=redis_server), limits=limits
+    )
+    second = rate_limiter.RedisRateLimiter(
+        fakeredis.FakeRedis(server=redis_server), limits=limits
+    )
+    assert first.try_acquire("opendota")[0]
+    assert second.try_acquire("opendota")[0]
+    assert not first.try_acquire("opendota")[0]
+    assert not second.try_acquire("opendota")[0]
+
+
+def test_redis_limiter_waits_for_the_slowest_bucket(redis_server):
+    limiter = rate_limiter.RedisRateLimiter(
+        fakeredis.FakeRedis(server=redis_server),
+        limits={("opendota", None): (2, 1), ("opendota", "explorer"): (0.25, 1)},
+    )
+    assert limiter.try_acquire("opendota", "explorer") == (True, 0)
+
+    granted, wait = limiter.try_acquire("opendota")
+    assert not granted and 0 < wait <= 0.5
+    # The explorer bucket refills at a quarter token a second
+    granted, wait = limiter.try_acquire("opendota", "explorer")
+    assert not granted and 0.5 < wait <= 4
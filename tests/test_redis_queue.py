@@ -0,0 +1,212 @@
+import json
+
+import redis_queue
+
+
+def push(redis_client, *match_ids):
+    for match_id in match_ids:
+        redis_client.lpush(redis_queue.QUEUE_NAME, json.dumps({"match_id": match_id}))
+
+
+def test_consumer_pops_in_order_and_acks(redis_client):
+    consumer = redis_queue.QueueConsumer(redis_client, "worker-1")
+    assert consumer.pop(timeout=0.01) is None
+
+    push(redis_client, 1, 2)
+    first = consumer.pop()
+    assert first.payload == {"match_id": 1}
+    assert redis_client.lrange(consumer.processing_list, 0, -1) == [first.raw]
+
+    consumer.ack(first)
+    assert redis_client.llen(consumer.processing_list) == 0
+    assert redis_client.zcard(redis_queue.DEADLINES) == 0
+
+    second = consumer.pop()
+    consumer.delay(second, 60)
+    assert redis_client.llen(consumer.processing_list) == 0
+    assert redis_client.zcard("delayed:") == 1
+
+
+def test_unacked_items_are_redelivered(redis_client):
+    crashed = redis_queue.QueueConsumer(redis_client, "worker-1")
+    push(redis_client, 1, 2)
+    expired = crashed.pop()
+    redis_client.zadd(redis_queue.DEADLINES, {expired.raw: 0})
+    # Popped but its deadline never written, as if it died right after BLMOVE
+    no_deadline = crashed.pop()
+    redis_client.zrem(redis_queue.DEADLINES, no_deadline.raw)
+
+    assert redis_queue.reap_expired(redis_client, visibility_timeout=0) == 1
+    other = redis_queue.QueueConsumer(redis_client, "worker-2")
+    assert other.pop().payload == {"match_id": 1}
+
+    # The first reap gave the other one a deadline, which has now passed
+    assert redis_queue.reap_expired(redis_client) == 1
+    assert redis_client.llen(crashed.processing_list) == 0
+    # worker-2's item isn't due yet
+    assert redis_queue.reap_expired(redis_client) == 0
+
+
+def test_release_hands_back_unacked_items(redis_client):
+    consumer = redis_queue.QueueConsumer(redis_client, "worker-1")
+    push(redis_client, 1, 2, 3)
+    consumer.pop()
+    consumer.pop()
+    assert consumer.release() == 2
+    assert not redis_client.sismember(redis_queue.CONSUMERS, "worker-1")
+
+    other = redis_queue.QueueConsumer(redis_client, "worker-2")
+    assert [other.pop().payload["match_id"] for _ in range(3)] == [1, 2, 3]
+
+
+def test_reaper_forgets_consumers_that_are_gone(redis_client):
+    crashed = redis_queue.QueueConsumer(redis_client, "worker-1", visibility_timeout=60)
+    idle = redis_queue.QueueConsumer(redis_client, "worker-2", visibility_timeout=60)
+    push(redis_client, 1)
+    crashed.pop()
+    # Its heartbeat runs out, but it still has an item to hand back
+    redis_client.delete(crashed.heartbeat_key)
+    redis_queue.reap_expired(redis_client)
+    assert redis_client.smembers(redis_queue.CONSUMERS) == {b"worker-1", b"worker-2"}
+
+    redis_client.zadd(
+        redis_queue.DEADLINES, {redis_client.lindex(crashed.processing_list, 0): 0}
+    )
+    assert redis_queue.reap_expired(redis_client) == 1
+    assert redis_client.smembers(redis_queue.CONSUMERS) == {b"worker-2"}
+    assert idle.pop().payload == {"match_id": 1}
+
+
+def test_promote_delayed_moves_due_items_in_batches(redis_client, monkeypatch):
+    now = 1000000.0
+    monkeypatch.setattr(redis_queue.time, "time", lambda: now)
+    for match_id in range(5):
+        redis_queue.delay_queue(
+            redis_client,
+            redis_queue.QUEUE_NAME,
+            json.dumps({"match_id": match_id}),
+            delay=match_id - 3,
+        )
+    redis_queue.delay_queue(redis_client, "zeus:other_queue", "other", delay=-1)
+    # Not due until now + 1
+    redis_queue.delay_queue(redis_client, redis_queue.QUEUE_NAME, "later", delay=1)
+
+    assert redis_queue.promote_delayed(redis_client, limit=3) == (3, now + 1)
+    assert redis_queue.promote_delayed(redis_client) == (1, now + 1)
+    assert redis_queue.promote_delayed(redis_client) == (0, now + 1)
+
+    assert [
+        json.loads(raw)["match_id"]
+        for raw in redis_client.lrange(redis_queue.QUEUE_NAME, 0, -1)
+    ] == [0, 1, 2, 3]
+    # Only the queues passed in are touched
+    assert redis_client.llen("zeus:other_queue") == 0
+    assert redis_queue.promote_delayed(redis_client, ["zeus:other_queue"]) == (
+        1,
+        now + 1,
+    )
+    assert redis_client.lrange("zeus:other_queue", 0, -1) == [b"other"]
+    assert redis_client.zcard("delayed:") == 2
+
+
+def test_recheck_delays_follow_observed_parse_latency(redis_client):
+    # Too few samples to go on yet
+    redis_queue.record_parse_latency(redis_client, 10)
+    assert (
+        redis_queue.recheck_latencies(redis_client)
+        == redis_queue.DEFAULT_RECHECK_LATENCIES
+    )
+
+    for seconds in range(1, 101):
+        redis_queue.record_parse_latency(redis_client, seconds * 2)
+    assert redis_queue.recheck_latencies(redis_client) == (160, 190, 198)
+
+    assert redis_queue.recheck_delay(redis_client, 0, 0) == 160
+    assert (
+        redis_queue.recheck_delay(redis_client, 1, 170) == redis_queue.MIN_RECHECK_DELAY
+    )
+    assert redis_queue.recheck_delay(redis_client, 2, 100) == 98
+    assert redis_queue.recheck_delay(redis_client, 3, 500) is None
+
+    # Only the most recent samples count
+    for _ in range(redis_queue.LATENCY_SAMPLES):
+        redis_queue.record_parse_latency(redis_client, 40)
+    assert redis_queue.recheck_latencies(redis_client) == (40, 40, 40)
+
+    redis_queue.record_outcome(redis_client, "expired")
+    redis_queue.record_outcome(redis_client, "expired")
+    assert redis_queue.parse_queue_stats(redis_client) == {"expired": 2}
+
+
+def test_claims_keep_matches_from_being_queued_twice(redis_client):
+    assert redis_queue.claim_in_flight(redis_client, [1, 2, 3]) == [1, 2, 3]
+    assert redis_queue.claim_in_flight(redis_client, [3, 4]) == [4]
+    assert redis_queue.in_flight_match_ids(redis_client, [1, 4, 5]) == [1, 4]
+
+    matches = [{"match_id": match_id, "start_time": 0} for match_id in (1, 2)]
+    assert redis_queue.enqueue_unparsed_matches(
+        redis_client, [(match, "job") for match in matches]
+    ) == [1, 2]
+    assert redis_client.llen(redis_queue.QUEUE_NAME) == 2
+    redis_queue.enqueue_unparsed_matches(
+        redis_client, [({"match_id": 3, "start_time": 0}, "job")], delay=60
+    )
+    assert redis_client.zcard("delayed:") == 1
+
+    # Stored or expired matches can be queued again
+    assert not redis_queue.push_unparsed_match_to_queue(
+        redis_client, matches[0], "job", delay=0
+    )
+    redis_queue.finish_match_ids(redis_client, [1])
+    assert redis_queue.push_unparsed_match_to_queue(
+        redis_client, matches[0], "job", delay=0
+    )
+
+    consumer = redis_queue.QueueConsumer(redis_client, "worker-1")
+    assert consumer.pop().payload["match_id"] == 1
+
+
+def test_lost_in_flight_claims_lapse(redis_client, monkeypatch):
+    monkeypatch.setattr(redis_queue, "IN_FLIGHT_TTL", -1)
+    assert redis_queue.claim_in_flight(redis_client, [1]) == [1]
+    assert redis_queue.in_flight_match_ids(redis_client, [1]) == []
+    assert redis_queue.claim_in_flight(redis_client, [1]) == [1]
+
+
+def simulate_rechecks(redis_client, parse_latencies):
+    """Check matches that take parse_latencies to parse on the current
+    schedule, recording samples the way the parse-queue worker does.
+    Returns (check times, number expired)."""
+    checks = []
+    elapsed = 0
+    while True:
+        delay = redis_queue.recheck_delay(redis_client, len(checks), elapsed)
+        if delay is None:
+            break
+        elapsed += delay
+        checks.append(elapsed)
+
+    expired = 0
+    for latency in parse_latencies:
+        previous = 0
+        for check in checks:
+            if latency <= check:
+                redis_queue.record_parse_latency(redis_client, (previous + check) / 2)
+                break
+            previous = check
+        else:
+            redis_queue.record_expired(redis_client, checks[-1])
+            expired += 1
+    return checks, expired
+
+
+def test_recheck_schedule_does_not_shrink_from_its_own_samples(redis_client):
+    # Mostly quick parses, with a long tail
+    parse_latencies = [20 + i % 40 for i in range(180)] + [
+        100 + i * 40 for i in range(20)
+    ]
+    first_checks, first_expired = simulate_rechecks(redis_client, parse_latencies)
+    for _ in range(10):
+        checks, expired = simulate_rechecks(redis_client, parse_latencies)
+    assert checks[-1] >= first_checks[-1]
+    assert expired <= first_expired
@@ -0,0 +1,109 @@
+import json
+
+import pytest
+import requests
+
+import opendota
+import retry_policy
+from tests.conftest import FakeResponse
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    slept = []
+    monkeypatch.setattr(retry_policy.time, "sleep", slept.append)
+    return slept
+
+
+def make_send(outcomes):
+    outcomes = list(outcomes)
+
+    def send():
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    return send
+
+
+def test_parse_retry_after():
+    assert retry_policy.parse_retry_after("12") == 12
+    assert retry_policy.parse_retry_after(None) is None
+    assert retry_policy.parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0
+
+
+def test_retries_retryable_statuses_and_honors_retry_after(sleeps):
+    policy = retry_policy.RetryPolicy(max_attempts=4, base_delay=0.01)
+    send = make_send(
+        [
+            FakeResponse(status_code=429, headers={"Retry-After": "7"}),
+            requests.exceptions.Timeout(),
+            FakeResponse(status_code=503),
+            FakeResponse(status_code=200),
+        ]
+    )
+    assert policy.call("matches", send).status_code == 200
+    assert sleeps[0] == 7
+    assert all(delay <= 0.08 for delay in sleeps[1:])
+    assert policy.stats["matches"]["retries"] == 3
+    assert policy.stats["matches"]["calls"] == 4
+    assert policy.stats["matches"]["failures"] == 0
+
+
+def test_non_retryable_status_is_returned(sleeps):
+    policy = retry_policy.RetryPolicy()
+    assert (
+        policy.call("matches", make_send([FakeResponse(status_code=404)])).status_code
+        == 404
+    )
+    assert not sleeps
+
+
+def test_retries_exhausted_raises(sleeps):
+    policy = retry_policy.RetryPolicy(max_attempts=2)
+    with pytest.raises(retry_policy.RetriesExhausted):
+        policy.call(
+            "explorer",
+            make_send([FakeResponse(status_code=500), FakeResponse(status_code=502)]),
+        )
+    assert policy.stats["explorer"]["failures"] == 1
+
+
+def test_circuit_breaker_opens_after_sustained_failures(sleeps):
+    breaker = retry_policy.CircuitBreaker("test", failure_threshold=2, reset_timeout=30)
+    policy = retry_policy.RetryPolicy(
+        max_attempts=2, breaker=breaker, block_while_open=False
+    )
+    with pytest.raises(retry_policy.RetriesExhausted):
+        policy.call(
+            "matches",
+            make_send([FakeResponse(status_code=500), FakeResponse(status_code=500)]),
+        )
+    assert breaker.is_open()
+    with pytest.raises(retry_policy.CircuitOpen):
+        policy.call("matches", make_send([FakeResponse(status_code=200)]))
+
+
+class TruncatedResponse(FakeResponse):
+    def json(self):
+        raise json.decoder.JSONDecodeError("Expecting value", "<html>", 0)
+
+
+def test_only_gets_are_retried_on_bad_json(sleeps, monkeypatch):
+    requests_made = []
+
+    def api_request(method, path, headers=None, **params):
+        requests_made.append((method, path))
+        return TruncatedResponse()
+
+    monkeypatch.setattr(opendota, "_api_request", api_request)
+    with pytest.raises(retry_policy.RetriesExhausted):
+        opendota._fetch_match_by_id(1)
+    assert requests_made == [("GET", "/matches/1")] * opendota.JSON_RETRY_ATTEMPTS
+
+    # Posting again could queue a second parse job
+    requests_made.clear()
+    with pytest.raises(json.decoder.JSONDecodeError):
+        opendota.request_parse(1)
+    assert requests_made == [("POST", "/request/1")]